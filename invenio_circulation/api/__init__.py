@@ -24,7 +24,13 @@ import invenio_circulation.api.user
 import invenio_circulation.api.item
 import invenio_circulation.api.loan_cycle
 import invenio_circulation.api.location
+import invenio_circulation.api.mail
 import invenio_circulation.api.mail_template
 import invenio_circulation.api.loan_rule
 import invenio_circulation.api.loan_rule_match
+import invenio_circulation.api.rule_matcher
 import invenio_circulation.api.event
+import invenio_circulation.api.availability
+import invenio_circulation.api.context
+import invenio_circulation.api.waitlist
+import invenio_circulation.api.request_queue
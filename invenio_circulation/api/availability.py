@@ -0,0 +1,329 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015, 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""invenio-circulation api to query the availability of items.
+
+The availability is read from the materialized CirculationItemOccupancy
+table instead of the loan cycles themselves.
+"""
+
+import datetime
+from collections import defaultdict
+
+from invenio_db import db
+from sqlalchemy import and_
+
+from invenio_circulation.api.utils import DateException, DateManager
+from invenio_circulation.models import (CirculationItem,
+                                        CirculationItemOccupancy,
+                                        CirculationLoanCycle)
+
+_ONE_DAY = datetime.timedelta(days=1)
+
+
+def _get_ids(objs):
+    return [getattr(x, 'id', x) for x in objs]
+
+
+def _get_rows(items=None, exclude=None):
+    table = CirculationItemOccupancy.__table__
+    criteria = []
+    if items is not None:
+        criteria.append(table.c.item_id.in_(_get_ids(items)))
+    if exclude:
+        criteria.append(~table.c.loan_cycle_id.in_(_get_ids(exclude)))
+    query = (table.select().where(and_(*criteria))
+             .order_by(table.c.start_date))
+    return db.session.execute(query).fetchall()
+
+
+def get_periods(items, exclude=None):
+    """Get the busy periods of the given items.
+
+    :param items: CirculationItems or their ids.
+    :param exclude: CirculationLoanCycles (or their ids) to ignore.
+    :return: A list of (start_date, end_date) tuples.
+    """
+    if not items:
+        return []
+    return [(row.start_date, row.end_date)
+            for row in _get_rows(items, exclude)]
+
+
+def get_occupancy(items, exclude=None):
+    """Get the Occupancy of the given items, see get_periods."""
+    return DateManager.get_occupancy(get_periods(items, exclude))
+
+
+def get_loan_cycle_ids(items):
+    """Get the ids of the active loan cycles of the given items."""
+    if not items:
+        return []
+    return [row.loan_cycle_id for row in _get_rows(items)]
+
+
+def _merge(periods):
+    res = []
+    for start, end in sorted(periods):
+        if res and start <= res[-1][1] + _ONE_DAY:
+            res[-1] = (res[-1][0], max(res[-1][1], end))
+        else:
+            res.append((start, end))
+    return res
+
+
+def get_item_periods(items, exclude=None):
+    """Get the busy periods of many items using one query.
+
+    :param items: CirculationItems or their ids.
+    :param exclude: CirculationLoanCycles (or their ids) to ignore.
+    :return: A dictionary mapping the item ids to the sorted lists of their
+             merged (start_date, end_date) busy periods.
+    """
+    res = dict((x, []) for x in _get_ids(items))
+    if res:
+        for row in _get_rows(res.keys(), exclude):
+            res[row.item_id].append((row.start_date, row.end_date))
+    return dict((key, _merge(value)) for key, value in res.items())
+
+
+def get_busy_counts(item_periods):
+    """Count the busy items per day.
+
+    :param item_periods: Busy periods per item, see get_item_periods.
+    :return: A sorted list of (start_date, end_date, count) tuples, grouping
+             the consecutive days on which count items are busy. Days on
+             which all items are free are omitted.
+    """
+    changes = defaultdict(int)
+    for periods in item_periods.values():
+        for start, end in periods:
+            changes[start] += 1
+            changes[end + _ONE_DAY] -= 1
+
+    res = []
+    count = 0
+    days = sorted(day for day, change in changes.items() if change)
+    for day, next_day in zip(days, days[1:]):
+        count += changes[day]
+        if count:
+            res.append((day, next_day - _ONE_DAY, count))
+    return res
+
+
+def get_union(item_periods):
+    """Get the periods during which at least one of the items is busy."""
+    return _merge((start, end)
+                  for start, end, _ in get_busy_counts(item_periods))
+
+
+def get_intersection(item_periods):
+    """Get the periods during which all of the items are busy."""
+    if not item_periods:
+        return []
+    return _merge((start, end)
+                  for start, end, count in get_busy_counts(item_periods)
+                  if count == len(item_periods))
+
+
+def get_first_free_day(item_periods, date):
+    """Get the first day on or after date on which any of the items is free.
+
+    :return: The date, or None if no items are given.
+    """
+    if not item_periods:
+        return None
+    for start, end in get_intersection(item_periods):
+        if start <= date <= end:
+            return end + _ONE_DAY
+    return date
+
+
+class Availability(object):
+    """Availability of one or several items for a requested period."""
+
+    def __init__(self, start_date, end_date, periods):
+        """Constructor.
+
+        :param start_date: The requested start date.
+        :param end_date: The requested end date.
+        :param periods: The busy periods of the items.
+        """
+        self.start_date = start_date
+        self.end_date = end_date
+        self.periods = periods
+        self.contained_dates = None
+        self.suggested_dates = None
+
+        try:
+            self.contained_dates = DateManager.get_contained_date(
+                    start_date, end_date, periods)
+        except DateException:
+            return
+
+        if not self.free:
+            self.suggested_dates = DateManager.get_date_suggestions(periods)
+
+    @property
+    def free(self):
+        """True if the whole requested period is available."""
+        return self.contained_dates == (self.start_date, self.end_date)
+
+    @property
+    def available_from(self):
+        """The first date from which the requested duration is available."""
+        days = max((self.end_date - self.start_date).days, 1)
+        return DateManager.get_earliest_free_date(self.start_date, days,
+                                                  self.periods)
+
+    @classmethod
+    def join(cls, availabilities, start_date, end_date):
+        """Get the availability of all the given items together.
+
+        All the availabilities must be for the given requested period.
+        Without availabilities, the whole period is free.
+        """
+        if len(availabilities) == 1:
+            return availabilities[0]
+        periods = [x for availability in availabilities
+                   for x in availability.periods]
+        return cls(start_date, end_date, periods)
+
+    def validate(self):
+        """Raise a DateException if the requested period isn't available."""
+        if not self.free:
+            raise DateException(suggested_dates=self.suggested_dates,
+                                contained_dates=self.contained_dates)
+
+
+def check(items, start_date, end_date, exclude=None):
+    """Check the availability of many items for the given period.
+
+    The busy periods of all the items are fetched in one query. The result
+    can be passed on to the validation functions (try_loan_items,
+    try_request_items, try_loan_extension) to avoid fetching them again.
+
+    :param items: CirculationItems or their ids.
+    :param exclude: CirculationLoanCycles (or their ids) to ignore.
+    :return: A dictionary mapping the item ids to their Availability.
+    """
+    return dict((item_id, Availability(start_date, end_date, periods))
+                for item_id, periods
+                in get_item_periods(items, exclude).items())
+
+
+def find_copy(record_id, start_date, end_date):
+    """Find the copy of a record satisfying the requested period soonest.
+
+    All the requestable copies of the record are evaluated together. The
+    copies free during the whole period come first, then the ones becoming
+    free for the requested duration the soonest. Ties are broken by the
+    longest available part of the requested period.
+
+    :return: The CirculationItem and its Availability, or (None, None) if
+             the record has no requestable copy.
+    """
+    statuses = [CirculationItem.STATUS_ON_LOAN,
+                CirculationItem.STATUS_ON_SHELF]
+    items = [x for x in CirculationItem.search('record_id:{0}'.format(
+                record_id)) if x.current_status in statuses]
+    availability = check(items, start_date, end_date)
+
+    def key(item):
+        _availability = availability[item.id]
+        contained = _availability.contained_dates
+        length = (contained[1] - contained[0]).days if contained else -1
+        return _availability.available_from, -length, item.id
+
+    if not items:
+        return None, None
+    item = min(items, key=key)
+    return item, availability[item.id]
+
+
+def get_joint_availability(items, start_date, end_date, availability=None,
+                           exclude=None):
+    """Get the Availability of all the given items together.
+
+    :param availability: The result of check for the same period, fetched
+                         if not given.
+    """
+    if availability is None:
+        availability = check(items, start_date, end_date, exclude)
+    return Availability.join([availability[x] for x in _get_ids(items)],
+                             start_date, end_date)
+
+
+def _get_expected_rows(items=None):
+    table = CirculationLoanCycle.__table__
+    criteria = [~table.c.current_status.in_(
+                    CirculationItemOccupancy.INACTIVE_STATUSES),
+                table.c.item_id.isnot(None),
+                table.c.start_date.isnot(None),
+                table.c.end_date.isnot(None)]
+    if items is not None:
+        criteria.append(table.c.item_id.in_(_get_ids(items)))
+    query = table.select().with_only_columns(
+            [table.c.id, table.c.item_id, table.c.start_date,
+             table.c.end_date]).where(and_(*criteria))
+    return db.session.execute(query).fetchall()
+
+
+def check_consistency(items=None):
+    """Compare the materialized occupancy with the loan cycles.
+
+    :param items: Only check the given items, defaults to all items.
+    :return: A list of (loan_cycle_id, expected, actual) tuples, where
+             expected and actual are (item_id, start_date, end_date) tuples
+             or None if there is no such row.
+    """
+    expected = dict((row[0], tuple(row[1:]))
+                    for row in _get_expected_rows(items))
+    actual = dict((row.loan_cycle_id,
+                   (row.item_id, row.start_date, row.end_date))
+                  for row in _get_rows(items))
+
+    res = []
+    for clc_id in sorted(set(expected) | set(actual)):
+        if expected.get(clc_id) != actual.get(clc_id):
+            res.append((clc_id, expected.get(clc_id), actual.get(clc_id)))
+    return res
+
+
+def rebuild(items=None):
+    """Rebuild the materialized occupancy from the loan cycles.
+
+    :param items: Only rebuild the given items, defaults to all items.
+    :return: The number of stored busy periods.
+    """
+    table = CirculationItemOccupancy.__table__
+    query = table.delete()
+    if items is not None:
+        query = query.where(table.c.item_id.in_(_get_ids(items)))
+    db.session.execute(query)
+
+    rows = [dict(loan_cycle_id=clc_id, item_id=item_id,
+                 start_date=start_date, end_date=end_date)
+            for clc_id, item_id, start_date, end_date
+            in _get_expected_rows(items)]
+    if rows:
+        db.session.execute(table.insert(), rows)
+    db.session.commit()
+    return len(rows)
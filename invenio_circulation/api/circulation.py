@@ -21,16 +21,28 @@
 
 import uuid
 import datetime
+from collections import defaultdict
 
 import invenio_circulation.models as models
 
+from flask import current_app
+from invenio_db import db
+
 from invenio_circulation.api.utils import (DateException,
                                            ValidationExceptions,
                                            email_notification,
+                                           get_loan_period,
+                                           retry_on_conflict,
                                            _check_loan_duration,
-                                           _check_loan_period)
-from invenio_circulation.api.loan_cycle import update_waitlist
+                                           _check_loan_period,
+                                           _get_context)
+from invenio_circulation.api.waitlist import defer as defer_waitlist_update
+from invenio_circulation.api.waitlist import deferred as deferred_waitlist
+from invenio_circulation.api.availability import check as check_availability
+from invenio_circulation.api.availability import find_copy
 from invenio_circulation.api.event import create as create_event
+from invenio_circulation.api.event import batch as event_batch
+from invenio_circulation.api.event import flush as flush_events
 
 
 def _check_user(user):
@@ -81,7 +93,7 @@ def _check_request_start(start_date):
 
 
 def try_loan_items(user, items, start_date, end_date,
-                   waitlist=False, delivery=None):
+                   waitlist=False, delivery=None, context=None):
     """Check the conditions to loan the given items to the given user.
 
     Checked conditions:
@@ -95,6 +107,7 @@ def try_loan_items(user, items, start_date, end_date,
     :param user: CirculationUser.
     :param start_date: Start date of the loan (without time).
     :param end_date: End date of the loan (without time).
+    :param context: ValidationContext holding already loaded data.
 
     :raise: ValidationExceptions
     """
@@ -120,12 +133,12 @@ def try_loan_items(user, items, start_date, end_date,
         exceptions.append(('start_date', e))
 
     try:
-        _check_loan_duration(user, items, start_date, end_date)
+        _check_loan_duration(user, items, start_date, end_date, context)
     except Exception as e:
         exceptions.append(('duration', e))
 
     try:
-        _check_loan_period(user, items, start_date, end_date)
+        _check_loan_period(user, items, start_date, end_date, context)
     except DateException as e:
         exceptions.append(('date_suggestion', e))
     except Exception as e:
@@ -135,8 +148,9 @@ def try_loan_items(user, items, start_date, end_date,
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def loan_items(user, items, start_date, end_date,
-               waitlist=False, delivery=None):
+               waitlist=False, delivery=None, context=None):
     """Loan given items to the user.
 
     :param items: List of CirculationItem.
@@ -146,12 +160,14 @@ def loan_items(user, items, start_date, end_date,
     :param waitlist: If the desired dates are not available, the item will be
                      put on a waitlist.
     :param delivery: 'pick_up' or 'internal_mail'
+    :param context: ValidationContext holding already loaded data.
 
     :return: List of created CirculationLoanCycles
     :raise: ValidationExceptions
     """
     try:
-        try_loan_items(user, items, start_date, end_date, waitlist)
+        try_loan_items(user, items, start_date, end_date, waitlist,
+                       context=context)
         desired_start_date = start_date
         desired_end_date = end_date
     except ValidationExceptions as e:
@@ -169,24 +185,27 @@ def loan_items(user, items, start_date, end_date,
     if delivery is None:
         delivery = models.CirculationLoanCycle.DELIVERY_DEFAULT
     group_uuid = str(uuid.uuid4())
+    now = datetime.datetime.now()
     res = []
     for item in items:
         item.current_status = models.CirculationItem.STATUS_ON_LOAN
-        item.save()
         current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
-        clc = models.CirculationLoanCycle.new(
+        res.append(models.CirculationLoanCycle(
                 current_status=current_status, additional_statuses=[],
                 item_id=item.id, item=item, user_id=user.id, user=user,
                 start_date=start_date, end_date=end_date,
                 desired_start_date=desired_start_date,
                 desired_end_date=desired_end_date,
-                issued_date=datetime.datetime.now(),
-                group_uuid=group_uuid, delivery=delivery)
+                issued_date=now, group_uuid=group_uuid, delivery=delivery,
+                creation_date=now))
 
-        res.append(clc)
+    def create_events():
+        for item, clc in zip(items, res):
+            create_event(user_id=user.id, item_id=item.id,
+                         loan_cycle_id=clc.id,
+                         event=models.CirculationLoanCycle.EVENT_CREATED_LOAN)
 
-        create_event(user_id=user.id, item_id=item.id, loan_cycle_id=clc.id,
-                     event=models.CirculationLoanCycle.EVENT_CREATED_LOAN)
+    _write_bulk(list(items) + res, create_events)
 
     email_notification('item_loan', 'john.doe@cern.ch', user.email,
                        name=user.name, action='loaned',
@@ -196,7 +215,7 @@ def loan_items(user, items, start_date, end_date,
 
 
 def try_request_items(user, items, start_date, end_date,
-                      waitlist=False, delivery=None):
+                      waitlist=False, delivery=None, context=None):
     """Check the conditions to request the given items for the given user.
 
     Checked conditions:
@@ -210,6 +229,7 @@ def try_request_items(user, items, start_date, end_date,
     :param user: CirculationUser.
     :param start_date: Start date of the loan (without time).
     :param end_date: End date of the loan (without time).
+    :param context: ValidationContext holding already loaded data.
 
     :raise: ValidationExceptions
     """
@@ -237,12 +257,12 @@ def try_request_items(user, items, start_date, end_date,
         exceptions.append(('start_date', e))
 
     try:
-        _check_loan_duration(user, items, start_date, end_date)
+        _check_loan_duration(user, items, start_date, end_date, context)
     except Exception as e:
         exceptions.append(('duration', e))
 
     try:
-        _check_loan_period(user, items, start_date, end_date)
+        _check_loan_period(user, items, start_date, end_date, context)
     except DateException as e:
         exceptions.append(('date_suggestion', e))
     except Exception as e:
@@ -253,7 +273,8 @@ def try_request_items(user, items, start_date, end_date,
 
 
 def request_items(user, items, start_date, end_date,
-                  waitlist=False, delivery=None):
+                  waitlist=False, delivery=None, record_id=None,
+                  context=None):
     """Request given items for the user.
 
     :param items: List of CirculationItem.
@@ -263,12 +284,27 @@ def request_items(user, items, start_date, end_date,
     :param waitlist: If the desired dates are not available, the item will be
                      put on a waitlist.
     :param delivery: 'pick_up' or 'internal_mail'
+    :param record_id: If no items are given, request the copy of this record
+                      satisfying the dates soonest, see
+                      api.availability.find_copy.
+    :param context: ValidationContext holding already loaded data.
 
     :return: List of created CirculationLoanCycles
     :raise: ValidationExceptions
     """
+    context = _get_context(context)
+    if not items and record_id is not None:
+        item, item_availability = find_copy(record_id, start_date, end_date)
+        if item is None:
+            msg = 'No copy of record {0} is available.'.format(record_id)
+            raise ValidationExceptions([('items', Exception(msg))])
+        items = [item]
+        context.set_availability(start_date, end_date,
+                                 {item.id: item_availability})
+
     try:
-        try_request_items(user, items, start_date, end_date, waitlist)
+        try_request_items(user, items, start_date, end_date, waitlist,
+                          context=context)
         desired_start_date = start_date
         desired_end_date = end_date
     except ValidationExceptions as e:
@@ -286,20 +322,22 @@ def request_items(user, items, start_date, end_date,
 
     group_uuid = str(uuid.uuid4())
     res = []
-    for item in items:
-        current_status = models.CirculationLoanCycle.STATUS_REQUESTED
-        clc = models.CirculationLoanCycle.new(
-                current_status=current_status, item=item, user=user,
-                start_date=start_date, end_date=end_date,
-                desired_start_date=desired_start_date,
-                desired_end_date=desired_end_date,
-                issued_date=datetime.datetime.now(),
-                group_uuid=group_uuid, delivery=delivery)
-
-        res.append(clc)
-
-        create_event(user_id=user.id, item_id=item.id, loan_cycle_id=clc.id,
-                     event=models.CirculationLoanCycle.EVENT_CREATED_REQUEST)
+    with event_batch():
+        for item in items:
+            current_status = models.CirculationLoanCycle.STATUS_REQUESTED
+            clc = models.CirculationLoanCycle.new(
+                    current_status=current_status, item=item, user=user,
+                    start_date=start_date, end_date=end_date,
+                    desired_start_date=desired_start_date,
+                    desired_end_date=desired_end_date,
+                    issued_date=datetime.datetime.now(),
+                    group_uuid=group_uuid, delivery=delivery)
+
+            res.append(clc)
+
+            create_event(
+                    user_id=user.id, item_id=item.id, loan_cycle_id=clc.id,
+                    event=models.CirculationLoanCycle.EVENT_CREATED_REQUEST)
 
     email_notification('item_loan', 'john.doe@cern.ch', user.email,
                        name=user.name, action='requested',
@@ -308,17 +346,22 @@ def request_items(user, items, start_date, end_date,
     return res
 
 
-def try_return_items(items):
+def try_return_items(items, context=None):
     """Check the conditions to return the given items.
 
     Checked conditions:
     * Item object is valid (not None).
     * Item is in a valid condition (current_status: on_loan).
 
+    The active loan cycles of valid items are loaded into the context, with
+    one query, for return_items to finish them.
+
     :param items: List of CirculationItem.
+    :param context: ValidationContext holding already loaded data.
 
     :raise: ValidationExceptions
     """
+    context = _get_context(context)
     exceptions = []
     try:
         _check_items(items)
@@ -333,40 +376,286 @@ def try_return_items(items):
     if exceptions:
         raise ValidationExceptions(exceptions)
 
+    context.get_loan_cycles(items)
+
 
-def return_items(items):
+@retry_on_conflict
+def return_items(items, context=None):
     """Return given items.
 
     :param items: List of CirculationItem.
+    :param context: ValidationContext holding already loaded data.
 
     :return: List of created CirculationLoanCycles
     :raise: ValidationExceptions
     """
+    context = _get_context(context)
     try:
-        try_return_items(items)
+        try_return_items(items, context)
     except ValidationExceptions as e:
         raise e
 
     from invenio_circulation.views.utils import send_signal
     from invenio_circulation.signals import item_returned
 
+    CLC = models.CirculationLoanCycle
+    finished = []
+    for item in items:
+        clc = context.get_loan(item)
+        # Without a loan cycle, someone has to answer the signal
+        if clc is None and not send_signal(item_returned, None, item.id):
+            msg = 'The item {0} has no loan cycle on loan.'
+            raise Exception(msg.format(item.barcode))
+        if clc is not None:
+            finished.append(clc)
+
     for item in items:
         item.current_status = models.CirculationItem.STATUS_ON_SHELF
-        item.save()
+    for clc in finished:
+        clc.current_status = CLC.STATUS_FINISHED
+
+    def create_events():
+        for clc in finished:
+            create_event(user_id=clc.user.id, item_id=clc.item_id,
+                         loan_cycle_id=clc.id, event=CLC.EVENT_FINISHED)
+
+    with deferred_waitlist():
+        _write_bulk(list(items) + finished, create_events)
+        for clc in finished:
+            defer_waitlist_update(clc)
+
+    for clc in finished:
+        send_signal(item_returned, None, clc.item_id)
+
+
+def _check_bulk_size(barcodes):
+    limit = current_app.config['CIRCULATION_BULK_MAX_ITEMS']
+    if len(barcodes) > limit:
+        msg = 'At most {0} barcodes can be processed at once.'
+        raise Exception(msg.format(limit))
+
+
+def _resolve_barcodes(barcodes):
+    """Fetch the items of the barcodes and prepare a result per barcode."""
+    items = {}
+    if barcodes:
+        items = dict((item.barcode, item)
+                     for item in models.CirculationItem.find(
+                         models.CirculationItem.barcode.in_(set(barcodes))))
+
+    res, seen = [], set()
+    for barcode in barcodes:
+        result = {'barcode': barcode, 'item': items.get(barcode),
+                  'loan_cycle': None, 'errors': []}
+        if result['item'] is None:
+            msg = 'There is no item with the barcode {0}.'
+            result['errors'].append(('items',
+                                     Exception(msg.format(barcode))))
+        elif barcode in seen:
+            msg = 'The item {0} was scanned more than once.'
+            result['errors'].append(('items',
+                                     Exception(msg.format(barcode))))
+        seen.add(barcode)
+        res.append(result)
+    return res
+
+
+def _check_bulk_item_status(results, status):
+    for result in results:
+        if result['errors']:
+            continue
         try:
-            on_loan = models.CirculationLoanCycle.STATUS_ON_LOAN
-            query = 'item_id:{0} current_status:{1}'.format(item.id, on_loan)
-            clc = models.CirculationLoanCycle.search(query)[0]
-            clc.current_status = models.CirculationLoanCycle.STATUS_FINISHED
-            clc.save()
-            update_waitlist(clc)
-            create_event(user_id=clc.user.id, item_id=item.id,
-                         loan_cycle_id=clc.id,
-                         event=models.CirculationLoanCycle.EVENT_FINISHED)
-
-            send_signal(item_returned, None, item.id)
-        except IndexError:
-            # if the above fails, and no one returns on the signal, something
-            # went wrong
-            if not send_signal(item_returned, None, item.id):
-                raise
+            _check_item_status([result['item']], status)
+        except Exception as e:
+            result['errors'].append(('items_status', e))
+
+
+def _write_bulk(objs, create_events):
+    """Store the objects and the events of a bulk action in one transaction.
+
+    :param create_events: Function creating the events, called after the
+                          objects got their ids.
+    """
+    with event_batch():
+        try:
+            actions = models.CirculationObject.store_all(objs)
+            create_events()
+            flush_events()
+        except Exception:
+            db.session.rollback()
+            raise
+
+    models.CirculationObject.index_all(actions)
+
+
+@retry_on_conflict
+def bulk_loan_items(user, barcodes, start_date=None, end_date=None,
+                    delivery=None):
+    """Loan the items with the given barcodes to the user at once.
+
+    Meant for scanning stations: the items are fetched with one query and
+    validated one by one. The valid items are loaned in one transaction, the
+    invalid ones are reported without affecting the others.
+
+    :param user: CirculationUser.
+    :param barcodes: List of item barcodes.
+    :param start_date: Start date of the loans, defaults to today.
+    :param end_date: End date of the loans, defaults to the end of the loan
+                     period allowed for each item.
+    :param delivery: 'pick_up' or 'internal_mail'
+
+    :return: A list containing a dictionary per barcode, with the 'barcode',
+             the CirculationItem as 'item', the created CirculationLoanCycle
+             as 'loan_cycle' and the 'errors', a list of (category, exception)
+             tuples as in ValidationExceptions.
+    :raise: ValidationExceptions if the user or the start date are invalid.
+    """
+    _check_bulk_size(barcodes)
+    start_date = start_date or datetime.date.today()
+
+    exceptions = []
+    try:
+        _check_user(user)
+    except Exception as e:
+        exceptions.append(('user', e))
+
+    try:
+        _check_loan_start(start_date)
+    except Exception as e:
+        exceptions.append(('start_date', e))
+
+    if exceptions:
+        raise ValidationExceptions(exceptions)
+
+    results = _resolve_barcodes(barcodes)
+    _check_bulk_item_status(results, models.CirculationItem.STATUS_ON_SHELF)
+
+    end_dates = {}
+    by_end_date = defaultdict(list)
+    for result in results:
+        if result['errors']:
+            continue
+        item = result['item']
+        try:
+            _end_date = end_date or start_date + datetime.timedelta(
+                    days=get_loan_period(user, [item]))
+            _check_loan_duration(user, [item], start_date, _end_date)
+            end_dates[result['barcode']] = _end_date
+            by_end_date[_end_date].append(result)
+        except Exception as e:
+            result['errors'].append(('duration', e))
+
+    # One availability query per distinct end date, usually only one
+    for _end_date, _results in by_end_date.items():
+        availability = check_availability([x['item'] for x in _results],
+                                          start_date, _end_date)
+        for result in _results:
+            try:
+                availability[result['item'].id].validate()
+            except DateException as e:
+                result['errors'].append(('date_suggestion', e))
+
+    loaned = [x for x in results if not x['errors']]
+    if not loaned:
+        return results
+
+    if delivery is None:
+        delivery = models.CirculationLoanCycle.DELIVERY_DEFAULT
+    group_uuid = str(uuid.uuid4())
+    now = datetime.datetime.now()
+    for result in loaned:
+        item = result['item']
+        item.current_status = models.CirculationItem.STATUS_ON_LOAN
+        _end_date = end_dates[result['barcode']]
+        result['loan_cycle'] = models.CirculationLoanCycle(
+                current_status=models.CirculationLoanCycle.STATUS_ON_LOAN,
+                additional_statuses=[], item_id=item.id, item=item,
+                user_id=user.id, user=user,
+                start_date=start_date, end_date=_end_date,
+                desired_start_date=start_date, desired_end_date=_end_date,
+                issued_date=now, group_uuid=group_uuid, delivery=delivery,
+                creation_date=now)
+
+    def create_events():
+        for result in loaned:
+            create_event(user_id=user.id, item_id=result['item'].id,
+                         loan_cycle_id=result['loan_cycle'].id,
+                         event=models.CirculationLoanCycle.EVENT_CREATED_LOAN)
+
+    _write_bulk([x['item'] for x in loaned] +
+                [x['loan_cycle'] for x in loaned], create_events)
+
+    email_notification('item_loan', 'john.doe@cern.ch', user.email,
+                       name=user.name, action='loaned',
+                       items=[x['item'].record.title for x in loaned])
+
+    return results
+
+
+@retry_on_conflict
+def bulk_return_items(barcodes):
+    """Return the items with the given barcodes at once.
+
+    Meant for scanning stations and book drops: the items and their loan
+    cycles are fetched with one query each and validated one by one. The
+    valid items are returned in one transaction, the invalid ones are
+    reported without affecting the others.
+
+    :param barcodes: List of item barcodes.
+
+    :return: A list containing a dictionary per barcode, with the 'barcode',
+             the CirculationItem as 'item', the finished CirculationLoanCycle
+             as 'loan_cycle' and the 'errors', a list of (category, exception)
+             tuples as in ValidationExceptions.
+    """
+    from invenio_circulation.views.utils import send_signal
+    from invenio_circulation.signals import item_returned
+
+    _check_bulk_size(barcodes)
+
+    results = _resolve_barcodes(barcodes)
+    _check_bulk_item_status(results, models.CirculationItem.STATUS_ON_LOAN)
+
+    CLC = models.CirculationLoanCycle
+    item_ids = [x['item'].id for x in results if not x['errors']]
+    clcs = {}
+    if item_ids:
+        clcs = dict((clc.item_id, clc) for clc in CLC.find(
+                CLC.item_id.in_(item_ids),
+                CLC.current_status == CLC.STATUS_ON_LOAN))
+
+    for result in results:
+        if result['errors']:
+            continue
+        item = result['item']
+        result['loan_cycle'] = clc = clcs.get(item.id)
+        # Without a loan cycle, someone has to answer the signal
+        if clc is None and not send_signal(item_returned, None, item.id):
+            msg = 'The item {0} has no loan cycle on loan.'
+            result['errors'].append(('loan_cycle',
+                                     Exception(msg.format(item.barcode))))
+
+    returned = [x for x in results if not x['errors']]
+    if not returned:
+        return results
+
+    finished = [x['loan_cycle'] for x in returned if x['loan_cycle']]
+    for result in returned:
+        result['item'].current_status = models.CirculationItem.STATUS_ON_SHELF
+    for clc in finished:
+        clc.current_status = CLC.STATUS_FINISHED
+
+    def create_events():
+        for clc in finished:
+            create_event(user_id=clc.user.id, item_id=clc.item_id,
+                         loan_cycle_id=clc.id, event=CLC.EVENT_FINISHED)
+
+    with deferred_waitlist():
+        _write_bulk([x['item'] for x in returned] + finished, create_events)
+        for clc in finished:
+            defer_waitlist_update(clc)
+
+    for clc in finished:
+        send_signal(item_returned, None, clc.item_id)
+
+    return results
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation context shared by the validation and the actions."""
+
+import invenio_circulation.models as models
+
+from invenio_circulation.api.availability import check, _get_ids
+
+
+def _get_key(start_date, end_date, exclude):
+    return (start_date, end_date,
+            tuple(sorted(_get_ids(exclude))) if exclude else ())
+
+
+class ValidationContext(object):
+    """Data shared by the validation and the execution of actions.
+
+    The availabilities, loan rules and active loan cycles of the items are
+    loaded on first use and reused by every check and action the context
+    is passed to. This way checking several actions on the same items, as
+    well as running an action after its try_* function, loads them once.
+
+    A context reflects the state at the time of loading. It is meant for
+    one request or one action, not to be kept around.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self._availability = {}
+        self._loan_rules = {}
+        self._loan_cycles = {}
+
+    def set_availability(self, start_date, end_date, availability,
+                         exclude=None):
+        """Add already known availabilities.
+
+        :param availability: Result of api.availability.check for the given
+                             period.
+        """
+        key = _get_key(start_date, end_date, exclude)
+        self._availability.setdefault(key, {}).update(availability)
+
+    def get_availability(self, items, start_date, end_date, exclude=None):
+        """Get the Availability of the items for the given period.
+
+        Only the items not evaluated for this period yet are fetched, all of
+        them using one query.
+
+        :param exclude: CirculationLoanCycles (or their ids) to ignore.
+        :return: A dictionary mapping the item ids to their Availability,
+                 see api.availability.check.
+        """
+        key = _get_key(start_date, end_date, exclude)
+        known = self._availability.setdefault(key, {})
+        missing = [x for x in _get_ids(items) if x not in known]
+        if missing:
+            known.update(check(missing, start_date, end_date, exclude))
+        return known
+
+    def get_loan_rule(self, user, item):
+        """Get the CirculationLoanRule for the user and the item.
+
+        :raise: Exception if no CirculationLoanRuleMatch applies.
+        """
+        from invenio_circulation.api.utils import get_loan_rule
+
+        key = (user.id, item.id)
+        try:
+            return self._loan_rules[key]
+        except KeyError:
+            rule = self._loan_rules[key] = get_loan_rule(user, item)
+            return rule
+
+    def get_loan_period(self, user, items):
+        """Get the allowed loan period for the user and the items."""
+        try:
+            return max(self.get_loan_rule(user, item).loan_period
+                       for item in items)
+        except ValueError:
+            return 0
+
+    def is_renewable(self, user, items):
+        """Check if the loan of the items is renewable for the user."""
+        try:
+            return all(self.get_loan_rule(user, item).renewable
+                       for item in items)
+        except Exception:
+            return False
+
+    def get_loan_cycles(self, items):
+        """Get the active CirculationLoanCycles of the items.
+
+        The loan cycles of all the items not loaded yet are fetched with one
+        query.
+
+        :return: A dictionary mapping the item ids to the lists of their
+                 loan cycles, not finished or canceled.
+        """
+        CLC = models.CirculationLoanCycle
+        ids = _get_ids(items)
+        missing = [x for x in ids if x not in self._loan_cycles]
+        if missing:
+            for item_id in missing:
+                self._loan_cycles[item_id] = []
+            inactive = [CLC.STATUS_FINISHED, CLC.STATUS_CANCELED]
+            for clc in CLC.find(CLC.item_id.in_(missing),
+                                ~CLC.current_status.in_(inactive)):
+                self._loan_cycles[clc.item_id].append(clc)
+        return dict((x, self._loan_cycles[x]) for x in ids)
+
+    def get_loan(self, item):
+        """Get the on loan CirculationLoanCycle of the item or None."""
+        on_loan = models.CirculationLoanCycle.STATUS_ON_LOAN
+        for clc in self.get_loan_cycles([item])[item.id]:
+            if clc.current_status == on_loan:
+                return clc
+        return None
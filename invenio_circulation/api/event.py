@@ -19,8 +19,102 @@
 
 """invenio-circulation api responsible for CirculationEvent handling."""
 
+import datetime
+import gzip
+import json
+import os
+from contextlib import contextmanager
+
+import jsonpickle
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import and_, func
+from sqlalchemy.orm import make_transient_to_detached
+
 from invenio_circulation.models import CirculationEvent
 
+_BUFFER_KEY = 'circulation_event_buffer'
+
+
+def _get_buffer():
+    return db.session().info.get(_BUFFER_KEY)
+
+
+@contextmanager
+def batch():
+    """Buffer all events created inside the block and write them at once.
+
+    The events are written with one multi-row insert when the block is left,
+    and indexed in bulk afterwards. Nested blocks share the outermost buffer.
+    The ids of the buffered events are available after the block. If the
+    block raises, the buffered events are dropped without being written.
+    """
+    info = db.session().info
+    if info.get(_BUFFER_KEY) is not None:
+        yield info[_BUFFER_KEY]
+        return
+
+    info[_BUFFER_KEY] = []
+    try:
+        yield info[_BUFFER_KEY]
+    except Exception:
+        info.pop(_BUFFER_KEY)
+        raise
+    events = info.pop(_BUFFER_KEY)
+    if events:
+        _write(events)
+
+
+def flush():
+    """Write the currently buffered events, making their ids available."""
+    events = _get_buffer()
+    if events:
+        _write(events[:])
+        del events[:]
+
+
+def _write(events):
+    table = CirculationEvent.__table__
+    columns = [column.key for column in table.columns if column.key != 'id']
+    rows = [{key: getattr(ce, key, None) for key in columns}
+            for ce in events]
+
+    if db.session.bind.dialect.implicit_returning:
+        res = db.session.execute(table.insert().values(rows)
+                                 .returning(table.c.id))
+        ids = [row[0] for row in res]
+    else:
+        ids = [db.session.execute(table.insert().values(row))
+               .inserted_primary_key[0] for row in rows]
+    db.session.commit()
+
+    for ce, _id in zip(events, ids):
+        ce.id = _id
+        make_transient_to_detached(ce)
+        db.session.add(ce)
+
+    if current_app.config['CIRCULATION_EVENTS_ASYNC_INDEXING']:
+        from invenio_circulation.tasks import index_events
+        index_events.delay(ids)
+    else:
+        index(ids, refresh=True)
+
+
+def index(ids, refresh=False):
+    """Index the CirculationEvents with the given ids in bulk."""
+    from elasticsearch.helpers import bulk
+    from invenio_circulation.serializers import get_serializer
+
+    serializer = get_serializer(CirculationEvent)
+    doc_type = CirculationEvent.__tablename__
+
+    def actions():
+        for ce in CirculationEvent.query.filter(CirculationEvent.id.in_(ids)):
+            yield {'_index': ce._get_index_name(), '_type': doc_type,
+                   '_id': ce.id, '_source': serializer.dump(ce)}
+
+    bulk(CirculationEvent._es, actions(), refresh=refresh)
+
 
 def create(user_id=None, item_id=None, loan_cycle_id=None, location_id=None,
            mail_template_id=None, loan_rule_id=None, loan_rule_match_id=None,
@@ -28,21 +122,159 @@ def create(user_id=None, item_id=None, loan_cycle_id=None, location_id=None,
     """Create a CirculationEvent object.
 
     Only the entities involved in the event should be passed as arguments.
+    Inside of api.event.batch, the event is only written when the batch is
+    left, its id is available after that.
 
     :return: The newly created object.
     """
-    ce = CirculationEvent.new(user_id=user_id, item_id=item_id,
-                              loan_cycle_id=loan_cycle_id,
-                              location_id=location_id,
-                              mail_template_id=mail_template_id,
-                              loan_rule_id=loan_rule_id,
-                              loan_rule_match_id=loan_rule_match_id,
-                              event=event, description=description,
-                              **kwargs)
+    now = datetime.datetime.now()
+    ce = CirculationEvent(user_id=user_id, item_id=item_id,
+                          loan_cycle_id=loan_cycle_id,
+                          location_id=location_id,
+                          mail_template_id=mail_template_id,
+                          loan_rule_id=loan_rule_id,
+                          loan_rule_match_id=loan_rule_match_id,
+                          event=event, description=description,
+                          creation_date=now, modification_date=now,
+                          _data=jsonpickle.encode(kwargs), **kwargs)
+
+    events = _get_buffer()
+    if events is None:
+        _write([ce])
+    else:
+        events.append(ce)
 
     return ce
 
 
+def get_timeline(**kwargs):
+    """Get the events of an entity, sorted by their creation_date.
+
+    :param kwargs: Column filters, e.g. loan_cycle_id=1.
+    """
+    return (CirculationEvent.query.filter_by(**kwargs)
+            .order_by(CirculationEvent.creation_date).all())
+
+
+def _get_month(date):
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def _get_next_month(month):
+    if month.month == 12:
+        return month.replace(year=month.year+1, month=1)
+    return month.replace(month=month.month+1)
+
+
+def _get_months(before):
+    """Get the months holding events created before the given date."""
+    first = db.session.query(func.min(CirculationEvent.creation_date))
+    first = first.scalar()
+    if first is None:
+        return []
+
+    res = []
+    month = _get_month(first)
+    while month < _get_month(before):
+        res.append(month)
+        month = _get_next_month(month)
+    return res
+
+
+def _recover_archives(directory):
+    """Finish the archival of months interrupted before moving their files.
+
+    A temporary file left over by an interrupted archival holds the rows of
+    one delete. If its rows are gone from the database, the delete was
+    committed and the file is moved to the archive file, otherwise the rows
+    are still there to be archived again and the file is dropped.
+
+    :return: A list of (path, number of recovered events).
+    """
+    from invenio_circulation.export import move_gz
+
+    res = []
+    suffix = '.ndjson.gz.tmp'
+    for name in sorted(os.listdir(directory)):
+        if not (name.startswith(CirculationEvent.__tablename__) and
+                name.endswith(suffix)):
+            continue
+        tmp_path = os.path.join(directory, name)
+        count, first_id = 0, None
+        try:
+            with gzip.open(tmp_path) as f:
+                for line in f:
+                    if first_id is None:
+                        first_id = json.loads(line)['id']
+                    count += 1
+        except (IOError, EOFError, ValueError):
+            # Interrupted while writing, before the rows were deleted
+            first_id = None
+
+        query = CirculationEvent.query.filter_by(id=first_id)
+        if first_id is not None and not query.count():
+            path = tmp_path[:-len('.tmp')]
+            move_gz(tmp_path, path)
+            res.append((path, count))
+        else:
+            os.remove(tmp_path)
+    return res
+
+
+def archive(before, directory):
+    """Move the events created before the month of the given date to files.
+
+    Every month is written to a gzip compressed NDJSON file in the given
+    directory, named like the months elasticsearch index. The archived rows
+    are deleted from the database and the months index is dropped.
+
+    The rows are first written to a temporary file, which is only moved to
+    the archive file once the rows are deleted. Temporary files left over by
+    an interrupted archival are recovered first, see _recover_archives, so
+    rerunning it neither loses nor duplicates rows.
+
+    :return: A list of (path, number of archived events).
+    """
+    from invenio_circulation.export import (iter_rows, move_gz,
+                                            write_ndjson_gz)
+
+    table = CirculationEvent.__table__
+    res = _recover_archives(directory)
+    for month in _get_months(before):
+        criteria = [table.c.creation_date >= month,
+                    table.c.creation_date < _get_next_month(month)]
+        index_name = CirculationEvent.get_index_name(month)
+        path = os.path.join(directory, index_name + '.ndjson.gz')
+        tmp_path = path + '.tmp'
+
+        count = write_ndjson_gz(tmp_path, iter_rows(table, *criteria))
+        if count:
+            db.session.execute(table.delete().where(and_(*criteria)))
+            db.session.commit()
+            move_gz(tmp_path, path)
+            res.append((path, count))
+        else:
+            os.remove(tmp_path)
+        CirculationEvent._es.indices.delete(index=index_name, ignore=404)
+    return res
+
+
+def compact(before):
+    """Merge the segments of the monthly indices before the given date.
+
+    Past months don't receive new events anymore, so their indices can be
+    merged into a single segment.
+    """
+    res = []
+    for month in _get_months(before):
+        index_name = CirculationEvent.get_index_name(month)
+        CirculationEvent._es.indices.forcemerge(index=index_name,
+                                                max_num_segments=1,
+                                                ignore=404)
+        res.append(index_name)
+    return res
+
+
 def update(ce, **kwargs):
     """Update an event.
 
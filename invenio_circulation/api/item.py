@@ -21,7 +21,9 @@
 
 import invenio_circulation.models as models
 
-from invenio_circulation.api.utils import ValidationExceptions
+from invenio_circulation.api.utils import (ValidationExceptions,
+                                           retry_on_conflict)
+from invenio_circulation.api.circulation import _write_bulk
 from invenio_circulation.api.event import create as create_event
 from invenio_circulation.api.loan_cycle import (cancel_clcs,
                                                 overdue_clcs,
@@ -119,6 +121,7 @@ def try_lose_items(items):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def lose_items(items):
     """Lose the given items.
 
@@ -137,10 +140,15 @@ def lose_items(items):
 
     for item in items:
         item.current_status = models.CirculationItem.STATUS_MISSING
-        item.save()
-        create_event(item_id=item.id,
-                     event=models.CirculationItem.EVENT_MISSING)
 
+    def create_events():
+        for item in items:
+            create_event(item_id=item.id,
+                         event=models.CirculationItem.EVENT_MISSING)
+
+    _write_bulk(items, create_events)
+
+    for item in items:
         query = 'item_id:{0} current_status:{1}'
         statuses = [models.CirculationLoanCycle.STATUS_REQUESTED,
                     models.CirculationLoanCycle.STATUS_ON_LOAN]
@@ -168,6 +176,7 @@ def try_return_missing_items(items):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def return_missing_items(items):
     """Return the missing items.
 
@@ -181,9 +190,13 @@ def return_missing_items(items):
 
     for item in items:
         item.current_status = models.CirculationItem.STATUS_ON_SHELF
-        item.save()
-        create_event(item_id=item.id,
-                     event=models.CirculationItem.EVENT_RETURNED_MISSING)
+
+    def create_events():
+        for item in items:
+            create_event(item_id=item.id,
+                         event=models.CirculationItem.EVENT_RETURNED_MISSING)
+
+    _write_bulk(items, create_events)
 
 
 def try_process_items(items):
@@ -204,6 +217,7 @@ def try_process_items(items):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def process_items(items, description):
     """Process the given items.
 
@@ -219,10 +233,14 @@ def process_items(items, description):
 
     for item in items:
         item.current_status = models.CirculationItem.STATUS_IN_PROCESS
-        item.save()
-        create_event(item_id=item.id,
-                     event=models.CirculationItem.EVENT_IN_PROCESS,
-                     description=description)
+
+    def create_events():
+        for item in items:
+            create_event(item_id=item.id,
+                         event=models.CirculationItem.EVENT_IN_PROCESS,
+                         description=description)
+
+    _write_bulk(items, create_events)
 
 
 def try_return_processed_items(items):
@@ -243,6 +261,7 @@ def try_return_processed_items(items):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def return_processed_items(items):
     """Return the given processed items.
 
@@ -256,9 +275,13 @@ def return_processed_items(items):
 
     for item in items:
         item.current_status = models.CirculationItem.STATUS_ON_SHELF
-        item.save()
-        create_event(item_id=item.id,
-                     event=models.CirculationItem.EVENT_PROCESS_RETURNED)
+
+    def create_events():
+        for item in items:
+            create_event(item_id=item.id,
+                         event=models.CirculationItem.EVENT_PROCESS_RETURNED)
+
+    _write_bulk(items, create_events)
 
 
 def try_overdue_items(items):
@@ -20,17 +20,28 @@
 """invenio-circulation api responsible for CirculationLoanCycle handling."""
 
 import datetime
+import itertools
+import timeit
+
 import invenio_circulation.models as models
 
-from invenio_circulation.api.utils import (DateManager,
-                                           DateException,
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import or_, type_coerce
+
+from invenio_circulation.api.utils import (DateException,
                                            ValidationExceptions,
                                            check_field_in,
                                            _check_loan_duration,
                                            _check_loan_period_extension,
-                                           is_renewable)
+                                           _get_context, retry_on_conflict)
 from invenio_circulation.api.utils import update as _update
+from invenio_circulation.api.circulation import _write_bulk
 from invenio_circulation.api.event import create as create_event
+from invenio_circulation.api.event import batch as event_batch
+from invenio_circulation.api.waitlist import defer as defer_waitlist_update
+from invenio_circulation.api.waitlist import deferred as deferred_waitlist
+from invenio_circulation.api.waitlist import update_waitlists
 
 
 def create(item_id, user_id, current_status, start_date, end_date,
@@ -101,11 +112,13 @@ def try_cancel_clcs(clcs):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def cancel_clcs(clcs, reason=''):
     """Cancelt the given loan cycles.
 
     The items current_status will be set to 'on_shelf'.
-    This also calls api.loan_cycle.update_waitlist.
+    This also updates the waitlists behind the loan cycles, see
+    api.waitlist.defer.
     :raise: ValidationExceptions
     """
     try:
@@ -115,51 +128,17 @@ def cancel_clcs(clcs, reason=''):
 
     for clc in clcs:
         clc.current_status = models.CirculationLoanCycle.STATUS_CANCELED
-        clc.save()
-        create_event(loan_cycle_id=clc.id,
-                     event=models.CirculationLoanCycle.EVENT_CANCELED,
-                     description=reason)
-
-        update_waitlist(clc)
-
-
-def _get_involved_clcs(handled_clc, other_clcs):
-    res = []
-    statuses = [models.CirculationLoanCycle.STATUS_FINISHED,
-                models.CirculationLoanCycle.STATUS_CANCELED]
-    for clc in other_clcs:
-        _issued_date = clc.issued_date >= handled_clc.issued_date
-        _status = clc.current_status not in statuses
-        _id = clc.id != handled_clc.id
-        if _issued_date and _status and _id:
-            res.append(clc)
-    return res
 
+    def create_events():
+        for clc in clcs:
+            create_event(loan_cycle_id=clc.id,
+                         event=models.CirculationLoanCycle.EVENT_CANCELED,
+                         description=reason)
 
-def _get_affected_clcs(handled_clc, involved_clcs):
-    start_date = handled_clc.start_date
-    end_date = handled_clc.end_date
-    involved_clcs = sorted(involved_clcs, key=lambda x: x.issued_date)
-    res = []
-    for clc in involved_clcs:
-        if start_date <= clc.desired_start_date <= end_date:
-            # present:      |-----|
-            # requested:        ???|---|
-            # requested:     ?????
-            # start_date affected
-            res.append(clc)
-        elif start_date <= clc.desired_end_date <= end_date:
-            # present:      |-----|
-            # requested: |-|????
-            # end_date affected
-            res.append(clc)
-        elif (clc.desired_start_date <= start_date <= clc.desired_end_date and
-              clc.desired_start_date <= end_date <= clc.desired_end_date):
-            # present:          |-----|
-            # requested:    |--|???????????
-            # requested:    ???????????|--|
-            res.append(clc)
-    return res
+    with deferred_waitlist():
+        _write_bulk(clcs, create_events)
+        for clc in clcs:
+            defer_waitlist_update(clc)
 
 
 def update_waitlist(clc):
@@ -168,36 +147,11 @@ def update_waitlist(clc):
     This function will check all loan cycles occurring in the same period of
     time and update their start_date and end_date attributes if they differ
     from their desired_start_date and desired_end_date values if possible.
-    """
-    query = 'item_id:{0}'.format(clc.item.id)
-    other_clcs = models.CirculationLoanCycle.search(query)
-    involved_clcs = _get_involved_clcs(clc, other_clcs)
-    affected_clcs = _get_affected_clcs(clc, involved_clcs)
-
-    if not affected_clcs:
-        return
-
-    for affected_clc in affected_clcs:
-        _involved_clcs = involved_clcs[:]
-        _involved_clcs.remove(affected_clc)
-
-        start_date = affected_clc.desired_start_date
-        end_date = affected_clc.desired_end_date
-        requested_dates = [(lc.start_date, lc.end_date)
-                           for lc in _involved_clcs]
-        _start, _end = DateManager.get_contained_date(start_date, end_date,
-                                                      requested_dates)
-
-        _update = {}
-        if _start < affected_clc.start_date:
-            _update['start_date'] = _start
-
-        if _end > affected_clc.end_date:
-            _update['end_date'] = _end
 
-        if _update:
-            update(affected_clc, **_update)
-        # TODO: mail the other guy
+    :return: The changes, see api.waitlist.WaitlistScheduler.schedule.
+    """
+    # TODO: mail the other guys
+    return update_waitlists([clc.id])
 
 
 def try_overdue_clcs(clcs):
@@ -245,6 +199,7 @@ def try_overdue_clcs(clcs):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def overdue_clcs(clcs):
     """Overdue the given loan cycles.
 
@@ -259,17 +214,208 @@ def overdue_clcs(clcs):
     for clc in clcs:
         clc.additional_statuses.append(
                 models.CirculationLoanCycle.STATUS_OVERDUE)
-        clc.save()
-        create_event(loan_cycle_id=clc.id,
-                     event=models.CirculationLoanCycle.EVENT_OVERDUE)
 
+    def create_events():
+        for clc in clcs:
+            create_event(loan_cycle_id=clc.id,
+                         event=models.CirculationLoanCycle.EVENT_OVERDUE)
+
+    _write_bulk(clcs, create_events)
+
+
+def _get_overdue_criteria(today):
+    CLC = models.CirculationLoanCycle
+    statuses = type_coerce(CLC.additional_statuses, db.String)
+    return [CLC.current_status == CLC.STATUS_ON_LOAN,
+            CLC.end_date < today,
+            or_(statuses.is_(None),
+                ~statuses.like('%"{0}"%'.format(CLC.STATUS_OVERDUE)))]
+
+
+def _is_overdue(clc, today):
+    CLC = models.CirculationLoanCycle
+    return (clc.current_status == CLC.STATUS_ON_LOAN and
+            clc.end_date < today and
+            CLC.STATUS_OVERDUE not in (clc.additional_statuses or []))
+
+
+def detect_overdue(chunk_size=None):
+    """Overdue all loan cycles on loan past their end_date.
+
+    The loan cycles are found using the index on current_status and
+    end_date, and processed in chunks of chunk_size. Every chunk is locked,
+    checked again and written in one transaction together with its events,
+    so concurrent or repeated runs overdue each loan cycle once.
+
+    :param chunk_size: Defaults to CIRCULATION_OVERDUE_CHUNK_SIZE.
+    :return: A dictionary with the number of 'overdue' loan cycles, the
+             number of 'chunks' and the 'duration' in seconds.
+    """
+    CLC = models.CirculationLoanCycle
+    chunk_size = (chunk_size or
+                  current_app.config['CIRCULATION_OVERDUE_CHUNK_SIZE'])
+    today = datetime.date.today()
+    criteria = _get_overdue_criteria(today)
+
+    res = {'overdue': 0, 'chunks': 0}
+    start = timeit.default_timer()
+    last_id = 0
+    while True:
+        query = (db.session.query(CLC.id)
+                 .filter(CLC.id > last_id, *criteria)
+                 .order_by(CLC.id).limit(chunk_size).with_for_update())
+        ids = [x for x, in query]
+        if not ids:
+            db.session.commit()
+            break
+        last_id = ids[-1]
+
+        clcs = [x for x in CLC.find(CLC.id.in_(ids)) if _is_overdue(x, today)]
+        if not clcs:
+            db.session.commit()
+            continue
+        for clc in clcs:
+            clc.additional_statuses = ((clc.additional_statuses or []) +
+                                       [CLC.STATUS_OVERDUE])
+
+        def create_events():
+            for clc in clcs:
+                create_event(loan_cycle_id=clc.id, event=CLC.EVENT_OVERDUE)
+
+        _write_bulk(clcs, create_events)
+        res['overdue'] += len(clcs)
+        res['chunks'] += 1
+
+    res['duration'] = timeit.default_timer() - start
+    return res
+
+
+def _get_letter_ids(template_name, before=None):
+    """Query the ids of the loan cycles covered by the given letter."""
+    CE = models.CirculationEvent
+    query = db.session.query(CE.loan_cycle_id).filter(
+            CE.event == models.CirculationLoanCycle.EVENT_OVERDUE_LETTER,
+            CE.description == template_name,
+            CE.loan_cycle_id.isnot(None))
+    if before is not None:
+        query = query.filter(CE.creation_date <= before)
+    return query.subquery()
+
+
+def _get_letter_criteria(template_name, previous, before, today):
+    CLC = models.CirculationLoanCycle
+    statuses = type_coerce(CLC.additional_statuses, db.String)
+    res = [CLC.current_status == CLC.STATUS_ON_LOAN,
+           CLC.end_date < today,
+           statuses.like('%"{0}"%'.format(CLC.STATUS_OVERDUE)),
+           ~CLC.id.in_(_get_letter_ids(template_name))]
+    if previous is not None:
+        res.append(CLC.id.in_(_get_letter_ids(previous, before)))
+    return res
+
+
+def _get_title(item):
+    return item.record.title if item.record else item.barcode
+
+
+def send_overdue_letters(chunk_size=None):
+    """Send the overdue letters, one digest per user and letter.
+
+    CIRCULATION_OVERDUE_LETTERS lists the letters as (template_name, days)
+    tuples. The first letter covers every overdue loan cycle, every following
+    one the loan cycles covered by the previous letter at least the given
+    days ago. The overdue loan cycles of a user are rendered into one mail
+    per letter.
 
-def _extension_allowed(user, items):
-    if not is_renewable(user, items):
+    The users are processed in chunks of chunk_size. The covered loan cycles
+    are locked and checked again once locked. They get an
+    EVENT_OVERDUE_LETTER event, written in the transaction storing the mails,
+    so every letter covers a loan cycle once. If rendering or storing the
+    mails fails, neither the mails nor the events of the chunk are written.
+
+    :param chunk_size: Defaults to CIRCULATION_OVERDUE_CHUNK_SIZE.
+    :return: A dictionary with the number of sent 'letters', of covered
+             'loan_cycles' and the 'duration' in seconds.
+    """
+    from invenio_circulation.api.mail import dispatch, store_all
+    from invenio_circulation.api.mail_template import get_template
+
+    CLC = models.CirculationLoanCycle
+    config = current_app.config
+    chunk_size = chunk_size or config['CIRCULATION_OVERDUE_CHUNK_SIZE']
+    sender = 'john.doe@cern.ch'
+    today = datetime.date.today()
+    now = datetime.datetime.now()
+
+    res = {'letters': 0, 'loan_cycles': 0}
+    start = timeit.default_timer()
+    previous = None
+    for template_name, days in config['CIRCULATION_OVERDUE_LETTERS']:
+        criteria = _get_letter_criteria(template_name, previous,
+                                        now - datetime.timedelta(days=days),
+                                        today)
+        previous = template_name
+        template = get_template(template_name)
+        if template is None:
+            continue
+
+        query = (db.session.query(CLC.user_id).filter(*criteria)
+                 .distinct().order_by(CLC.user_id))
+        user_ids = [x for x, in query]
+        for i in range(0, len(user_ids), chunk_size):
+            query = (db.session.query(CLC.id)
+                     .filter(CLC.user_id.in_(user_ids[i:i + chunk_size]),
+                             *criteria)
+                     .order_by(CLC.id).with_for_update())
+            ids = [x for x, in query]
+            if ids:
+                # A concurrent run holding the locks before may have covered
+                # the loan cycles meanwhile, which only a new statement sees.
+                ids = [x for x, in db.session.query(CLC.id).filter(
+                        CLC.id.in_(ids), *criteria)]
+            if not ids:
+                db.session.commit()
+                continue
+
+            clcs = sorted(CLC.find(CLC.id.in_(ids)),
+                          key=lambda x: (x.user_id, x.id))
+            mails = []
+            with event_batch():
+                try:
+                    for _, group in itertools.groupby(clcs,
+                                                      lambda x: x.user_id):
+                        group = list(group)
+                        user = group[0].user
+                        subject, body = template.render(
+                                name=user.name, loan_cycles=group,
+                                items=[_get_title(x.item) for x in group])
+                        mails.append((sender, user.email, subject, body))
+                        for clc in group:
+                            create_event(user_id=user.id,
+                                         loan_cycle_id=clc.id,
+                                         mail_template_id=template.id,
+                                         event=CLC.EVENT_OVERDUE_LETTER,
+                                         description=template_name)
+                    store_all(mails)
+                except Exception:
+                    db.session.rollback()
+                    raise
+
+            res['letters'] += len(mails)
+            res['loan_cycles'] += len(clcs)
+
+    if res['letters']:
+        dispatch()
+    res['duration'] = timeit.default_timer() - start
+    return res
+
+
+def _extension_allowed(user, items, context=None):
+    if not _get_context(context).is_renewable(user, items):
         raise Exception('One of the items is not renewable.')
 
 
-def try_loan_extension(clcs, requested_end_date):
+def try_loan_extension(clcs, requested_end_date, context=None):
     """Check the conditions to extend the loan duration of the loan cycles.
 
     Checked conditions:
@@ -279,6 +425,7 @@ def try_loan_extension(clcs, requested_end_date):
     * The extended loan duration is valid.
     * The requested_end_date doesn't interfere with other loans/requests.
 
+    :param context: ValidationContext holding already loaded data.
     :raise: ValidationExceptions
     """
     start_date = datetime.date.today()
@@ -303,17 +450,18 @@ def try_loan_extension(clcs, requested_end_date):
         exceptions.append(('user', e))
 
     try:
-        _extension_allowed(user, items)
+        _extension_allowed(user, items, context)
     except Exception as e:
         exceptions.append(('extension_allowed', e))
 
     try:
-        _check_loan_duration(user, items, start_date, requested_end_date)
+        _check_loan_duration(user, items, start_date, requested_end_date,
+                             context)
     except Exception as e:
         exceptions.append(('duration', e))
 
     try:
-        _check_loan_period_extension(clcs, requested_end_date)
+        _check_loan_period_extension(clcs, requested_end_date, context)
     except DateException as e:
         exceptions.append(('date_suggestion', e))
 
@@ -321,15 +469,17 @@ def try_loan_extension(clcs, requested_end_date):
         raise ValidationExceptions(exceptions)
 
 
-def loan_extension(clcs, requested_end_date):
+@retry_on_conflict
+def loan_extension(clcs, requested_end_date, context=None):
     """Extend the given loan cycles.
 
     'overdue' will be removed from the attribute additional_statuses.
+    :param context: ValidationContext holding already loaded data.
     :raise: ValidationExceptions
     """
     new_end_date = requested_end_date
     try:
-        try_loan_extension(clcs, requested_end_date)
+        try_loan_extension(clcs, requested_end_date, context)
     except ValidationExceptions as e:
         raise e
 
@@ -341,9 +491,13 @@ def loan_extension(clcs, requested_end_date):
             pass
         clc.desired_end_date = requested_end_date
         clc.end_date = new_end_date
-        clc.save()
-        create_event(loan_cycle_id=clc.id,
-                     event=models.CirculationLoanCycle.EVENT_LOAN_EXTENSION)
+
+    def create_events():
+        event = models.CirculationLoanCycle.EVENT_LOAN_EXTENSION
+        for clc in clcs:
+            create_event(loan_cycle_id=clc.id, event=event)
+
+    _write_bulk(clcs, create_events)
 
 
 def try_transform_into_loan(clcs):
@@ -382,6 +536,7 @@ def try_transform_into_loan(clcs):
         raise ValidationExceptions(exceptions)
 
 
+@retry_on_conflict
 def transform_into_loan(clcs):
     """Transform the given requests into loans.
 
@@ -393,12 +548,15 @@ def transform_into_loan(clcs):
     except ValidationExceptions as e:
         raise e
 
-    event = models.CirculationLoanCycle.EVENT_TRANSFORMED_REQUEST
-
     for clc in clcs:
         clc.current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
-        clc.save()
-        create_event(loan_cycle_id=clc.id, event=event)
+
+    def create_events():
+        event = models.CirculationLoanCycle.EVENT_TRANSFORMED_REQUEST
+        for clc in clcs:
+            create_event(loan_cycle_id=clc.id, event=event)
+
+    _write_bulk(clcs, create_events)
 
 
 schema = {}
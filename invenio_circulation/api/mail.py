@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation api to queue and send E-mails.
+
+The mails are written to the CirculationMail outbox and sent in batches by a
+celery task, each batch over one SMTP connection configured by Flask-Mail.
+For local testing, a debugging server printing the mails can be started with
+``python -m smtpd -n -c DebuggingServer localhost:1025`` and used by setting
+MAIL_SERVER to 'localhost' and MAIL_PORT to 1025.
+"""
+
+import datetime
+import smtplib
+import socket
+import uuid
+
+from flask import current_app
+from flask_mail import Message
+from invenio_db import db
+from sqlalchemy import and_, func
+
+from invenio_circulation.models import CirculationMail
+
+_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected,
+                      smtplib.SMTPConnectError, socket.error)
+
+
+def queue(sender, recipient, subject, body):
+    """Add a mail to the outbox, see queue_all."""
+    return queue_all([(sender, recipient, subject, body)])
+
+
+def queue_all(mails):
+    """Add the given mails to the outbox and dispatch their sending.
+
+    The current session is committed, to write the mails together with
+    other changes use store_all.
+
+    :param mails: (sender, recipient, subject, body) tuples.
+    :return: The number of queued mails.
+    """
+    count = store_all(mails)
+    if count:
+        db.session.commit()
+        dispatch()
+    return count
+
+
+def store_all(mails):
+    """Write the given mails to the outbox without committing.
+
+    The mails are written with one multi-row insert. They are sent once the
+    transaction is committed and dispatch is called, which allows to store
+    them together with the changes they are about.
+
+    :param mails: (sender, recipient, subject, body) tuples.
+    :return: The number of stored mails.
+    """
+    now = datetime.datetime.now()
+    rows = [{'sender': sender, 'recipient': recipient, 'subject': subject,
+             'body': body, 'status': CirculationMail.STATUS_PENDING,
+             'attempts': 0, 'next_attempt': now, 'creation_date': now}
+            for sender, recipient, subject, body in mails]
+    if rows:
+        db.session.execute(CirculationMail.__table__.insert().values(rows))
+    return len(rows)
+
+
+def dispatch():
+    """Send the queued mails, in a celery task if configured."""
+    if current_app.config['CIRCULATION_MAIL_ASYNC']:
+        from invenio_circulation.tasks import send_mails
+        send_mails.delay()
+    else:
+        send_all()
+
+
+def claim(limit):
+    """Claim the due mails of the outbox for sending.
+
+    Pending mails and mails whose claim expired are due. The claimed mails
+    can't be claimed again for CIRCULATION_MAIL_CLAIM_TIMEOUT seconds.
+
+    :return: The claimed CirculationMails, at most limit.
+    """
+    now = datetime.datetime.now()
+    table = CirculationMail.__table__
+    due = and_(table.c.status.in_([CirculationMail.STATUS_PENDING,
+                                   CirculationMail.STATUS_SENDING]),
+               table.c.next_attempt <= now)
+
+    query = (db.session.query(CirculationMail.id).filter(due)
+             .order_by(CirculationMail.next_attempt, CirculationMail.id)
+             .limit(limit))
+    ids = [x for x, in query]
+    if not ids:
+        return []
+
+    token = str(uuid.uuid4())
+    timeout = current_app.config['CIRCULATION_MAIL_CLAIM_TIMEOUT']
+    db.session.execute(table.update().where(and_(table.c.id.in_(ids), due))
+                       .values(status=CirculationMail.STATUS_SENDING,
+                               claim=token,
+                               next_attempt=now + datetime.timedelta(
+                                   seconds=timeout)))
+    db.session.commit()
+    return (CirculationMail.query.filter_by(claim=token)
+            .order_by(CirculationMail.id).all())
+
+
+def _get_message(cm):
+    return Message(sender=cm.sender, recipients=[cm.recipient],
+                   subject=cm.subject, body=cm.body)
+
+
+def _set_sent(cm):
+    cm.status = CirculationMail.STATUS_SENT
+    cm.attempts += 1
+    cm.sent_date = datetime.datetime.now()
+    cm.next_attempt = None
+    cm.claim = None
+    cm.last_error = None
+
+
+def _set_retry(cm, error):
+    """Schedule the next attempt, doubling the delay after every failure."""
+    cm.attempts += 1
+    cm.claim = None
+    cm.last_error = '{0}: {1}'.format(type(error).__name__, error)
+    if cm.attempts >= current_app.config['CIRCULATION_MAIL_MAX_ATTEMPTS']:
+        cm.status = CirculationMail.STATUS_FAILED
+        cm.next_attempt = None
+        return False
+
+    delay = (current_app.config['CIRCULATION_MAIL_RETRY_DELAY'] *
+             2 ** (cm.attempts - 1))
+    cm.status = CirculationMail.STATUS_PENDING
+    cm.next_attempt = (datetime.datetime.now() +
+                       datetime.timedelta(seconds=delay))
+    return True
+
+
+def send(mails):
+    """Send the given CirculationMails over one SMTP connection.
+
+    A mail failing on its own is retried later, see _set_retry. If the
+    connection fails, the current and the remaining mails are retried later.
+
+    :return: A dictionary with the number of 'sent', 'retried' and 'failed'
+             mails.
+    """
+    res = {'sent': 0, 'retried': 0, 'failed': 0}
+
+    def _retry(cm, error):
+        current_app.logger.warning('Sending mail %s failed: %s', cm.id, error)
+        res['retried' if _set_retry(cm, error) else 'failed'] += 1
+
+    position = 0
+    try:
+        with current_app.extensions['mail'].connect() as connection:
+            while position < len(mails):
+                cm = mails[position]
+                try:
+                    connection.send(_get_message(cm))
+                except _CONNECTION_ERRORS:
+                    raise
+                except Exception as e:
+                    _retry(cm, e)
+                else:
+                    _set_sent(cm)
+                    res['sent'] += 1
+                position += 1
+    except Exception as e:
+        for cm in mails[position:]:
+            _retry(cm, e)
+
+    db.session.commit()
+    return res
+
+
+def send_pending(limit=None):
+    """Claim and send one batch of due mails.
+
+    :param limit: The batch size, defaults to CIRCULATION_MAIL_BATCH_SIZE.
+    :return: The result of send.
+    """
+    limit = limit or current_app.config['CIRCULATION_MAIL_BATCH_SIZE']
+    mails = claim(limit)
+    if not mails:
+        return {'sent': 0, 'retried': 0, 'failed': 0}
+    return send(mails)
+
+
+def send_all():
+    """Send batches of due mails until none is left.
+
+    :return: The summed results of send.
+    """
+    res = {'sent': 0, 'retried': 0, 'failed': 0}
+    while True:
+        batch = send_pending()
+        if not any(batch.values()):
+            return res
+        for key, value in batch.items():
+            res[key] += value
+
+
+def get_status():
+    """Get the number of mails in the outbox per status."""
+    query = (db.session.query(CirculationMail.status,
+                              func.count(CirculationMail.id))
+             .group_by(CirculationMail.status))
+    return dict(query.all())
+
+
+def purge(before):
+    """Delete the mails sent before the given date.
+
+    :return: The number of deleted mails.
+    """
+    table = CirculationMail.__table__
+    res = db.session.execute(table.delete().where(
+        and_(table.c.status == CirculationMail.STATUS_SENT,
+             table.c.sent_date < before)))
+    db.session.commit()
+    return res.rowcount
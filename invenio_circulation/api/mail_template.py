@@ -19,11 +19,82 @@
 
 """invenio-circulation api responsible for CirculationMailTemplate handling."""
 
+import time
+
 import invenio_circulation.models as models
 
+from flask import current_app
+from invenio_db import db
+from jinja2 import Template
+
 from invenio_circulation.api.event import create as create_event
 from invenio_circulation.api.utils import update as _update
 
+_templates = {}
+
+
+class CompiledMailTemplate(object):
+    """The compiled jinja2 templates of a CirculationMailTemplate."""
+
+    def __init__(self, cmt):
+        """Constructor."""
+        self.id = cmt.id
+        self.template_name = cmt.template_name
+        self.modification_date = cmt.modification_date
+        self.subject = Template(cmt.subject)
+        self.header = Template(cmt.header)
+        self.content = Template(cmt.content)
+
+    def render(self, **kwargs):
+        """Render the template with the given keyword arguments.
+
+        :return: A (subject, body) tuple.
+        """
+        return (self.subject.render(**kwargs),
+                '\n'.join([self.header.render(**kwargs),
+                           self.content.render(**kwargs)]))
+
+
+def _get_version(template_name):
+    CMT = models.CirculationMailTemplate
+    return (db.session.query(CMT.id, CMT.modification_date)
+            .filter(CMT.template_name == template_name)
+            .order_by(CMT.id).first())
+
+
+def get_template(template_name):
+    """Get the CompiledMailTemplate with the given name.
+
+    The compiled templates are cached by name and modification_date. The
+    templates changed in this process are compiled again right away, changes
+    made by other processes are detected after at most
+    CIRCULATION_MAIL_TEMPLATES_REFRESH_INTERVAL seconds.
+
+    :return: The CompiledMailTemplate or None if there is no such template.
+    """
+    now = time.time()
+    config = current_app.config
+    interval = config['CIRCULATION_MAIL_TEMPLATES_REFRESH_INTERVAL']
+    cached = _templates.get(template_name)
+    if cached is not None and now - cached[0] < interval:
+        return cached[1]
+
+    version = _get_version(template_name)
+    compiled = cached[1] if cached is not None else None
+    if version is None:
+        compiled = None
+    elif compiled is None or (compiled.id,
+                              compiled.modification_date) != tuple(version):
+        cmt = models.CirculationMailTemplate.get(version[0])
+        compiled = CompiledMailTemplate(cmt)
+    _templates[template_name] = (now, compiled)
+    return compiled
+
+
+def invalidate():
+    """Drop the cached CompiledMailTemplates of this process."""
+    _templates.clear()
+
 
 def create(template_name, subject, header, content):
     """Create a CirculationLoanMailTemplate object.
@@ -34,6 +105,7 @@ def create(template_name, subject, header, content):
     cmt = models.CirculationMailTemplate.new(
             template_name=template_name, subject=subject, header=header,
             content=content)
+    invalidate()
 
     create_event(mail_template_id=cmt.id,
                  event=models.CirculationMailTemplate.EVENT_CREATE)
@@ -45,6 +117,7 @@ def update(cmt, **kwargs):
     """Update a CirculationLoanMailTemplate object."""
     current_items, changed = _update(cmt, **kwargs)
     if changed:
+        invalidate()
         changes_str = ['{0}: {1} -> {2}'.format(key,
                                                 current_items[key],
                                                 changed[key])
@@ -59,6 +132,7 @@ def delete(cmt):
     create_event(mail_template_id=cmt.id,
                  event=models.CirculationMailTemplate.EVENT_DELETE)
     cmt.delete()
+    invalidate()
 
 
 schema = {}
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation queue of the requests waiting for items on shelf.
+
+Desks working on the requested loan cycles of items on shelf claim the next
+ones from the queue. A claim is a lease, the loan cycles are handed to no
+other desk until it expires or is released.
+
+The candidates are locked with SELECT ... FOR UPDATE SKIP LOCKED, so
+concurrent desks skip each others candidates instead of waiting for them.
+Databases without SKIP LOCKED, like SQLite, serialize the claims of the
+process with a lock instead, the primary key of the claims protects against
+other processes.
+"""
+
+import datetime
+import threading
+
+import invenio_circulation.models as models
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import and_, exists
+from sqlalchemy.exc import IntegrityError
+
+_SKIP_LOCKED_DIALECTS = ('postgresql', 'mysql', 'oracle')
+
+_lock = threading.Lock()
+
+
+def _get_claim_criteria(now):
+    CLC = models.CirculationLoanCycle
+    Claim = models.CirculationRequestClaim
+    claimed = exists().where(and_(Claim.loan_cycle_id == CLC.id,
+                                  Claim.expiry_date > now))
+    return [CLC.current_status == CLC.STATUS_REQUESTED,
+            models.CirculationItem.current_status ==
+            models.CirculationItem.STATUS_ON_SHELF,
+            ~claimed]
+
+
+def _claim_ids(desk, limit, now, lease):
+    CLC = models.CirculationLoanCycle
+    Claim = models.CirculationRequestClaim
+    query = (db.session.query(CLC.id)
+             .join(models.CirculationItem,
+                   CLC.item_id == models.CirculationItem.id)
+             .filter(*_get_claim_criteria(now))
+             .order_by(CLC.issued_date, CLC.id).limit(limit))
+    if db.session.bind.dialect.name in _SKIP_LOCKED_DIALECTS:
+        query = query.with_for_update(skip_locked=True, of=CLC)
+    ids = [x for x, in query]
+    if not ids:
+        db.session.commit()
+        return []
+
+    # Claims committed since the query started are only visible to a new
+    # statement, the locks keep others from claiming the ids meanwhile.
+    # Only expired claims are replaced, a live claim committed after this
+    # check makes the insert fail and the claim is tried again.
+    table = Claim.__table__
+    claimed = set(x for x, in db.session.query(Claim.loan_cycle_id).filter(
+            Claim.loan_cycle_id.in_(ids), Claim.expiry_date > now))
+    ids = [x for x in ids if x not in claimed]
+    if ids:
+        db.session.execute(table.delete().where(and_(
+                table.c.loan_cycle_id.in_(ids), table.c.expiry_date <= now)))
+        db.session.execute(table.insert().values(
+                [{'loan_cycle_id': x, 'desk': desk, 'claim_date': now,
+                  'expiry_date': now + lease} for x in ids]))
+    db.session.commit()
+    return ids
+
+
+def claim(desk, limit=None):
+    """Claim the next requested loan cycles of items on shelf for the desk.
+
+    The requests are handed out by issued_date. Each of them is claimed for
+    CIRCULATION_REQUEST_CLAIM_LEASE seconds, see renew and release.
+
+    :param desk: Name of the claiming desk or worker.
+    :param limit: Maximum number of claimed loan cycles, defaults to
+                  CIRCULATION_REQUEST_CLAIM_SIZE.
+    :return: The claimed CirculationLoanCycles.
+    """
+    config = current_app.config
+    limit = limit or config['CIRCULATION_REQUEST_CLAIM_SIZE']
+    lease = datetime.timedelta(
+            seconds=config['CIRCULATION_REQUEST_CLAIM_LEASE'])
+
+    for _ in range(3):
+        now = datetime.datetime.now()
+        try:
+            if db.session.bind.dialect.name in _SKIP_LOCKED_DIALECTS:
+                ids = _claim_ids(desk, limit, now, lease)
+            else:
+                with _lock:
+                    ids = _claim_ids(desk, limit, now, lease)
+            break
+        except IntegrityError:
+            # Another process claimed some of the ids first
+            db.session.rollback()
+    else:
+        ids = []
+
+    if not ids:
+        return []
+    CLC = models.CirculationLoanCycle
+    return sorted(CLC.find(CLC.id.in_(ids)),
+                  key=lambda x: (x.issued_date, x.id))
+
+
+def _get_claims(desk, clcs=None):
+    Claim = models.CirculationRequestClaim
+    query = Claim.query.filter(Claim.desk == desk)
+    if clcs is not None:
+        query = query.filter(Claim.loan_cycle_id.in_([x.id for x in clcs]))
+    return query
+
+
+def get_claimed(desk):
+    """Get the CirculationLoanCycles currently claimed by the desk."""
+    CLC = models.CirculationLoanCycle
+    Claim = models.CirculationRequestClaim
+    now = datetime.datetime.now()
+    ids = [x.loan_cycle_id for x in
+           _get_claims(desk).filter(Claim.expiry_date > now)]
+    return CLC.find(CLC.id.in_(ids)) if ids else []
+
+
+def fill(desk, limit=None):
+    """Get the loan cycles claimed by the desk, claiming more if needed.
+
+    The loan cycles the desk already claimed are renewed and kept, only the
+    shortfall up to limit is claimed, so repeated calls don't take more
+    requests away from the other desks.
+
+    :param limit: Number of loan cycles the desk works on, at most and
+                  defaulting to CIRCULATION_REQUEST_CLAIM_SIZE.
+    :return: The claimed CirculationLoanCycles, by issued_date.
+    """
+    size = current_app.config['CIRCULATION_REQUEST_CLAIM_SIZE']
+    limit = max(0, min(int(limit or size), size))
+
+    clcs = list(get_claimed(desk))
+    renew(desk, clcs)
+    if len(clcs) < limit:
+        clcs.extend(claim(desk, limit - len(clcs)))
+    return sorted(clcs, key=lambda x: (x.issued_date, x.id))
+
+
+def renew(desk, clcs):
+    """Extend the leases of the given loan cycles claimed by the desk.
+
+    :return: The number of renewed claims, expired claims taken over by
+             another desk are not renewed.
+    """
+    if not clcs:
+        return 0
+    Claim = models.CirculationRequestClaim
+    now = datetime.datetime.now()
+    lease = datetime.timedelta(
+            seconds=current_app.config['CIRCULATION_REQUEST_CLAIM_LEASE'])
+    res = (_get_claims(desk, clcs).filter(Claim.expiry_date > now)
+           .update({Claim.expiry_date: now + lease},
+                   synchronize_session=False))
+    db.session.commit()
+    return res
+
+
+def release(desk, clcs):
+    """Give the given loan cycles claimed by the desk back to the queue.
+
+    :return: The number of released claims.
+    """
+    if not clcs:
+        return 0
+    res = _get_claims(desk, clcs).delete(synchronize_session=False)
+    db.session.commit()
+    return res
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation in-memory matcher for CirculationLoanRuleMatches.
+
+Every field of a CirculationLoanRuleMatch (item_type, patron_type and
+location_code) is either a plain value, matching only the same value, or
+contains '*' wildcards. A wildcard pattern matches every value starting with
+the pattern stripped of its wildcards and is scored by how much of the value
+this prefix covers, 0.1 for a bare '*'.
+
+The applicable match is the one with the best item_type score, then the best
+patron_type score, then the best location_code score; ties go to the match
+created first.
+
+The matches are compiled into a prefix trie per field, so resolving a rule
+only walks the characters of the three values.
+"""
+
+import time
+import timeit
+
+from flask import current_app
+from invenio_db import db
+from sqlalchemy import func
+from sqlalchemy import event as sa_event
+
+from invenio_circulation.models import (CirculationItem, CirculationLocation,
+                                        CirculationLoanRule,
+                                        CirculationLoanRuleMatch,
+                                        CirculationUser)
+
+_WILDCARD = '*'
+_POSITIONS = ''
+
+_RULES_KEY = 'circulation_loan_rules'
+
+_state = {'matcher': None, 'version': None, 'checked': 0}
+
+
+def _score(length, depth):
+    """Score a wildcard pattern with depth literal characters.
+
+    Equals difflib.SequenceMatcher(None, value, prefix).ratio() for a value
+    of the given length starting with the prefix.
+    """
+    total = length + depth
+    ratio = 2.0 * depth / total if total else 1.0
+    return ratio if ratio > 0 else 0.1
+
+
+class PatternIndex(object):
+    """Index of the patterns of one CirculationLoanRuleMatch field."""
+
+    def __init__(self):
+        """Constructor."""
+        self.exact = {}
+        self.trie = {}
+
+    def add(self, pattern, position):
+        """Add the pattern of the match at the given position."""
+        if pattern is None:
+            return
+        if _WILDCARD not in pattern:
+            self.exact.setdefault(pattern, []).append(position)
+            return
+
+        node = self.trie
+        for char in pattern.replace(_WILDCARD, ''):
+            node = node.setdefault(char, {})
+        node.setdefault(_POSITIONS, []).append(position)
+
+    def match(self, value):
+        """Get the positions of the patterns matching the value.
+
+        :return: A dictionary mapping the positions to their scores.
+        """
+        res = dict((x, 1) for x in self.exact.get(value, ()))
+        if value is None:
+            return res
+
+        length = len(value)
+        node = self.trie
+        depth = 0
+        while node is not None:
+            positions = node.get(_POSITIONS)
+            if positions:
+                score = _score(length, depth)
+                for position in positions:
+                    res[position] = score
+            if depth == length:
+                break
+            node = node.get(value[depth])
+            depth += 1
+        return res
+
+
+class LoanRuleMatcher(object):
+    """CirculationLoanRuleMatches compiled for fast lookups."""
+
+    def __init__(self, matches):
+        """Constructor.
+
+        :param matches: CirculationLoanRuleMatches in the order of their
+                        precedence on equal scores.
+        """
+        self.loan_rule_ids = []
+        self.match_ids = []
+        self.resolved = {}
+        self.item_types = PatternIndex()
+        self.patron_types = PatternIndex()
+        self.location_codes = PatternIndex()
+
+        for position, match in enumerate(matches):
+            self.loan_rule_ids.append(match.loan_rule_id)
+            self.match_ids.append(getattr(match, 'id', None))
+            self.item_types.add(match.item_type, position)
+            self.patron_types.add(match.patron_type, position)
+            self.location_codes.add(match.location_code, position)
+
+    def _iter_candidates(self, item_type, patron_type, location_code):
+        item_types = self.item_types.match(item_type)
+        if not item_types:
+            return
+        patron_types = self.patron_types.match(patron_type)
+        location_codes = self.location_codes.match(location_code)
+
+        for pos, score in item_types.items():
+            if pos in patron_types and pos in location_codes:
+                yield (1 - score, 1 - patron_types[pos],
+                       1 - location_codes[pos], pos)
+
+    def get_candidates(self, item_type, patron_type, location_code):
+        """Get the matches applying to the given values.
+
+        :return: A sorted list of (item_type_key, patron_type_key,
+                 location_code_key, position) tuples, the keys being one minus
+                 the score of the field. The first entry is the applicable
+                 match.
+        """
+        return sorted(self._iter_candidates(item_type, patron_type,
+                                            location_code))
+
+    def match(self, item_type, patron_type, location_code):
+        """Get the id of the CirculationLoanRule applying to the values.
+
+        :return: The CirculationLoanRule id or None if no match applies.
+        """
+        key = (item_type, patron_type, location_code)
+        try:
+            return self.resolved[key]
+        except KeyError:
+            pass
+
+        candidates = list(self._iter_candidates(*key))
+        res = self.loan_rule_ids[min(candidates)[3]] if candidates else None
+        self.resolved[key] = res
+        return res
+
+    def explain(self, item_type, patron_type, location_code):
+        """Explain which match applies to the given values.
+
+        :return: A list of dictionaries describing the applying matches and
+                 the scores of their fields, the applicable match first.
+        """
+        item_types = self.item_types.match(item_type)
+        patron_types = self.patron_types.match(patron_type)
+        location_codes = self.location_codes.match(location_code)
+
+        candidates = self.get_candidates(item_type, patron_type,
+                                         location_code)
+        return [{'loan_rule_match_id': self.match_ids[pos],
+                 'loan_rule_id': self.loan_rule_ids[pos],
+                 'item_type': item_types[pos],
+                 'patron_type': patron_types[pos],
+                 'location_code': location_codes[pos],
+                 'applied': i == 0}
+                for i, (_, _, _, pos) in enumerate(candidates)]
+
+
+class _MatchData(object):
+
+    def __init__(self, data):
+        self.id = None
+        self.__dict__.update(data)
+
+
+def _get_version():
+    res = ()
+    for clazz in (CirculationLoanRuleMatch, CirculationLoanRule):
+        query = db.session.query(func.count(clazz.id),
+                                 func.max(clazz.modification_date))
+        res += tuple(query.one())
+    return res
+
+
+def compile_matcher(matches=None):
+    """Compile CirculationLoanRuleMatches.
+
+    :param matches: Dictionaries with the fields of the matches to compile
+                    instead of the stored CirculationLoanRuleMatches, for
+                    example to validate a rule migration upfront.
+    """
+    if matches is not None:
+        return LoanRuleMatcher(_MatchData(x) for x in matches)
+
+    query = CirculationLoanRuleMatch.query.order_by(
+            CirculationLoanRuleMatch.id)
+    return LoanRuleMatcher(query.all())
+
+
+def get_matcher():
+    """Get the compiled LoanRuleMatcher of this process.
+
+    The matcher is compiled again after the CirculationLoanRules or their
+    matches were changed in this process. Changes made by other processes are
+    detected after at most CIRCULATION_LOAN_RULES_REFRESH_INTERVAL seconds.
+    """
+    now = time.time()
+    interval = current_app.config['CIRCULATION_LOAN_RULES_REFRESH_INTERVAL']
+    if _state['matcher'] is not None and now - _state['checked'] < interval:
+        return _state['matcher']
+
+    version = _get_version()
+    if _state['matcher'] is None or version != _state['version']:
+        _state['matcher'] = compile_matcher()
+        _state['version'] = version
+    _state['checked'] = now
+    return _state['matcher']
+
+
+def resolve(item_type, patron_type, location_code):
+    """Get the CirculationLoanRule applying to the given values.
+
+    The rules are memoized per (item_type, patron_type, location_code) in the
+    current session, as long as the compiled matcher stays the same.
+
+    :raise: Exception if no CirculationLoanRuleMatch applies.
+    """
+    matcher = get_matcher()
+    info = db.session().info
+    cached = info.get(_RULES_KEY)
+    if cached is None or cached[0] is not matcher:
+        cached = info[_RULES_KEY] = (matcher, {})
+
+    key = (item_type, patron_type, location_code)
+    try:
+        return cached[1][key]
+    except KeyError:
+        pass
+
+    loan_rule_id = matcher.match(*key)
+    if loan_rule_id is None:
+        msg = 'There is no loan rule for {0}, {1} and {2}.'
+        raise Exception(msg.format(*key))
+
+    rule = cached[1][key] = CirculationLoanRule.get(loan_rule_id)
+    return rule
+
+
+def get_combinations():
+    """Get the combinations of user and item groups and locations in use.
+
+    :return: A list of (patron_type, item_type, location_code, item_count)
+             tuples, combining every user group with every pair of item group
+             and location code of the stored items.
+    """
+    user_groups = sorted(x for x, in db.session.query(
+            CirculationUser.user_group).distinct())
+    query = (db.session.query(CirculationItem.item_group,
+                              CirculationLocation.code,
+                              func.count(CirculationItem.id))
+             .outerjoin(CirculationLocation,
+                        CirculationItem.location_id == CirculationLocation.id)
+             .group_by(CirculationItem.item_group, CirculationLocation.code)
+             .order_by(CirculationItem.item_group, CirculationLocation.code))
+    item_groups = query.all()
+
+    return [(user_group, item_group, location_code, count)
+            for user_group in user_groups
+            for item_group, location_code, count in item_groups]
+
+
+def evaluate(matches=None):
+    """Resolve the loan rule of every combination in use.
+
+    :param matches: Dictionaries with the fields of the matches to evaluate,
+                    see compile_matcher.
+    :return: A dictionary containing the 'results', a list of (patron_type,
+             item_type, location_code, item_count, loan_rule_id) tuples,
+             their 'count', the number of covered 'items', the 'duration' of
+             the resolution in seconds and the resolutions per second as
+             'throughput'.
+    """
+    combinations = get_combinations()
+    matcher = compile_matcher(matches)
+
+    start = timeit.default_timer()
+    results = [combination + (matcher.match(combination[1], combination[0],
+                                            combination[2]),)
+               for combination in combinations]
+    duration = timeit.default_timer() - start
+
+    return {'results': results,
+            'count': len(results),
+            'items': sum(x[3] for x in combinations),
+            'duration': duration,
+            'throughput': len(results) / duration if duration else None}
+
+
+def compare(baseline, results):
+    """Get the combinations resolved to different loan rules.
+
+    :param baseline: The results of a previous evaluate call.
+    :param results: The results of the current evaluate call.
+    :return: A list of (patron_type, item_type, location_code, item_count,
+             baseline_loan_rule_id, loan_rule_id) tuples.
+    """
+    previous = dict((tuple(x[:3]), x[4]) for x in baseline['results'])
+    res = []
+    for result in results['results']:
+        loan_rule_id = previous.get(tuple(result[:3]))
+        if loan_rule_id != result[4]:
+            res.append(tuple(result[:4]) + (loan_rule_id, result[4]))
+    return res
+
+
+def invalidate():
+    """Drop the compiled LoanRuleMatcher of this process."""
+    _state['matcher'] = None
+
+
+@sa_event.listens_for(CirculationLoanRuleMatch, 'after_insert')
+@sa_event.listens_for(CirculationLoanRuleMatch, 'after_update')
+@sa_event.listens_for(CirculationLoanRuleMatch, 'after_delete')
+@sa_event.listens_for(CirculationLoanRule, 'after_update')
+@sa_event.listens_for(CirculationLoanRule, 'after_delete')
+def _invalidate_matcher(mapper, connection, target):
+    invalidate()
@@ -21,9 +21,10 @@
 
 import invenio_circulation.models as models
 
-from flask import current_app
-from flask_mail import Message
 from invenio_circulation.api.event import create as create_event
+from invenio_circulation.api.event import batch as event_batch
+from invenio_circulation.api.mail import dispatch as dispatch_mails
+from invenio_circulation.api.mail import store_all as store_mails
 from invenio_circulation.api.utils import update as _update
 
 
@@ -65,22 +66,20 @@ def delete(cu):
 
 
 def send_message(users, subject, message):
-    """Send a message with the provided subject to the given users."""
+    """Queue a message with the provided subject to the given users."""
     sender = 'john.doe@cern.ch'
 
-    for user in users:
-        msg = Message(sender=sender, recipients=[user.email],
-                      subject=subject, body=message)
-
-        # TODO: socket exception ~.~
-        try:
-            current_app.extensions['mail'].send(msg)
-        except Exception:
-            print msg
-
-        create_event(user_id=user.id,
-                     event=models.CirculationUser.EVENT_MESSAGED,
-                     description='\n'.join([subject, message]))
+    # The mails are committed together with the events
+    with event_batch():
+        count = store_mails([(sender, user.email, subject, message)
+                             for user in users])
+        for user in users:
+            create_event(user_id=user.id,
+                         event=models.CirculationUser.EVENT_MESSAGED,
+                         description='\n'.join([subject, message]))
+
+    if count:
+        dispatch_mails()
 
 
 schema = {}
@@ -19,19 +19,17 @@
 
 """invenio-circulation api utilities."""
 
+import bisect
 import datetime
 import functools
+import inspect
 
-from jinja2 import Template
-from itertools import starmap
-from difflib import SequenceMatcher
+from itertools import islice, starmap
 from flask import current_app
-from flask_mail import Message
+from invenio_db import db
+from sqlalchemy.orm.exc import StaleDataError
 
-from invenio_circulation.models import (CirculationLoanCycle,
-                                        CirculationMailTemplate,
-                                        CirculationLoanRule,
-                                        CirculationLoanRuleMatch)
+from invenio_circulation.api.mail import queue as queue_mail
 
 
 def check_field_in(field_name, values, message):
@@ -84,69 +82,37 @@ def try_functions(*funcs):
     return wrapper
 
 
-def _get_requested_dates(lcs):
-    return [(lc.start_date, lc.end_date) for lc in lcs]
+def _get_context(context):
+    from invenio_circulation.api.context import ValidationContext
 
+    return context if context is not None else ValidationContext()
 
-def _get_affected_loan_cycles(statuses, items):
-    def filter_func(x):
-        return x.current_status not in statuses
-    # clc_list = [CirculationLoanCycle.search(item=item.id) for item in items]
-    clc_list = [CirculationLoanCycle.search('item_id:{0}'.format(item.id))
-                for item in items]
-    clc_list = [item for sub_list in clc_list for item in sub_list]
-    return filter(filter_func, clc_list)
 
+def _check_loan_period(user, items, start_date, end_date, context=None):
+    from invenio_circulation.api.availability import get_joint_availability
 
-def _check_loan_period(user, items, start_date, end_date):
-    lcs = _get_affected_loan_cycles(['finished', 'canceled'], items)
-    requested_dates = _get_requested_dates(lcs)
-    _start, _end = DateManager.get_contained_date(start_date, end_date,
-                                                  requested_dates)
-    available_start_date = _start
-    desired_start_date = start_date
+    availability = _get_context(context).get_availability(
+            items, start_date, end_date)
+    get_joint_availability(items, start_date, end_date,
+                           availability).validate()
 
-    available_end_date = _end
-    desired_end_date = end_date
 
-    avd_start_date = available_start_date != desired_start_date
-    avd_end_date = available_end_date != desired_end_date
-    if avd_start_date or avd_end_date:
-        suggested_dates = DateManager.get_date_suggestions(requested_dates)
-        contained_dates = (_start, _end)
-        raise DateException(suggested_dates=suggested_dates,
-                            contained_dates=contained_dates)
+def _check_loan_period_extension(clcs, requested_end_date, context=None):
+    from invenio_circulation.api.availability import get_joint_availability
 
-
-def _check_loan_period_extension(clcs, requested_end_date):
-    _ids = [clc.id for clc in clcs]
     items = [clc.item for clc in clcs]
     start_date = datetime.date.today()
     end_date = requested_end_date
 
-    lcs = _get_affected_loan_cycles(['finished', 'canceled'], items)
-    lcs = filter(lambda x: x.id not in _ids, lcs)
-    requested_dates = _get_requested_dates(lcs)
-    _start, _end = DateManager.get_contained_date(start_date, end_date,
-                                                  requested_dates)
-    available_start_date = _start
-    desired_start_date = start_date
-
-    available_end_date = _end
-    desired_end_date = end_date
-
-    avd_start_date = available_start_date != desired_start_date
-    avd_end_date = available_end_date != desired_end_date
-    if avd_start_date or avd_end_date:
-        suggested_dates = DateManager.get_date_suggestions(requested_dates)
-        contained_dates = (_start, _end)
-        raise DateException(suggested_dates=suggested_dates,
-                            contained_dates=contained_dates)
+    availability = _get_context(context).get_availability(
+            items, start_date, end_date, exclude=clcs)
+    get_joint_availability(items, start_date, end_date, availability,
+                           exclude=clcs).validate()
 
 
-def _check_loan_duration(user, items, start_date, end_date):
+def _check_loan_duration(user, items, start_date, end_date, context=None):
     desired_loan_period = end_date - start_date
-    allowed_loan_period = get_loan_period(user, items)
+    allowed_loan_period = _get_context(context).get_loan_period(user, items)
     if desired_loan_period.days > allowed_loan_period:
         msg = ('The desired loan period ({0} days) exceeds '
                'the allowed period of {1} days.')
@@ -181,74 +147,42 @@ def update(obj, **kwargs):
 
 
 def email_notification(template_name, sender, receiver, **kwargs):
-    """Send an email.
+    """Queue an email, see api.mail.queue.
 
     :param template_name: The name of the MailTemplate to use.
     :param kwargs: The keyword arguments to use in the fetched template.
     """
-    try:
-        query = 'template_name:{0}'.format(template_name)
-        cmt = CirculationMailTemplate.search(query)[0]
-    except IndexError:
-        return
-
-    subject = Template(cmt.subject).render(**kwargs)
-    header = Template(cmt.header).render(**kwargs)
-    content = Template(cmt.content).render(**kwargs)
-
-    body = '\n'.join([header, content])
-
-    msg = Message(sender=sender, recipients=[receiver],
-                  subject=subject, body=body)
-
-    # TODO: socket exception ~.~
-    try:
-        current_app.extensions['mail'].send(msg)
-    except Exception:
-        print msg
-
+    from invenio_circulation.api.mail_template import get_template
 
-def _compare_query(library_code, item_type, user_group, rule):
-    def _compare(val, rule_val):
-        if '*' in rule_val:
-            tmp = rule_val.replace('*', '')
-            if val.startswith(tmp):
-                res = SequenceMatcher(None, val, tmp).ratio()
-                return res if res > 0 else 0.1  # This addresses '*'
-        else:
-            if rule_val == val:
-                return 1
-        return 0
-
-    library_val = _compare(library_code, rule.location_code)
-    item_val = _compare(item_type, rule.item_type)
-    user_val = _compare(user_group, rule.patron_type)
+    template = get_template(template_name)
+    if template is None:
+        return
 
-    return (item_val, user_val, library_val, rule.loan_rule_id)
+    subject, body = template.render(**kwargs)
+    queue_mail(sender, receiver, subject, body)
 
 
 def get_loan_rule(user, item):
-    """Get the loan rule responsible for the given user and item."""
-    user_group = user.user_group
-    item_type = item.item_group
-    library_code = item.location.code
+    """Get the loan rule responsible for the given user and item.
+
+    :raise: Exception if no CirculationLoanRuleMatch applies.
+    """
+    from invenio_circulation.api.rule_matcher import resolve
 
-    # Direct query
-    query = 'user_group:{0} item_group:{1} location_code:{2}'
-    query = query.format(user_group, item_type, library_code)
+    return resolve(item.item_group, user.user_group, item.location.code)
 
-    rules = CirculationLoanRuleMatch.search(query)
 
-    if not rules:
-        comp = functools.partial(_compare_query,
-                                 library_code, item_type, user_group)
-        rules = sorted([comp(x) for x in CirculationLoanRuleMatch.get_all()],
-                       key=lambda x: (1-x[0], 1-x[1], 1-x[2]))
-        rules = filter(lambda x: x[0] != 0 and x[1] != 0 and x[2] != 0, rules)
+def explain_loan_rule(user, item):
+    """Explain which CirculationLoanRuleMatch applies to the user and item.
 
-    rule = rules[0]
+    :return: A list of dictionaries with the ids of the applying matches,
+             their loan rules and the scores of the item_type, patron_type
+             and location_code fields, the applied match first.
+    """
+    from invenio_circulation.api.rule_matcher import get_matcher
 
-    return CirculationLoanRule.get(rule[3])
+    return get_matcher().explain(item.item_group, user.user_group,
+                                 item.location.code)
 
 
 def is_renewable(user, items):
@@ -307,6 +241,208 @@ class ValidationExceptions(Exception):
                           for x, y in self.exceptions])
 
 
+class ConflictException(Exception):
+    """Exception raised if an action kept conflicting with concurrent ones."""
+
+
+def retry_on_conflict(func):
+    """Run the decorated action again if its objects were changed meanwhile.
+
+    CirculationItems and CirculationLoanCycles carry a version, an update
+    of an object changed by someone else since it was loaded fails. The
+    transaction is rolled back, which reloads the objects, and the action
+    runs again including its validation, at most CIRCULATION_CONFLICT_RETRIES
+    times. A ValidationContext passed as argument, by position or keyword, is
+    dropped for the retries, as its data is outdated.
+
+    :raise: ConflictException if all the retries conflicted.
+    """
+    arg_names = inspect.getargspec(func).args
+    context_pos = (arg_names.index('context')
+                   if 'context' in arg_names else None)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        retries = current_app.config['CIRCULATION_CONFLICT_RETRIES']
+        for _ in range(retries + 1):
+            try:
+                return func(*args, **kwargs)
+            except StaleDataError:
+                db.session.rollback()
+                if context_pos is not None and len(args) > context_pos:
+                    args = (args[:context_pos] + (None,) +
+                            args[context_pos + 1:])
+                elif 'context' in kwargs:
+                    kwargs['context'] = None
+        msg = ('The objects were changed concurrently {0} times, the action '
+               'was aborted.')
+        raise ConflictException(msg.format(retries + 1))
+    return wrapper
+
+
+class Occupancy(object):
+    """Sorted list of merged busy periods, used to answer date queries.
+
+    The periods are stored as inclusive (start_day, end_day) pairs, counted in
+    days since DateManager._start. Overlapping or adjacent periods are merged,
+    so every day after the end of a period is free.
+    Lookups are done with a binary search, the queries returning periods only
+    visit the periods they return.
+    """
+
+    def __init__(self, periods):
+        """Constructor.
+
+        :param periods: Iterable of (start_day, end_day) pairs.
+        """
+        self.starts = []
+        self.ends = []
+        for start, end in sorted(periods):
+            if self.ends and start <= self.ends[-1] + 1:
+                self.ends[-1] = max(self.ends[-1], end)
+            else:
+                self.starts.append(start)
+                self.ends.append(end)
+
+    def __len__(self):
+        """Number of merged busy periods."""
+        return len(self.starts)
+
+    def _index(self, day):
+        """Index of the last period starting on or before the given day."""
+        return bisect.bisect_right(self.starts, day) - 1
+
+    def is_free(self, day):
+        """Check if the given day is free."""
+        i = self._index(day)
+        return i < 0 or self.ends[i] < day
+
+    def get_first_free_day(self, day):
+        """Get the first free day on or after the given day."""
+        i = self._index(day)
+        if i < 0 or self.ends[i] < day:
+            return day
+        return self.ends[i] + 1
+
+    def get_next_busy_day(self, day):
+        """Get the first busy day after the given day or None."""
+        i = bisect.bisect_right(self.starts, day)
+        return self.starts[i] if i < len(self.starts) else None
+
+    def iter_free_periods(self, start, end=None):
+        """Iterate over the free periods between start and end (inclusive).
+
+        The last period is open ended (end_day is None) if end is None.
+        """
+        day = self.get_first_free_day(start)
+        i = bisect.bisect_right(self.starts, day)
+        while end is None or day <= end:
+            if i == len(self.starts):
+                yield day, end
+                return
+            yield day, (self.starts[i] - 1 if end is None
+                        else min(self.starts[i] - 1, end))
+            day = self.ends[i] + 1
+            i += 1
+
+    def get_largest_free_period(self, start, end):
+        """Get the longest free period between start and end (inclusive)."""
+        res = None
+        for period in self.iter_free_periods(start, end):
+            if res is None or period[1] - period[0] > res[1] - res[0]:
+                res = period
+        return res
+
+
+class MutableOccupancy(object):
+    """Busy periods which can be added and removed one by one.
+
+    Unlike in Occupancy, the periods aren't merged, so each of them can be
+    removed again. The running maximum of the end days is kept next to the
+    periods sorted by start day, which keeps the lookups a binary search.
+    Adding or removing a period only updates the maxima after it.
+    """
+
+    def __init__(self, periods=()):
+        """Constructor.
+
+        :param periods: Iterable of (start_day, end_day) pairs.
+        """
+        self.periods = sorted(periods)
+        self.max_ends = []
+        self._update(0)
+
+    def __len__(self):
+        """Number of busy periods."""
+        return len(self.periods)
+
+    def _update(self, i):
+        del self.max_ends[i:]
+        for start, end in self.periods[i:]:
+            self.max_ends.append(max(self.max_ends[-1], end)
+                                 if self.max_ends else end)
+
+    def _index(self, day):
+        """Index of the last period starting on or before the given day."""
+        return bisect.bisect_right(self.periods, (day, float('inf'))) - 1
+
+    def add(self, start, end):
+        """Add the busy period (start_day, end_day)."""
+        i = bisect.bisect_left(self.periods, (start, end))
+        self.periods.insert(i, (start, end))
+        self._update(i)
+
+    def remove(self, start, end):
+        """Remove the busy period (start_day, end_day) added before."""
+        i = bisect.bisect_left(self.periods, (start, end))
+        if i == len(self.periods) or self.periods[i] != (start, end):
+            raise ValueError('({0}, {1}) is not a busy period.'.format(
+                start, end))
+        del self.periods[i]
+        self._update(i)
+
+    def get_first_free_day(self, day):
+        """Get the first free day on or after the given day."""
+        while True:
+            i = self._index(day)
+            if i < 0 or self.max_ends[i] < day:
+                return day
+            day = self.max_ends[i] + 1
+
+    def get_next_busy_day(self, day):
+        """Get the first busy day after the given day or None."""
+        i = self._index(day) + 1
+        return self.periods[i][0] if i < len(self.periods) else None
+
+
+class OccupancyUnion(object):
+    """Several Occupancies queried as one, without merging them."""
+
+    def __init__(self, occupancies):
+        """Constructor.
+
+        :param occupancies: List of Occupancy.
+        """
+        self.occupancies = occupancies
+
+    def get_first_free_day(self, day):
+        """Get the first day on or after the given day free in all of them."""
+        while True:
+            free_day = day
+            for occupancy in self.occupancies:
+                free_day = occupancy.get_first_free_day(free_day)
+            if free_day == day:
+                return day
+            day = free_day
+
+    def get_next_busy_day(self, day):
+        """Get the first day after the given day busy in any of them."""
+        days = [occupancy.get_next_busy_day(day)
+                for occupancy in self.occupancies]
+        days = [x for x in days if x is not None]
+        return min(days) if days else None
+
+
 class DateManager(object):
     """Utility class to calculate date confilcts."""
 
@@ -327,100 +463,123 @@ class DateManager(object):
             return cls._start + datetime.timedelta(days=start_days)
 
     @classmethod
-    def _build_timeline(cls, requested_period, periods):
-        periods = sorted(periods, key=lambda x: x[0])
-        periods = list(starmap(cls._convert_to_days, periods))
-        requested_period = cls._convert_to_days(*requested_period)
-        periods_and_requested = periods + [requested_period]
-        period_min = min(periods_and_requested, key=lambda x: x[0])[0]
-        period_max = max(periods_and_requested, key=lambda x: x[1])[1]
-
-        time_line = []
-        for x in range(period_min, period_max):
-            for start, end in periods:
-                if start <= x <= end:
-                    time_line.append(1)
-                    break
-            else:
-                time_line.append(0)
+    def _convert_day(cls, day):
+        if day is None:
+            return None
+        return cls._start + datetime.timedelta(days=day)
 
-        return period_min, time_line
+    @classmethod
+    def get_occupancy(cls, periods):
+        """Build the Occupancy for the given list of (start, end) dates."""
+        return Occupancy(starmap(cls._convert_to_days, periods))
 
     @classmethod
     def get_contained_date(cls, requested_start, requested_end, periods):
         """Get the dates contained in requested_start and requested_end.
 
+        The first free period starting in [requested_start, requested_end) is
+        returned, the given end date itself is never checked.
+
         :param requested_start: The requested start date.
         :param requested_end: The requested end date.
-        :param periods: The dates to be checked for conflicts.
+        :param periods: The dates to be checked for conflicts, either a list
+                        of (start, end) dates, an Occupancy or an
+                        OccupancyUnion.
 
         :return: Conflict free values for requested_start, requested_date.
         :raise: DateException with possible alternatives.
         """
-        try:
-            timeline_start, timeline = cls._build_timeline((requested_start,
-                                                            requested_end),
-                                                           periods)
-        except ValueError:
-            return requested_start, requested_end
+        if not isinstance(periods, (Occupancy, OccupancyUnion)):
+            periods = cls.get_occupancy(periods)
 
         req_start_day, req_end_day = cls._convert_to_days(requested_start,
                                                           requested_end)
 
-        start_in_timeline = req_start_day - timeline_start
-        end_in_timeline = req_end_day - timeline_start
-
-        start, end = None, None
-
-        for i, day in enumerate(timeline[start_in_timeline:end_in_timeline]):
-            if day == 0:
-                if start is None:
-                    start = start_in_timeline+i
-            elif day == 1:
-                if start is not None and end is None:
-                    end = start_in_timeline+i-1
-
-        if start is None and end is None:
+        start = periods.get_first_free_day(req_start_day)
+        if start >= req_end_day:
             raise DateException(None, None)
-        elif start is not None and end is None:
-            return cls._convert_to_datetime(timeline_start+start, req_end_day)
-        else:
-            return cls._convert_to_datetime(timeline_start+start,
-                                            timeline_start+end)
+
+        busy = periods.get_next_busy_day(start)
+        if busy is None or busy >= req_end_day:
+            return cls._convert_to_datetime(start, req_end_day)
+        return cls._convert_to_datetime(start, busy - 1)
 
     @classmethod
     def get_date_suggestions(cls, periods):
         """Get available free periods in a list of periods.
 
+        The periods are looked for between the earliest given date (or today)
+        and the latest one. If the last of those days are free, they are
+        returned as (start, latest date), otherwise the day after the latest
+        date is added.
+
         :return: A list of available periods.
         """
         if not periods:
             return [datetime.date.today()]
-        today = datetime.date.today()
-        try:
-            timeline_start, timeline = cls._build_timeline((today, today),
-                                                           periods)
-        except ValueError:
-            return []
-
-        res = []
-        start, end = None, None
 
-        for i, day in enumerate(timeline):
-            if day == 0:
-                if start is None:
-                    start = i
-            elif day == 1:
-                if start is not None and end is None:
-                    end = i-1
+        today = (datetime.date.today() - cls._start).days
+        periods = list(starmap(cls._convert_to_days, periods))
+        first = min(min(start for start, _ in periods), today)
+        last = max(max(end for _, end in periods), today)
 
-            if start is not None and end is not None:
-                res.append((timeline_start+start, timeline_start+end))
-                start, end = None, None
+        occupancy = Occupancy(periods)
+        res = list(occupancy.iter_free_periods(first, last - 1))
 
-        if start is None and end is None:
-            res.append((timeline_start+len(timeline)+1, None))
-        elif start is not None:
-            res.append((timeline_start+start, timeline_start+len(timeline)))
+        if res and res[-1][1] == last - 1:
+            res[-1] = (res[-1][0], last)
+        else:
+            res.append((last + 1, None))
 
         return list(starmap(cls._convert_to_datetime, res))
+
+    @classmethod
+    def get_largest_free_period(cls, start_date, end_date, periods):
+        """Get the longest free period between start_date and end_date.
+
+        :param periods: A list of (start, end) dates or an Occupancy.
+        :return: (start, end) dates or None if there is no free day.
+        """
+        if not isinstance(periods, Occupancy):
+            periods = cls.get_occupancy(periods)
+
+        start, end = cls._convert_to_days(start_date, end_date)
+        res = periods.get_largest_free_period(start, end)
+        if res is None:
+            return None
+        return cls._convert_day(res[0]), cls._convert_day(res[1])
+
+    @classmethod
+    def get_earliest_free_date(cls, start_date, days, periods):
+        """Get the first date on or after start_date followed by free days.
+
+        :param days: The number of consecutive free days required.
+        :param periods: A list of (start, end) dates or an Occupancy.
+        :return: The first date of the free days.
+        """
+        if not isinstance(periods, Occupancy):
+            periods = cls.get_occupancy(periods)
+
+        start = (start_date - cls._start).days
+        for period_start, period_end in periods.iter_free_periods(start):
+            if period_end is None or period_end - period_start + 1 >= days:
+                return cls._convert_day(period_start)
+
+    @classmethod
+    def get_free_periods(cls, start_date, count, periods):
+        """Get the next free periods starting on or after start_date.
+
+        :param count: The maximal number of periods to return.
+        :param periods: A list of (start, end) dates or an Occupancy.
+        :return: A list of (start, end) dates, the end of the last one is
+                 None if it is open ended.
+        """
+        if not isinstance(periods, Occupancy):
+            periods = cls.get_occupancy(periods)
+
+        start = (start_date - cls._start).days
+        res = []
+        for period in islice(periods.iter_free_periods(start), count):
+            res.append((cls._convert_day(period[0]),
+                        cls._convert_day(period[1])))
+        return res
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2015, 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation api to reschedule the waitlist of an item."""
+
+import heapq
+from contextlib import contextmanager
+
+import invenio_circulation.models as models
+
+from flask import current_app
+from invenio_db import db
+
+from invenio_circulation.api.availability import get_loan_cycle_ids
+from invenio_circulation.api.event import create as create_event
+from invenio_circulation.api.utils import (DateException, DateManager,
+                                           MutableOccupancy, OccupancyUnion,
+                                           retry_on_conflict)
+
+_PENDING_KEY = 'circulation_waitlist_pending'
+
+
+def _get_involved_clcs(handled_clc, other_clcs):
+    res = []
+    statuses = [models.CirculationLoanCycle.STATUS_FINISHED,
+                models.CirculationLoanCycle.STATUS_CANCELED]
+    for clc in other_clcs:
+        _issued_date = clc.issued_date >= handled_clc.issued_date
+        _status = clc.current_status not in statuses
+        _id = clc.id != handled_clc.id
+        if _issued_date and _status and _id:
+            res.append(clc)
+    return res
+
+
+def _get_affected_clcs(handled_clc, involved_clcs):
+    start_date = handled_clc.start_date
+    end_date = handled_clc.end_date
+    involved_clcs = sorted(involved_clcs, key=lambda x: x.issued_date)
+    res = []
+    for clc in involved_clcs:
+        if start_date <= clc.desired_start_date <= end_date:
+            # present:      |-----|
+            # requested:        ???|---|
+            # requested:     ?????
+            # start_date affected
+            res.append(clc)
+        elif start_date <= clc.desired_end_date <= end_date:
+            # present:      |-----|
+            # requested: |-|????
+            # end_date affected
+            res.append(clc)
+        elif (clc.desired_start_date <= start_date <= clc.desired_end_date and
+              clc.desired_start_date <= end_date <= clc.desired_end_date):
+            # present:          |-----|
+            # requested:    |--|???????????
+            # requested:    ???????????|--|
+            res.append(clc)
+    return res
+
+
+def _is_shortened(clc):
+    return (clc.start_date != clc.desired_start_date or
+            clc.end_date != clc.desired_end_date)
+
+
+class WaitlistScheduler(object):
+    """Reschedule the loan cycles waiting behind a finished loan cycle.
+
+    The loan cycles issued after the handled one, whose desired dates
+    overlap with it and which didn't get their desired dates, are processed
+    in a priority queue ordered by issued_date. Each of them is extended
+    towards its desired dates as far as the other loan cycles allow.
+    The loan cycles which can't move only contribute a static Occupancy,
+    built once. The periods of the moving ones are kept in a
+    MutableOccupancy, where only the period of the processed loan cycle is
+    replaced.
+    """
+
+    def __init__(self, handled_clc, clcs):
+        """Constructor.
+
+        :param handled_clc: The finished or canceled CirculationLoanCycle.
+        :param clcs: The active CirculationLoanCycles of the same item.
+        """
+        involved_clcs = _get_involved_clcs(handled_clc, clcs)
+        affected_clcs = [clc for clc
+                         in _get_affected_clcs(handled_clc, involved_clcs)
+                         if _is_shortened(clc)]
+        affected_ids = set(clc.id for clc in affected_clcs)
+
+        static = DateManager.get_occupancy(
+                (clc.start_date, clc.end_date) for clc in involved_clcs
+                if clc.id not in affected_ids)
+        self.dates = dict((clc.id, (clc.start_date, clc.end_date))
+                          for clc in affected_clcs)
+        self.movable = MutableOccupancy(
+                DateManager._convert_to_days(*dates)
+                for dates in self.dates.values())
+        self.occupancy = OccupancyUnion([static, self.movable])
+        self.queue = [(clc.issued_date, clc.id, clc) for clc in affected_clcs]
+        heapq.heapify(self.queue)
+
+    def _reschedule(self, clc):
+        """Get the new dates of the loan cycle, given all the others."""
+        start_date, end_date = self.dates[clc.id]
+        period = DateManager._convert_to_days(start_date, end_date)
+        self.movable.remove(*period)
+        try:
+            _start, _end = DateManager.get_contained_date(
+                    clc.desired_start_date, clc.desired_end_date,
+                    self.occupancy)
+            new_dates = (min(start_date, _start), max(end_date, _end))
+        except DateException:
+            new_dates = (start_date, end_date)
+        self.movable.add(*DateManager._convert_to_days(*new_dates))
+        return new_dates
+
+    def schedule(self):
+        """Compute the new dates of the waiting loan cycles.
+
+        Nothing is stored, see apply.
+
+        :return: A list of (clc, (start_date, end_date),
+                 (new_start_date, new_end_date)) tuples, one per moved loan
+                 cycle, in issued_date order.
+        """
+        res = []
+        while self.queue:
+            _, _, clc = heapq.heappop(self.queue)
+            dates = self.dates[clc.id]
+            new_dates = self._reschedule(clc)
+            if new_dates != dates:
+                self.dates[clc.id] = new_dates
+                res.append((clc, dates, new_dates))
+        return res
+
+    @staticmethod
+    def apply(changes):
+        """Store the changes computed by schedule in one batch.
+
+        The loan cycles and their change events are written in one
+        transaction, see api.circulation._write_bulk.
+        """
+        from invenio_circulation.api.circulation import _write_bulk
+
+        if not changes:
+            return
+
+        for clc, _, new_dates in changes:
+            clc.start_date, clc.end_date = new_dates
+
+        def create_events():
+            for clc, old_dates, new_dates in changes:
+                description = []
+                for key, old, new in zip(['start_date', 'end_date'],
+                                         old_dates, new_dates):
+                    if old != new:
+                        description.append(
+                                '{0}: {1} -> {2}'.format(key, old, new))
+                create_event(loan_cycle_id=clc.id,
+                             event=models.CirculationLoanCycle.EVENT_CHANGE,
+                             description=', '.join(description))
+
+        _write_bulk([clc for clc, _, _ in changes], create_events)
+
+
+@retry_on_conflict
+def update_waitlists(clc_ids):
+    """Update the waitlists behind the given loan cycles of one item.
+
+    The active loan cycles of the item are loaded once and rescheduled for
+    each of the given (finished or canceled) loan cycles by issued_date.
+
+    :return: The changes, see WaitlistScheduler.schedule.
+    """
+    clcs = sorted((models.CirculationLoanCycle.get(x) for x in clc_ids),
+                  key=lambda x: x.issued_date)
+    if not clcs:
+        return []
+
+    other_clcs = [models.CirculationLoanCycle.get(x)
+                  for x in get_loan_cycle_ids([clcs[0].item])]
+    res = []
+    for clc in clcs:
+        scheduler = WaitlistScheduler(clc, other_clcs)
+        changes = scheduler.schedule()
+        scheduler.apply(changes)
+        res.extend(changes)
+    return res
+
+
+def dispatch(pending):
+    """Run the pending waitlist updates, one job per item.
+
+    :param pending: Dictionary mapping item ids to loan cycle ids.
+    """
+    run_async = current_app.config['CIRCULATION_WAITLIST_ASYNC']
+    for item_id, clc_ids in pending.items():
+        if run_async:
+            from invenio_circulation.tasks import update_waitlists as task
+            task.delay(clc_ids)
+        else:
+            update_waitlists(clc_ids)
+
+
+@contextmanager
+def deferred():
+    """Collect the waitlist updates requested inside the block.
+
+    The updates are coalesced per item and dispatched when the block is
+    left. Nested blocks share the outermost collection. If the block raises,
+    the collected updates are dropped, as the changes they are about were
+    not stored.
+    """
+    info = db.session().info
+    if info.get(_PENDING_KEY) is not None:
+        yield info[_PENDING_KEY]
+        return
+
+    info[_PENDING_KEY] = {}
+    try:
+        yield info[_PENDING_KEY]
+    except Exception:
+        info.pop(_PENDING_KEY)
+        raise
+    pending = info.pop(_PENDING_KEY)
+    if pending:
+        dispatch(pending)
+
+
+def defer(clc):
+    """Request the waitlist update behind the given loan cycle.
+
+    Inside a deferred block the update is collected, otherwise it is
+    dispatched right away.
+    """
+    pending = db.session().info.get(_PENDING_KEY)
+    if pending is None:
+        dispatch({clc.item_id: [clc.id]})
+    else:
+        pending.setdefault(clc.item_id, []).append(clc.id)
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+
+"""Simulation of request/loan/return/cancel sequences for benchmarking.
+
+The simulation replays synthetic loan cycle histories against the
+availability and waitlist logic, keeping the loan cycles in memory. This
+measures the scheduling code without the database and elasticsearch
+round trips.
+"""
+
+import datetime
+import json
+import random
+import timeit
+
+from invenio_circulation.api.availability import Availability
+from invenio_circulation.api.waitlist import WaitlistScheduler
+
+_OPERATIONS = [('request', 5), ('loan', 1), ('return', 2), ('cancel', 2)]
+
+
+class _LoanCycle(object):
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+def _get_percentile(durations, percentile):
+    index = int(round(percentile / 100.0 * (len(durations) - 1)))
+    return durations[index]
+
+
+def get_statistics(durations):
+    """Get the throughput (per second) and latency percentiles (in ms).
+
+    :param durations: The durations of the operations in seconds.
+    """
+    durations = sorted(durations)
+    total = sum(durations)
+    return {'count': len(durations),
+            'total': total,
+            'throughput': len(durations) / total if total else None,
+            'p50': _get_percentile(durations, 50) * 1000,
+            'p90': _get_percentile(durations, 90) * 1000,
+            'p99': _get_percentile(durations, 99) * 1000,
+            'max': durations[-1] * 1000}
+
+
+class Simulation(object):
+    """Replay random operations on in-memory loan cycles."""
+
+    def __init__(self, items=10, requests=50, horizon=365, seed=42):
+        """Constructor.
+
+        :param items: The number of simulated items.
+        :param requests: The number of operations per item.
+        :param horizon: Requests start up to this many days in the future.
+        :param seed: Seed of the random generator.
+        """
+        self.parameters = dict(items=items, requests=requests,
+                               horizon=horizon, seed=seed)
+        self.random = random.Random(seed)
+        self.today = datetime.date.today()
+        # Only the active loan cycles are kept, like in the occupancy table
+        self.clcs = dict((item_id, []) for item_id in range(items))
+        self.durations = dict((name, []) for name, _ in _OPERATIONS)
+        self.rejected = 0
+        self._id = 0
+        self._issued_date = datetime.datetime.now()
+
+    def _create(self, item_id, status, start_date, end_date,
+                desired_start_date=None, desired_end_date=None):
+        self._id += 1
+        self._issued_date += datetime.timedelta(seconds=1)
+        clc = _LoanCycle(id=self._id, item_id=item_id, current_status=status,
+                         issued_date=self._issued_date,
+                         start_date=start_date, end_date=end_date,
+                         desired_start_date=desired_start_date or start_date,
+                         desired_end_date=desired_end_date or end_date)
+        self.clcs[item_id].append(clc)
+        return clc
+
+    def _request(self, item_id, start_date, end_date, status):
+        periods = [(x.start_date, x.end_date)
+                   for x in self.clcs[item_id]]
+        availability = Availability(start_date, end_date, periods)
+        if availability.free:
+            return self._create(item_id, status, start_date, end_date)
+        elif (availability.contained_dates and
+              (status == 'requested' or
+               availability.contained_dates[0] == start_date)):
+            _start, _end = availability.contained_dates
+            return self._create(item_id, status, _start, _end,
+                                start_date, end_date)
+        self.rejected += 1
+
+    def request(self, item_id):
+        """Request the item with random dates, using the waitlist."""
+        start_date = self.today + datetime.timedelta(
+                self.random.randint(0, self.parameters['horizon']))
+        end_date = start_date + datetime.timedelta(
+                self.random.randint(7, 28))
+        return self._request(item_id, start_date, end_date, 'requested')
+
+    def loan(self, item_id):
+        """Loan the item starting today."""
+        return self._request(item_id, self.today,
+                             self.today + datetime.timedelta(28), 'on_loan')
+
+    def _finish(self, clc, status):
+        clc.current_status = status
+        self.clcs[clc.item_id].remove(clc)
+        scheduler = WaitlistScheduler(clc, self.clcs[clc.item_id])
+        changes = scheduler.schedule()
+        for _clc, _, new_dates in changes:
+            _clc.start_date, _clc.end_date = new_dates
+        return changes
+
+    def return_item(self, item_id):
+        """Finish a random active loan cycle of the item."""
+        active = self.clcs[item_id]
+        if active:
+            return self._finish(self.random.choice(active), 'finished')
+
+    def cancel(self, item_id):
+        """Cancel a random active loan cycle of the item."""
+        active = self.clcs[item_id]
+        if active:
+            return self._finish(self.random.choice(active), 'canceled')
+
+    def run(self):
+        """Replay the operations and collect their durations.
+
+        :return: The parameters and the statistics per operation.
+        """
+        functions = {'request': self.request, 'loan': self.loan,
+                     'return': self.return_item, 'cancel': self.cancel}
+        names = [name for name, weight in _OPERATIONS for _ in range(weight)]
+
+        count = self.parameters['items'] * self.parameters['requests']
+        for _ in range(count):
+            name = self.random.choice(names)
+            item_id = self.random.randrange(self.parameters['items'])
+            start = timeit.default_timer()
+            functions[name](item_id)
+            self.durations[name].append(timeit.default_timer() - start)
+
+        return self.get_results()
+
+    def get_results(self):
+        """Get the results of the last run, see run."""
+        from invenio_circulation import __version__
+
+        return {'version': __version__,
+                'date': datetime.datetime.now().isoformat(),
+                'parameters': self.parameters,
+                'rejected': self.rejected,
+                'operations': dict((name, get_statistics(durations))
+                                   for name, durations
+                                   in self.durations.items() if durations)}
+
+
+def compare(baseline, results):
+    """Get the p50 latency ratios of the results relative to a baseline.
+
+    :return: A dictionary mapping the operation names to the ratios.
+    """
+    res = {}
+    for name, stats in results['operations'].items():
+        try:
+            res[name] = stats['p50'] / baseline['operations'][name]['p50']
+        except (KeyError, ZeroDivisionError):
+            pass
+    return res
+
+
+def dump(results, f):
+    """Store the results as JSON in the given file object."""
+    json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation command line interface."""
+
+import datetime
+
+import click
+from flask_cli import with_appcontext
+
+
+def _parse_month(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m')
+    except ValueError:
+        raise click.BadParameter('The month must be given as YYYY-MM.')
+
+
+@click.group()
+def circulation():
+    """Circulation commands."""
+
+
+@circulation.group()
+def events():
+    """Circulation event storage commands."""
+
+
+@events.command()
+@click.option('--before', '-b', required=True,
+              help='Archive the events created before this month (YYYY-MM).')
+@click.option('--directory', '-d', default='.',
+              type=click.Path(exists=True, file_okay=False, writable=True),
+              help='Directory to store the archive files in.')
+@with_appcontext
+def archive(before, directory):
+    """Move old events to compressed NDJSON files."""
+    import invenio_circulation.api as api
+
+    for path, count in api.event.archive(_parse_month(before), directory):
+        click.echo('{0}: {1} events'.format(path, count))
+
+
+@events.command()
+@click.option('--before', '-b', required=True,
+              help='Compact the indices of the months before (YYYY-MM).')
+@with_appcontext
+def compact(before):
+    """Merge the segments of the monthly event indices."""
+    import invenio_circulation.api as api
+
+    for index_name in api.event.compact(_parse_month(before)):
+        click.echo(index_name)
+
+
+def _parse_date(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise click.BadParameter('The date must be given as YYYY-MM-DD.')
+
+
+@circulation.command()
+@click.argument('entity', type=click.Choice(['event', 'loan_cycle']))
+@click.option('--from', 'start_date', callback=_parse_date,
+              help='Only export rows created on or after (YYYY-MM-DD).')
+@click.option('--to', 'end_date', callback=_parse_date,
+              help='Only export rows created before (YYYY-MM-DD).')
+@click.option('--type', '-t', 'types', multiple=True,
+              help='Event type or loan cycle status, can be repeated.')
+@click.option('--output', '-o', type=click.File('wb'), default='-',
+              help='Output file, defaults to stdout.')
+@with_appcontext
+def export(entity, start_date, end_date, types, output):
+    """Export events or loan cycles as gzip compressed NDJSON."""
+    from invenio_circulation.export import (export as export_rows,
+                                            iter_gzip, iter_ndjson)
+
+    rows = export_rows(entity, start_date, end_date, types)
+    for chunk in iter_gzip(iter_ndjson(rows)):
+        output.write(chunk)
+
+
+@circulation.group()
+def occupancy():
+    """Materialized item occupancy commands."""
+
+
+@occupancy.command()
+@with_appcontext
+def check():
+    """Compare the item occupancy with the loan cycles."""
+    import invenio_circulation.api as api
+
+    differences = api.availability.check_consistency()
+    for clc_id, expected, actual in differences:
+        click.echo('Loan cycle {0}: expected {1}, found {2}'.format(
+            clc_id, expected, actual))
+    if differences:
+        raise click.ClickException(
+                '{0} inconsistencies found.'.format(len(differences)))
+    click.echo('The item occupancy is consistent.')
+
+
+@occupancy.command()
+@with_appcontext
+def rebuild():
+    """Rebuild the item occupancy from the loan cycles."""
+    import invenio_circulation.api as api
+
+    count = api.availability.rebuild()
+    click.echo('{0} busy periods stored.'.format(count))
+
+
+@circulation.command()
+@click.option('--items', '-i', default=10, help='Number of items.')
+@click.option('--requests', '-r', default=50,
+              help='Number of operations per item.')
+@click.option('--horizon', default=365,
+              help='Requests start up to this many days in the future.')
+@click.option('--seed', default=42, help='Seed of the random generator.')
+@click.option('--output', '-o', type=click.File('w'),
+              help='Store the results as JSON in this file.')
+@click.option('--baseline', '-b', type=click.File('r'),
+              help='Compare with the JSON results of a previous run.')
+@with_appcontext
+def bench(items, requests, horizon, seed, output, baseline):
+    """Benchmark the availability checks and the waitlist scheduling."""
+    import json
+
+    from invenio_circulation.benchmark import Simulation, compare, dump
+
+    results = Simulation(items, requests, horizon, seed).run()
+    if output:
+        dump(results, output)
+
+    ratios = compare(json.load(baseline), results) if baseline else {}
+    click.echo('{0:<10} {1:>8} {2:>10} {3:>8} {4:>8} {5:>8}'.format(
+        'operation', 'count', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms'))
+    for name, stats in sorted(results['operations'].items()):
+        line = '{0:<10} {1[count]:>8} {1[throughput]:>10.1f} {1[p50]:>8.3f} '
+        line += '{1[p90]:>8.3f} {1[p99]:>8.3f}'
+        if name in ratios:
+            line += ' ({0:.2f}x baseline p50)'.format(ratios[name])
+        click.echo(line.format(name, stats))
+
+
+@circulation.group()
+def rules():
+    """Loan rule commands."""
+
+
+@rules.command()
+@click.argument('user_id', type=int)
+@click.argument('item_id', type=int)
+@with_appcontext
+def explain(user_id, item_id):
+    """Show the loan rule matches applying to a user and an item."""
+    import invenio_circulation.models as models
+    from invenio_circulation.api.utils import explain_loan_rule
+
+    user = models.CirculationUser.get(user_id)
+    item = models.CirculationItem.get(item_id)
+    candidates = explain_loan_rule(user, item)
+    if not candidates:
+        raise click.ClickException('No loan rule match applies.')
+
+    click.echo('{0:<8} {1:>8} {2:>9} {3:>9} {4:>11} {5:>13}'.format(
+        '', 'match', 'loan rule', 'item_type', 'patron_type',
+        'location_code'))
+    for candidate in candidates:
+        line = '{0:<8} {1[loan_rule_match_id]:>8} {1[loan_rule_id]:>9} '
+        line += '{1[item_type]:>9.3f} {1[patron_type]:>11.3f} '
+        line += '{1[location_code]:>13.3f}'
+        click.echo(line.format('applied' if candidate['applied'] else '',
+                               candidate))
+
+
+@rules.command()
+@click.option('--matches', '-m', type=click.File('r'),
+              help='Evaluate the loan rule matches of this JSON file '
+                   'instead of the stored ones.')
+@click.option('--output', '-o', type=click.File('w'),
+              help='Store the results as JSON in this file.')
+@click.option('--baseline', '-b', type=click.File('r'),
+              help='Report the differences to the JSON results of a '
+                   'previous run.')
+@with_appcontext
+def evaluate(matches, output, baseline):
+    """Resolve the loan rule of every user group, item group and location."""
+    import json
+
+    from invenio_circulation.api.rule_matcher import compare, evaluate
+
+    results = evaluate(json.load(matches) if matches else None)
+    if output:
+        json.dump(results, output)
+
+    click.echo('{0[count]} combinations covering {0[items]} items resolved '
+               'in {0[duration]:.3f}s.'.format(results))
+    if results['throughput']:
+        click.echo('{0:.1f} resolutions/s'.format(results['throughput']))
+
+    if baseline:
+        changes = compare(json.load(baseline), results)
+        for change in changes:
+            click.echo('{0}, {1}, {2} ({3} items): loan rule {4} -> '
+                       '{5}'.format(*change))
+        click.echo('{0} combinations changed.'.format(len(changes)))
+
+
+@circulation.group()
+def mails():
+    """Circulation E-mail outbox commands."""
+
+
+@mails.command()
+@with_appcontext
+def send():
+    """Send the due E-mails of the outbox."""
+    import invenio_circulation.api as api
+
+    res = api.mail.send_all()
+    click.echo('{0[sent]} sent, {0[retried]} retried, {0[failed]} '
+               'failed.'.format(res))
+
+
+@mails.command()
+@with_appcontext
+def status():
+    """Show the number of E-mails per status."""
+    import invenio_circulation.api as api
+
+    for key, count in sorted(api.mail.get_status().items()):
+        click.echo('{0}: {1}'.format(key, count))
+
+
+@mails.command()
+@click.option('--before', '-b', required=True, callback=_parse_date,
+              help='Delete the E-mails sent before this date (YYYY-MM-DD).')
+@with_appcontext
+def purge(before):
+    """Delete sent E-mails from the outbox."""
+    import invenio_circulation.api as api
+
+    click.echo('{0} E-mails deleted.'.format(api.mail.purge(before)))
+
+
+@circulation.command()
+@click.option('--chunk-size', '-c', type=int,
+              help='Number of loan cycles processed per transaction.')
+@with_appcontext
+def overdue(chunk_size):
+    """Overdue all loan cycles on loan past their end date."""
+    import invenio_circulation.api as api
+
+    res = api.loan_cycle.detect_overdue(chunk_size)
+    click.echo('{0[overdue]} loan cycles overdue in {0[chunks]} chunks, '
+               '{0[duration]:.3f}s.'.format(res))
+
+
+@circulation.command()
+@click.option('--chunk-size', '-c', type=int,
+              help='Number of users processed per transaction.')
+@with_appcontext
+def letters(chunk_size):
+    """Send the overdue letters, one digest per user and letter."""
+    import invenio_circulation.api as api
+
+    res = api.loan_cycle.send_overdue_letters(chunk_size)
+    click.echo('{0[letters]} letters covering {0[loan_cycles]} loan cycles, '
+               '{0[duration]:.3f}s.'.format(res))
@@ -24,11 +24,88 @@ from celery.schedules import crontab
 
 DEFAULT_LOAN_PERIOD = 28    # in days
 
+CIRCULATION_EVENTS_ASYNC_INDEXING = True
+"""Index CirculationEvents in bulk using a celery task.
+
+If disabled, the events are indexed right after being written, and the index
+is refreshed (useful for testing).
+"""
+
+CIRCULATION_WAITLIST_ASYNC = True
+"""Update the waitlists behind returned and canceled loans in celery tasks.
+
+The updates are coalesced into one task per item. If disabled, they run
+before the return or cancel action finishes (useful for testing).
+"""
+
+CIRCULATION_LOAN_RULES_REFRESH_INTERVAL = 60
+"""Seconds after which the compiled loan rule matches are checked for changes.
+
+Changes made in the same process are picked up immediately.
+"""
+
+CIRCULATION_BULK_MAX_ITEMS = 500
+"""Maximum number of barcodes processed by one bulk loan or return."""
+
+CIRCULATION_REQUEST_CLAIM_SIZE = 10
+"""Number of pending requests a desk claims at once."""
+
+CIRCULATION_REQUEST_CLAIM_LEASE = 300
+"""Seconds after which the pending requests claimed by a desk expire."""
+
+CIRCULATION_CONFLICT_RETRIES = 3
+"""Retries of a loan or return conflicting with a concurrent change."""
+
+CIRCULATION_MAIL_ASYNC = True
+"""Send the queued E-mails in celery tasks.
+
+If disabled, the mails are sent before the queuing action finishes (useful
+for testing).
+"""
+
+CIRCULATION_MAIL_BATCH_SIZE = 100
+"""Maximum number of E-mails sent over one SMTP connection."""
+
+CIRCULATION_MAIL_MAX_ATTEMPTS = 5
+"""Number of attempts after which an E-mail is marked as failed."""
+
+CIRCULATION_MAIL_RETRY_DELAY = 60
+"""Seconds before the first retry of an E-mail, doubled for every retry."""
+
+CIRCULATION_MAIL_CLAIM_TIMEOUT = 600
+"""Seconds after which E-mails claimed by a crashed worker are sent again."""
+
+CIRCULATION_MAIL_TEMPLATES_REFRESH_INTERVAL = 60
+"""Seconds after which the compiled mail templates are checked for changes.
+
+Changes made in the same process are picked up immediately.
+"""
+
+CIRCULATION_OVERDUE_CHUNK_SIZE = 500
+"""Number of loan cycles overdued in one transaction by the overdue sweep."""
+
+CIRCULATION_OVERDUE_LETTERS = [('overdue_letter_1', 0),
+                               ('overdue_letter_2', 14)]
+"""Overdue letters as (mail template name, days) tuples.
+
+The first letter is sent for every overdue loan cycle, every following one
+the given days after the previous letter. A user receives one letter covering
+all of their overdue loan cycles.
+"""
+
 CHECKER_CELERYBEAT_SCHEDULE = {
     'checker-beat': {
-        'task': 'invenio.modules.circulation.tasks.detect_overdue',
+        'task': 'invenio_circulation.tasks.detect_overdue',
+        'schedule': crontab(minute='*/1'),
+    },
+    'circulation-overdue-letters': {
+        'task': 'invenio_circulation.tasks.send_overdue_letters',
+        'schedule': crontab(hour=7, minute=0),
+    },
+    'circulation-mails': {
+        'task': 'invenio_circulation.tasks.send_mails',
         'schedule': crontab(minute='*/1'),
-    }
+    },
 }
 
 CELERYBEAT_SCHEDULE = CHECKER_CELERYBEAT_SCHEDULE
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation utilities to export database rows as NDJSON."""
+
+import datetime
+import gzip
+import json
+import os
+import shutil
+import zlib
+
+from invenio_db import db
+from sqlalchemy import and_
+
+try:
+    _binary_types = (bytearray, memoryview, buffer)
+except NameError:
+    _binary_types = (bytearray, memoryview)
+
+
+def _serialize(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    elif isinstance(value, _binary_types):
+        return bytearray(value).decode('utf-8')
+    raise TypeError('{0!r} is not JSON serializable'.format(value))
+
+
+def iter_rows(table, *criteria, **kwargs):
+    """Stream the rows of the given table as dictionaries.
+
+    The rows are fetched using a server side cursor, so the memory usage
+    doesn't depend on the number of rows.
+
+    :param table: The sqlalchemy Table to read.
+    :param criteria: Filter expressions on the tables columns.
+    :param columns: The column names to include, defaults to all columns.
+    """
+    columns = kwargs.get('columns') or [x.key for x in table.columns]
+    query = (table.select().with_only_columns([table.c[x] for x in columns])
+             .where(and_(*criteria)).order_by(table.c.id))
+
+    connection = db.session.connection().execution_options(
+            stream_results=True)
+    for row in connection.execute(query):
+        yield dict(zip(columns, row))
+
+
+def iter_ndjson(rows):
+    """Serialize the given rows to NDJSON, one line at a time."""
+    for row in rows:
+        yield json.dumps(row, default=_serialize) + '\n'
+
+
+def write_ndjson_gz(path, rows):
+    """Write the given rows to a gzip compressed NDJSON file.
+
+    An existing file at the given path is replaced.
+
+    :return: The number of written rows.
+    """
+    count = 0
+    with gzip.open(path, 'wb') as f:
+        for line in iter_ndjson(rows):
+            f.write(line.encode('utf-8'))
+            count += 1
+    return count
+
+
+def move_gz(src, dst):
+    """Move the gzip file src to dst.
+
+    If dst already exists, src is appended to it as an additional gzip
+    member, which readers decompress as if it was one stream.
+    """
+    if not os.path.exists(dst):
+        os.rename(src, dst)
+        return
+
+    with open(dst, 'ab') as out, open(src, 'rb') as f:
+        shutil.copyfileobj(f, out)
+    os.remove(src)
+
+
+def iter_gzip(lines, level=6):
+    """Compress the given lines into a gzip stream, chunk by chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for line in lines:
+        chunk = compressor.compress(line.encode('utf-8'))
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def get_exported_entities():
+    """Get the exportable entities and the column used as their type."""
+    import invenio_circulation.models as models
+
+    return {'event': (models.CirculationEvent, 'event'),
+            'loan_cycle': (models.CirculationLoanCycle, 'current_status')}
+
+
+def export(entity, start_date=None, end_date=None, types=None):
+    """Stream the rows of the given entity.
+
+    :param entity: 'event' or 'loan_cycle'.
+    :param start_date: Only rows created on or after this date.
+    :param end_date: Only rows created before this date.
+    :param types: Only events of the given types or loan cycles in the
+                  given statuses.
+    :return: A generator of dictionaries.
+    """
+    try:
+        clazz, type_column = get_exported_entities()[entity]
+    except KeyError:
+        raise Exception('The entity {0} can not be exported.'.format(entity))
+
+    table = clazz.__table__
+    criteria = []
+    if start_date:
+        criteria.append(table.c.creation_date >= start_date)
+    if end_date:
+        criteria.append(table.c.creation_date < end_date)
+    if types:
+        criteria.append(table.c[type_column].in_(types))
+
+    columns = [x.key for x in table.columns if x.key != '_data']
+    return iter_rows(table, *criteria, columns=columns)
@@ -28,6 +28,7 @@ from __future__ import absolute_import, print_function
 
 from flask_babelex import gettext as _
 
+from . import config
 from .receivers.circulation import *
 from .receivers.entity import *
 from .receivers.lists import *
@@ -67,3 +68,6 @@ class InvenioCirculation(object):
             "INVENIO_CIRCULATION_BASE_TEMPLATE",
             app.config.get("BASE_TEMPLATE",
                            "invenio_circulation/base.html"))
+        for k in dir(config):
+            if k.startswith('CIRCULATION_'):
+                app.config.setdefault(k, getattr(config, k))
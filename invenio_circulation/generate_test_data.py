@@ -31,9 +31,7 @@ def create_indices(app):
     from invenio_circulation.models import entities
 
     for name, _, cls in filter(lambda x: x[0] != 'Record', entities):
-        index = cls.__tablename__
-        cls._es.indices.delete(index=index, ignore=404)
-        cls._es.indices.create(index=index, body=cls._mappings)
+        cls.create_index()
 
     from elasticsearch import Elasticsearch
 
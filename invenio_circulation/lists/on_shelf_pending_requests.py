@@ -43,9 +43,14 @@ class OnShelfPendingRequests(object):
                                active_nav='lists', clcs=clcs)
 
     @classmethod
-    def detail(cls, query):
+    def detail(cls, desk, limit=None):
         """List class function providing second stage user interface.
 
-        Empty.
+        Displays the pending requests claimed for the given desk, claiming
+        the next ones up to limit, see api.request_queue.fill.
         """
-        pass
+        from invenio_circulation.api.request_queue import fill
+
+        clcs = fill(desk, limit)
+        return render_template('lists/on_shelf_pending_requests.html',
+                               active_nav='lists', clcs=clcs)
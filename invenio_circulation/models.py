@@ -27,7 +27,11 @@ import elasticsearch
 import jsonpickle
 
 from invenio_db import db
+from sqlalchemy import event as sa_event
 from sqlalchemy.orm import subqueryload_all
+from sqlalchemy.orm.exc import StaleDataError
+
+from invenio_circulation.serializers import _dump_any, get_serializer
 
 
 class CirculationPickleHandler(jsonpickle.handlers.BaseHandler):
@@ -136,6 +140,19 @@ class CirculationObject(object):
         if obj is None:
             msg = "A {0} object with id {1} doesn't exist"
             raise Exception(msg.format(cls.__name__, id))
+        return cls._load(obj)
+
+    @classmethod
+    def find(cls, *criteria):
+        """Get the CirculationObjects matching the criteria using one query.
+
+        :param criteria: Filter expressions on the columns of the class.
+        """
+        query = cls.query.options(subqueryload_all('*')).filter(*criteria)
+        return [cls._load(obj) for obj in query.order_by(cls.id)]
+
+    @classmethod
+    def _load(cls, obj):
         data = jsonpickle.decode(obj._data)
 
         if hasattr(cls, '_construction_schema'):
@@ -167,11 +184,21 @@ class CirculationObject(object):
         for x in cls.query.all():
             cls.get(x.id).delete()
 
+    @classmethod
+    def create_index(cls):
+        """(Re)create the elasticsearch index of the given class."""
+        cls._es.indices.delete(index=cls.__tablename__, ignore=404)
+        cls._es.indices.create(index=cls.__tablename__, body=cls._mappings)
+
+    def _get_index_name(self):
+        """Get the name of the elasticsearch index storing the object."""
+        return self.__tablename__
+
     def delete(self):
         """Delete the object."""
         try:
             db.session.delete(self)
-            self._es.delete(index=self.__tablename__,
+            self._es.delete(index=self._get_index_name(),
                             doc_type=self.__tablename__,
                             id=self.id,
                             refresh=True)
@@ -207,114 +234,136 @@ class CirculationObject(object):
         res = cls._es.search(index=cls.__tablename__, body=body, size=10000)
         return [cls.get(x['_id']) for x in res['hits']['hits']]
 
-    def save(self):
-        """Store and index the object."""
+    def _store(self):
+        """Add the object to the session.
+
+        :return: The data to index in elasticsearch.
+        """
+        # Dirty shit :(
+        '''
+        The ArrayType attribute is not tracked by SQLAlchemy, which means
+        that calling save will never actually write it to the DB. Marking
+        it as *dirty* does the trick.
+        '''
         try:
-            """Save object to persistent storage."""
-            # Dirty shit :(
-            '''
-            The ArrayType attribute is not tracked by SQLAlchemy, which means
-            that calling save will never actually write it to the DB. Marking
-            it as *dirty* does the trick.
-            '''
-            try:
-                from sqlalchemy.orm.attributes import flag_modified
-                self.additional_statuses
-                flag_modified(self, 'additional_statuses')
-            except (AttributeError, KeyError):
-                pass
-            # End of dirty shit :(
+            from sqlalchemy.orm.attributes import flag_modified
+            self.additional_statuses
+            flag_modified(self, 'additional_statuses')
+        except (AttributeError, KeyError):
+            pass
+        # End of dirty shit :(
+
+        self.modification_date = datetime.datetime.now()
+
+        # Create dict for additional vars in _data
+        db_data = {}
+        if hasattr(self, '_construction_schema'):
+            for key, _ in self._construction_schema.items():
+                db_data[key] = getattr(self, key)
+
+        # Saving data for other modules
+        from invenio_circulation.views.utils import (
+                send_signal, flatten)
+        from invenio_circulation.signals import save_entity
 
-            self.modification_date = datetime.datetime.now()
+        construction_data = flatten(send_signal(save_entity,
+                                                self.__class__.__name__,
+                                                None))
 
-            # Create dict for additional vars in _data
-            db_data = {}
-            if hasattr(self, '_construction_schema'):
-                for key, _ in self._construction_schema.items():
+        if construction_data:
+            for key in construction_data:
+                try:
                     db_data[key] = getattr(self, key)
+                except AttributeError:
+                    pass
+        # End
+
+        self._data = jsonpickle.encode(db_data)
+        db.session.add(self)
+        if not hasattr(self, 'id') or self.id is None:
+            db.session.flush()
+
+        # Create dict for elasticsearch
+        es_data = get_serializer(self.__class__).dump(self)
+        es_data['id'] = self.id
+        return es_data
+
+    def save(self):
+        """Store and index the object.
 
-            # Saving data for other modules
-            from invenio_circulation.views.utils import (
-                    send_signal, flatten)
-            from invenio_circulation.signals import save_entity
-
-            construction_data = flatten(send_signal(save_entity,
-                                                    self.__class__.__name__,
-                                                    None))
-
-            if construction_data:
-                for key in construction_data:
-                    try:
-                        db_data[key] = getattr(self, key)
-                    except AttributeError:
-                        pass
-            # End
-
-            self._data = jsonpickle.encode(db_data)
-            db.session.add(self)
-            if not hasattr(self, 'id') or self.id is None:
-                db.session.flush()
-
-            # Create dict for elasticsearch
-            es_data = {}
-            for key, value in self.__dict__.items():
-                if key not in ['_data', '_sa_instance_state']:
-                    es_data[key] = self._encode(value)
-
-            es_data['id'] = self.id
-            self._es.index(index=self.__tablename__,
-                           doc_type=self.__tablename__,
-                           id=self.id,
-                           body=es_data,
-                           refresh=True)
+        The object is indexed once the transaction is committed.
 
+        :raise: StaleDataError if the object was changed concurrently since
+                it was loaded, see api.utils.retry_on_conflict.
+        """
+        try:
+            es_data = self._store()
             db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise
         except Exception:
             db.session.rollback()
+            return
+
+        self._es.index(index=self._get_index_name(),
+                       doc_type=self.__tablename__,
+                       id=es_data['id'],
+                       body=es_data,
+                       refresh=True)
+
+    @classmethod
+    def save_all(cls, objs):
+        """Store and index the given objects together.
+
+        The objects are written in one transaction and indexed using one
+        bulk request once it is committed.
+
+        :raise: StaleDataError if one of the objects was changed concurrently
+                since it was loaded.
+        """
+        try:
+            actions = cls.store_all(objs)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise
+        except Exception:
+            db.session.rollback()
+            return
+
+        cls.index_all(actions)
+
+    @classmethod
+    def store_all(cls, objs):
+        """Add the given objects to the session without committing.
+
+        :return: The elasticsearch bulk actions to index the objects with,
+                 see index_all.
+        """
+        actions = []
+        for obj in objs:
+            es_data = obj._store()
+            actions.append({'_index': obj._get_index_name(),
+                            '_type': obj.__tablename__,
+                            '_id': obj.id,
+                            '_source': es_data})
+        return actions
+
+    @classmethod
+    def index_all(cls, actions):
+        """Index objects in bulk using the actions returned by store_all."""
+        from elasticsearch.helpers import bulk
+
+        bulk(cls._es, actions, refresh=True)
 
     @classmethod
     def _encode(cls, value):
-        if isinstance(value, dict):
-            return {key: cls._encode(val) for key, val in value.items()}
-        elif isinstance(value, list):
-            return [cls._encode(val) for val in value]
-        elif isinstance(value, tuple):
-            return [cls._encode(val) for val in value]
-        elif isinstance(value, CirculationObject):
-            # NEW
-            return {key: cls._encode(val) for key, val
-                    in value.__dict__.items()
-                    if key not in ['_data', '_sa_instance_state']}
-            # OLDreturn value.id
-        else:
-            return value
+        return _dump_any(value)
 
     def jsonify(self):
         """Get a dictionary representation of the object."""
-        def _jsonify(value):
-            if isinstance(value, dict):
-                res = {}
-                for key, val in value.items():
-                    res[key] = _jsonify(val)
-                return res
-            elif isinstance(value, (list, tuple)):
-                return [_jsonify(val) for val in value]
-            else:
-                try:
-                    return value.jsonify()
-                except AttributeError:
-                    return value
-
-        # SQLalchemy hack: after every flush(), the __dict__ property
-        # disappears, touching the item gets it back
-        _id = self.id   # nopep8
-
-        res = {}
-        for key, value in self.__dict__.items():
-            if key == '_sa_instance_state':
-                continue
-            res[key] = _jsonify(value)
-        return res
+        return get_serializer(self.__class__).dump(self)
 
     def pickle(self):
         """Pickle the object."""
@@ -444,6 +493,11 @@ class CirculationItem(CirculationObject, db.Model):
     creation_date = db.Column(db.DateTime)
     modification_date = db.Column(db.DateTime)
     _data = db.Column(db.LargeBinary)
+    # Incremented by every update, which fails with a StaleDataError if
+    # the row was changed since it was loaded.
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version_id}
 
     GROUP_BOOK = 'book'
 
@@ -484,6 +538,8 @@ class CirculationItem(CirculationObject, db.Model):
 
     _all_field = ['record_id', 'isbn', 'barcode', 'title']
 
+    _projections = ['record']
+
     _mappings = {'mappings': {
         'circulation_item': {
             '_all': {'enabled': True},
@@ -541,6 +597,8 @@ class CirculationLoanCycle(CirculationObject, db.Model):
     """
 
     __tablename__ = 'circulation_loan_cycle'
+    __table_args__ = (db.Index('ix_circulation_loan_cycle_status_end_date',
+                               'current_status', 'end_date'),)
     id = db.Column(db.BigInteger, primary_key=True, nullable=False)
     current_status = db.Column(db.String(255))
     additional_statuses = db.Column(ArrayType(255))
@@ -558,6 +616,9 @@ class CirculationLoanCycle(CirculationObject, db.Model):
     creation_date = db.Column(db.DateTime)
     modification_date = db.Column(db.DateTime)
     _data = db.Column(db.LargeBinary)
+    version_id = db.Column(db.Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {'version_id_col': version_id}
 
     STATUS_ON_LOAN = 'on_loan'
     STATUS_REQUESTED = 'requested'
@@ -601,6 +662,8 @@ class CirculationLoanCycle(CirculationObject, db.Model):
                         }
                     }
 
+    _projections = ['group_uuid']
+
     _mappings = {'mappings': {
         'circulation_loan_cycle': {
             '_all': {'enabled': True},
@@ -619,6 +682,86 @@ class CirculationLoanCycle(CirculationObject, db.Model):
         }
 
 
+class CirculationItemOccupancy(db.Model):
+    """Materialized busy periods of the items.
+
+    Every active (neither finished nor canceled) loan cycle is represented by
+    one row with its start_date and end_date. The rows are maintained by the
+    CirculationLoanCycle mapper events in the same transaction as the loan
+    cycle itself, availability checks only need to read this table.
+    """
+
+    __tablename__ = 'circulation_item_occupancy'
+    loan_cycle_id = db.Column(db.BigInteger,
+                              db.ForeignKey('circulation_loan_cycle.id',
+                                            ondelete='CASCADE'),
+                              primary_key=True, autoincrement=False)
+    item_id = db.Column(db.BigInteger,
+                        db.ForeignKey('circulation_item.id',
+                                      ondelete='CASCADE'),
+                        index=True)
+    start_date = db.Column(db.Date)
+    end_date = db.Column(db.Date)
+
+    INACTIVE_STATUSES = [CirculationLoanCycle.STATUS_FINISHED,
+                         CirculationLoanCycle.STATUS_CANCELED]
+
+    @classmethod
+    def is_active(cls, clc):
+        """Check if the given loan cycle occupies its item."""
+        return (clc.current_status not in cls.INACTIVE_STATUSES and
+                clc.item_id is not None and
+                clc.start_date is not None and clc.end_date is not None)
+
+    @classmethod
+    def refresh(cls, connection, clc):
+        """Replace the row of the given loan cycle."""
+        table = cls.__table__
+        connection.execute(table.delete().where(
+            table.c.loan_cycle_id == clc.id))
+        if cls.is_active(clc):
+            connection.execute(table.insert().values(
+                loan_cycle_id=clc.id, item_id=clc.item_id,
+                start_date=clc.start_date, end_date=clc.end_date))
+
+
+@sa_event.listens_for(CirculationLoanCycle, 'after_insert')
+@sa_event.listens_for(CirculationLoanCycle, 'after_update')
+def _update_item_occupancy(mapper, connection, target):
+    CirculationItemOccupancy.refresh(connection, target)
+
+
+@sa_event.listens_for(CirculationLoanCycle, 'before_delete')
+def _delete_item_occupancy(mapper, connection, target):
+    table = CirculationItemOccupancy.__table__
+    connection.execute(table.delete().where(
+        table.c.loan_cycle_id == target.id))
+
+
+class CirculationRequestClaim(db.Model):
+    """Leases of requested loan cycles claimed by a desk for processing.
+
+    The rows are written by api.request_queue.claim and are only valid
+    until their expiry date, later they can be claimed again.
+    """
+
+    __tablename__ = 'circulation_request_claim'
+    loan_cycle_id = db.Column(db.BigInteger,
+                              db.ForeignKey('circulation_loan_cycle.id',
+                                            ondelete='CASCADE'),
+                              primary_key=True, autoincrement=False)
+    desk = db.Column(db.String(255), index=True)
+    claim_date = db.Column(db.DateTime)
+    expiry_date = db.Column(db.DateTime, index=True)
+
+
+@sa_event.listens_for(CirculationLoanCycle, 'before_delete')
+def _delete_request_claim(mapper, connection, target):
+    table = CirculationRequestClaim.__table__
+    connection.execute(table.delete().where(
+        table.c.loan_cycle_id == target.id))
+
+
 class CirculationUser(CirculationObject, db.Model):
     """Data model to store user information for invenio-circulation."""
 
@@ -818,6 +961,36 @@ class CirculationMailTemplate(CirculationObject, db.Model):
         }
 
 
+class CirculationMail(db.Model):
+    """Outbox of the E-mails to send.
+
+    Actions write their mails with api.mail.store_all in the transaction of
+    the changes they are about, notifications queued with api.mail.queue
+    after an action are committed on their own. The mails are sent in
+    batches by api.mail.send_pending. A mail being sent is claimed until its
+    next_attempt, a failed one is retried with an increasing delay.
+    """
+
+    __tablename__ = 'circulation_mail'
+    id = db.Column(db.BigInteger, primary_key=True, nullable=False)
+    sender = db.Column(db.String(255))
+    recipient = db.Column(db.String(255))
+    subject = db.Column(db.String(255))
+    body = db.Column(db.Text)
+    status = db.Column(db.String(255), index=True)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, index=True)
+    claim = db.Column(db.String(36))
+    last_error = db.Column(db.Text)
+    creation_date = db.Column(db.DateTime)
+    sent_date = db.Column(db.DateTime)
+
+    STATUS_PENDING = 'pending'
+    STATUS_SENDING = 'sending'
+    STATUS_SENT = 'sent'
+    STATUS_FAILED = 'failed'
+
+
 class CirculationLoanRule(CirculationObject, db.Model):
     """Data model to store loan rules definitions."""
 
@@ -982,10 +1155,19 @@ class CirculationEvent(CirculationObject, db.Model):
     loan_rule_match = db.relationship('CirculationLoanRuleMatch')
     event = db.Column(db.String(255))
     description = db.Column(db.String(255))
-    creation_date = db.Column(db.DateTime)
+    creation_date = db.Column(db.DateTime, index=True)
     modification_date = db.Column(db.DateTime)
     _data = db.Column(db.LargeBinary)
 
+    __table_args__ = (
+        db.Index('ix_circulation_event_user_id_creation_date',
+                 'user_id', 'creation_date'),
+        db.Index('ix_circulation_event_item_id_creation_date',
+                 'item_id', 'creation_date'),
+        db.Index('ix_circulation_event_loan_cycle_id_creation_date',
+                 'loan_cycle_id', 'creation_date'),
+    )
+
     _json_schema = {'type': 'object',
                     'title': 'Event',
                     'properties': {
@@ -1037,6 +1219,29 @@ class CirculationEvent(CirculationObject, db.Model):
         }
         }
 
+    @classmethod
+    def get_index_name(cls, date):
+        """Get the name of the monthly index for the given date.
+
+        The monthly indices are grouped under an alias named like the table.
+        """
+        return '{0}-{1:%Y-%m}'.format(cls.__tablename__, date)
+
+    @classmethod
+    def create_index(cls):
+        """(Re)create the index template for the monthly indices."""
+        pattern = cls.__tablename__ + '-*'
+        cls._es.indices.delete(index=pattern, ignore=404)
+        cls._es.indices.delete(index=cls.__tablename__, ignore=404)
+        cls._es.indices.delete_template(name=cls.__tablename__, ignore=404)
+
+        body = dict(cls._mappings, template=pattern,
+                    aliases={cls.__tablename__: {}})
+        cls._es.indices.put_template(name=cls.__tablename__, body=body)
+
+    def _get_index_name(self):
+        return self.get_index_name(self.creation_date)
+
 
 jsonpickle.handlers.registry.register(CirculationRecord,
                                       CirculationPickleHandler)
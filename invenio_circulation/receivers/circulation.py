@@ -112,21 +112,19 @@ def _circulation_search(sender, data):
 
 def _circulation_state(sender, data):
     def wrapped():
-        import json
         import datetime
         import invenio_circulation.models as m
         from flask import render_template
+        from invenio_circulation.api.context import ValidationContext
         from invenio_circulation.receivers.utils import _try_action
-        from invenio_circulation.views.utils import (
-                _get_cal_heatmap_dates, _get_cal_heatmap_range)
+        from invenio_circulation.views.utils import _get_occupancy_url
 
         def _enhance_record_data(records):
             q = 'record_id:{0}'
             for record in records:
                 record.items = m.CirculationItem.search(q.format(record.id))
                 for item in record.items:
-                    item.cal_data = json.dumps(_get_cal_heatmap_dates([item]))
-                    item.cal_range = _get_cal_heatmap_range([item])
+                    item.cal_url = _get_occupancy_url([item])
 
         def _get_warnings(validity, categories):
             res = []
@@ -167,6 +165,8 @@ def _circulation_state(sender, data):
         data['user'] = users[0] if (users and len(users) == 1) else users
         data['items'] = items
         data['records'] = records
+        # Shared by the checks of all the actions
+        data['context'] = ValidationContext()
 
         _actions = [('LOAN', 'loan'), ('REQUEST', 'request'),
                     ('RETURN', 'return')]
@@ -177,7 +177,7 @@ def _circulation_state(sender, data):
         date_warnings = _get_warnings(validity,
                                       ['start_date', 'date_suggestion'])
 
-        global_cal_data = json.dumps(_get_cal_heatmap_dates(items))
+        global_cal_url = _get_occupancy_url(items)
         global_cal_range = _get_global_cal_range(items, end_date)
 
         return render_template('circulation/circulation_content.html',
@@ -185,7 +185,7 @@ def _circulation_state(sender, data):
                                items=items, users=users, records=records,
                                start_date=start_date, end_date=end_date,
                                # action_buttons=action_buttons,
-                               cal_data=global_cal_data,
+                               cal_url=global_cal_url,
                                cal_range=global_cal_range,
                                waitlist=waitlist, delivery=delivery,
                                item_warnings=item_warnings,
@@ -189,14 +189,12 @@ def _get_location_aggregations(id):
 
 
 def _get_loan_cycle_aggregations(id):
-    import json
     import invenio_circulation.models as models
     import invenio_circulation.api as api
 
     from flask import render_template
     from invenio_circulation.api.utils import ValidationExceptions
-    from invenio_circulation.views.utils import (
-            _get_cal_heatmap_dates, _get_cal_heatmap_range)
+    from invenio_circulation.views.utils import _get_occupancy_url
 
     def _try(func, item):
         try:
@@ -207,14 +205,12 @@ def _get_loan_cycle_aggregations(id):
 
     def make_dict(clc):
         return {'clc': clc,
-                'cal_data': json.dumps(_get_cal_heatmap_dates([clc.item])),
-                'cal_range': _get_cal_heatmap_range([clc.item])}
+                'cal_url': _get_occupancy_url([clc.item])}
 
     clc = models.CirculationLoanCycle.get(id)
     items = [clc.item]
     users = [clc.user]
-    events = models.CirculationEvent.search('loan_cycle_id:{0}'.format(id))
-    events = sorted(events, key=lambda x: x.creation_date)
+    events = api.event.get_timeline(loan_cycle_id=id)
 
     cancel = _try(api.loan_cycle.try_cancel_clcs, clc)
     loan_extension = make_dict(clc)
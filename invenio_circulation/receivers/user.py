@@ -24,17 +24,14 @@ from invenio_circulation.signals import (user_current_holds,
 
 
 def _user_current_holds(sender, data):
-    import json
     import invenio_circulation.models as models
 
     from flask import render_template
-    from invenio_circulation.views.utils import (
-            _get_cal_heatmap_dates, _get_cal_heatmap_range)
+    from invenio_circulation.views.utils import _get_occupancy_url
 
     def make_dict(clc):
         return {'clc': clc,
-                'cal_data': json.dumps(_get_cal_heatmap_dates([clc.item])),
-                'cal_range': _get_cal_heatmap_range([clc.item])}
+                'cal_url': _get_occupancy_url([clc.item])}
 
     user_id = data
     SL = models.CirculationLoanCycle.STATUS_ON_LOAN
@@ -62,7 +62,10 @@ def _run_action(action, data):
     from invenio_circulation.views.utils import filter_params
 
     try:
-        filter_params(_get_action(action), **data)
+        result = filter_params(_get_action(action), **data)
+        if action == 'request' and not data.get('items'):
+            # request_items selected a copy of data['record_id']
+            data['items'] = [clc.item for clc in result]
         res = _get_message(action, data)
     except KeyError as e:
         res = None
@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation serializers for CirculationObjects.
+
+The fields of every entity are collected once per class, from the database
+columns, the relationships, the *_construction_schema* and the declared
+*_projections*. Dumping an object afterwards only walks this precompiled
+field list instead of inspecting the objects *__dict__*.
+"""
+
+import json
+
+from invenio_circulation.signals import get_entity
+
+_MISSING = object()
+
+_serializers = {}
+
+
+def _plain(value):
+    if isinstance(value, (list, tuple)):
+        return [_plain(val) for val in value]
+    elif isinstance(value, dict):
+        return {key: _plain(val) for key, val in value.items()}
+    return value
+
+
+def _dump_any(value):
+    """Fallback used for projections, where the type isn't known upfront."""
+    from invenio_circulation.models import CirculationObject
+
+    if isinstance(value, CirculationObject):
+        return get_serializer(value.__class__).dump(value)
+    elif isinstance(value, (list, tuple)):
+        return [_dump_any(val) for val in value]
+    elif isinstance(value, dict):
+        return {key: _dump_any(val) for key, val in value.items()}
+    return value
+
+
+def _dump_nested(value):
+    if value is None:
+        return None
+    return get_serializer(value.__class__).dump(value)
+
+
+class CirculationSerializer(object):
+    """Serializer compiled for one CirculationObject class."""
+
+    def __init__(self, cls):
+        """Constructor.
+
+        :param cls: The CirculationObject class to compile the serializer for.
+        """
+        self.cls = cls
+        self.fields = self._compile(cls)
+
+    @staticmethod
+    def _get_signal_fields(cls):
+        from invenio_circulation.views.utils import send_signal, flatten
+
+        return flatten(send_signal(get_entity, cls.__name__, None))
+
+    @classmethod
+    def _compile(cls, clazz):
+        from invenio_circulation.models import ArrayType
+
+        fields = []
+        seen = set(['_data', '_sa_instance_state'])
+
+        def add(name, encoder, loaded_only=False):
+            if name not in seen:
+                seen.add(name)
+                fields.append((name, encoder, loaded_only))
+
+        mapper = getattr(clazz, '__mapper__', None)
+        if mapper is not None:
+            relationships = set(x.key for x in mapper.relationships)
+            for prop in mapper.column_attrs:
+                array = isinstance(prop.columns[0].type, ArrayType)
+                add(prop.key, _plain if array else None)
+            # Relationships are only dumped if they are already loaded, to
+            # avoid lazy loading the whole object graph.
+            for name in sorted(relationships):
+                add(name, _dump_nested, loaded_only=True)
+        else:
+            add('id', None)
+
+        for name in sorted(getattr(clazz, '_construction_schema', {})):
+            add(name, _plain)
+
+        for name in getattr(clazz, '_projections', []):
+            add(name, _dump_any)
+
+        for name in cls._get_signal_fields(clazz):
+            add(name, _dump_any)
+
+        return tuple(fields)
+
+    def dump(self, obj):
+        """Get a dictionary representation of the given object.
+
+        Attributes that aren't set on the object are omitted.
+        """
+        # SQLalchemy hack: after every flush(), the __dict__ property
+        # disappears, touching the item gets it back
+        _id = getattr(obj, 'id', None)  # nopep8
+
+        loaded = obj.__dict__
+        res = {}
+        for name, encoder, loaded_only in self.fields:
+            if loaded_only:
+                value = loaded.get(name, _MISSING)
+            else:
+                value = getattr(obj, name, _MISSING)
+            if value is not _MISSING:
+                res[name] = encoder(value) if encoder else value
+        return res
+
+    def iter_json(self, objs, default=None):
+        """Stream the JSON list representation of the given objects.
+
+        :param objs: Iterable of objects of the serializers class.
+        :param default: Passed to json.dumps to handle unknown types.
+        :return: A generator yielding the JSON document in chunks.
+        """
+        yield '['
+        for i, obj in enumerate(objs):
+            if i:
+                yield ','
+            yield json.dumps(self.dump(obj), default=default)
+        yield ']'
+
+
+def get_serializer(cls):
+    """Get the compiled serializer of the given class."""
+    try:
+        return _serializers[cls]
+    except KeyError:
+        serializer = _serializers[cls] = CirculationSerializer(cls)
+        return serializer
+
+
+def reset_serializers():
+    """Drop all compiled serializers.
+
+    Called whenever a receiver of the *get_entity* signal is connected or
+    disconnected, as it changes the fields of the entities.
+    """
+    _serializers.clear()
+
+
+def _on_receivers_changed(sender, **kwargs):
+    reset_serializers()
+
+
+get_entity.receiver_connected.connect(_on_receivers_changed,
+                                      sender=get_entity)
+get_entity.receiver_disconnected.connect(_on_receivers_changed,
+                                         sender=get_entity)
@@ -23,9 +23,55 @@ define(
         'node_modules/cal-heatmap/cal-heatmap',
     ],
 function($, ch) {
+    /*
+     * Expand the [start_day, length] runs sent by the server, start_day
+     * counting the days since 1970-01-01, to the cal-heatmap format:
+     * {"<seconds of the local midnight>": 1, ...}
+     */
+    function expand(runs) {
+        if (!$.isArray(runs)) {
+            return runs;
+        }
+        var res = {};
+        for (var i = 0; i < runs.length; i++) {
+            for (var day = 0; day < runs[i][1]; day++) {
+                var date = new Date(1970, 0, 1 + runs[i][0] + day);
+                res[date.getTime() / 1000] = 1;
+            }
+        }
+        return res;
+    }
+
+    function get_data(element) {
+        return expand(JSON.parse($(element).attr('data-cal_data')));
+    }
+
+    /*
+     * Load the data of the given element and pass it to callback(data, range).
+     * Elements with a data-cal_url attribute fetch it from the occupancy
+     * endpoint, the responses are kept for the lifetime of the page and
+     * revalidated by the browser using their ETag.
+     */
+    var _loaded = {};
+
+    function load(element, callback) {
+        var url = $(element).attr('data-cal_url');
+        if (!url) {
+            callback(get_data(element),
+                     parseInt($(element).attr('data-cal_range')));
+            return;
+        }
+        if (!_loaded.hasOwnProperty(url)) {
+            _loaded[url] = $.getJSON(url);
+        }
+        _loaded[url].done(function(res) {
+            callback(expand(res.cal_data), res.cal_range);
+        });
+    }
+
     function setup(id) {
         var cal = new CalHeatMap();
-        var data = JSON.parse($(id).attr('data-cal_data'));
+        var data = get_data(id);
         var range = parseInt($(id).attr('data-cal_range'));
         if (range == 0){
             return
@@ -44,5 +90,5 @@ function($, ch) {
         return cal;
     }
 
-    return {setup: setup}
+    return {setup: setup, expand: expand, get_data: get_data, load: load}
 });
@@ -131,7 +131,9 @@ function($, chs, _bdp) {
             return;
         }
         cal = chs.setup('#cal-heatmap');
-        cal.update($('#cal-heatmap').data().cal_data);
+        chs.load('#cal-heatmap', function(data) {
+            cal.update(data);
+        });
     });
 
     $('#circulation_toggle_hints').on('click', function() {
@@ -139,22 +141,29 @@ function($, chs, _bdp) {
         $(this).blur();
     });
 
+    var hovered = null;
+
     $('.record_item').mouseenter(function(){
-        var data = JSON.parse($(this).attr('data-cal_data'));
-        var range = parseInt($(this).attr('data-cal_range'));
-        if (range == 0){
-            return
-        }
-        cal.update(data);
+        var element = hovered = this;
+        chs.load(element, function(data, range) {
+            if (range == 0 || hovered !== element){
+                return
+            }
+            cal.update(data);
+        });
     });
 
     $('.record_item').mouseleave(function(){
-        var data = JSON.parse($('#cal-heatmap').attr('data-cal_data'));
+        hovered = null;
         var range = parseInt($('#cal-heatmap').attr('data-cal_range'));
         if (range == 0){
             return
         }
-        cal.update(data);
+        chs.load('#cal-heatmap', function(data) {
+            if (hovered === null) {
+                cal.update(data);
+            }
+        });
     });
 
     $('.item_select').on('click', function(event){
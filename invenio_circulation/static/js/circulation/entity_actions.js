@@ -30,8 +30,9 @@ function($, chs, _bdp) {
             _data = $(event.target).data();
             if (_data.hasOwnProperty('modal_type') == true) {
                 if (_data.modal_type == 'time_pick') {
-                    var _cal = JSON.parse($(event.target).attr('data-cal_data'));
-                    cal.update(_cal);
+                    chs.load(event.target, function(_cal) {
+                        cal.update(_cal);
+                    });
                     $('#circulation_extension_time_pick').modal();
                     return
                 } else {
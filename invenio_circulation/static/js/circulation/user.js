@@ -77,12 +77,15 @@ function($, chs, _, _bdp) {
         cal = chs.setup('#cal-heatmap');
     });
 
+    var hovered = null;
+
     $('.record_item').mouseenter(function(){
-        var data = JSON.parse($(this).attr('data-cal_data'));
-        var range = parseInt($(this).attr('data-cal_range'));
-        if (range != 0){
-            cal.update(data);
-        }
+        var element = hovered = this;
+        chs.load(element, function(data, range) {
+            if (range != 0 && hovered === element){
+                cal.update(data);
+            }
+        });
 
         var warnings = JSON.parse($(this).attr('data-warnings'));
         if (warnings.length == 0) {
@@ -103,6 +106,7 @@ function($, chs, _, _bdp) {
     });
 
     $('.record_item').mouseleave(function(){
+        hovered = null;
         cal.update({});
         $(this).popover('hide');
     });
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA 02111-1307, USA.
+
+"""invenio-circulation celery tasks."""
+
+from celery import shared_task
+from flask import current_app
+
+
+@shared_task(ignore_result=True)
+def index_events(ids):
+    """Index the CirculationEvents with the given ids in bulk."""
+    from invenio_circulation.api.event import index
+
+    index(ids)
+
+
+@shared_task(ignore_result=True)
+def update_waitlists(clc_ids):
+    """Update the waitlists behind the given loan cycles of one item."""
+    from invenio_circulation.api.waitlist import update_waitlists
+
+    update_waitlists(clc_ids)
+
+
+@shared_task(ignore_result=True)
+def detect_overdue():
+    """Overdue all loan cycles on loan past their end_date."""
+    from invenio_circulation.api.loan_cycle import detect_overdue
+
+    res = detect_overdue()
+    current_app.logger.info('Overdue sweep: %(overdue)s loan cycles in '
+                            '%(chunks)s chunks, %(duration).3fs', res)
+    return res
+
+
+@shared_task(ignore_result=True)
+def send_overdue_letters():
+    """Send the overdue letters, one digest per user and letter."""
+    from invenio_circulation.api.loan_cycle import send_overdue_letters
+
+    res = send_overdue_letters()
+    current_app.logger.info('Overdue letters: %(letters)s letters covering '
+                            '%(loan_cycles)s loan cycles, %(duration).3fs',
+                            res)
+    return res
+
+
+@shared_task(ignore_result=True)
+def send_mails():
+    """Send the due E-mails of the outbox."""
+    from invenio_circulation.api.mail import send_all
+
+    send_all()
@@ -19,9 +19,11 @@
 
 """invenio-circulation entity interface."""
 
+import datetime
 import json
 
-from flask import Blueprint, render_template, flash
+from flask import (Blueprint, Response, render_template, flash, request,
+                   stream_with_context)
 
 from invenio_circulation.views.utils import (
         datetime_serial, send_signal, flatten, extract_params)
@@ -128,10 +130,12 @@ def entity_new(entity):
 def api_entity_search(entity, search):
     """API to search for objects of the given entity."""
     from invenio_circulation.signals import entity_class
+    from invenio_circulation.serializers import get_serializer
 
     clazz = send_signal(entity_class, entity, None)[0]
     objs = clazz.search(search)
-    return json.dumps([x.jsonify() for x in objs], default=datetime_serial)
+    return Response(get_serializer(clazz).iter_json(objs,
+                                                    default=datetime_serial))
 
 
 @blueprint.route('/api/entity/search_autocomplete', methods=['POST'])
@@ -198,3 +202,37 @@ def api_entity_delete(id, entity):
 
     flash('Successfully updated the {0} with id {1}.'.format(name, id))
     return ('', 200)
+
+
+@blueprint.route('/api/export/<entity>', methods=['GET'])
+@cap.require(403)
+def api_export(entity):
+    """API to stream events or loan cycles as gzip compressed NDJSON.
+
+    Supported query arguments: start_date and end_date (YYYY-MM-DD) and
+    type, which can be given multiple times.
+    """
+    from invenio_circulation.export import (export, get_exported_entities,
+                                            iter_gzip, iter_ndjson)
+
+    if entity not in get_exported_entities():
+        return ('', 404)
+
+    def _get_date(name):
+        try:
+            return datetime.datetime.strptime(request.args[name], '%Y-%m-%d')
+        except KeyError:
+            return None
+
+    try:
+        start_date = _get_date('start_date')
+        end_date = _get_date('end_date')
+    except ValueError:
+        return ('', 400)
+
+    rows = export(entity, start_date, end_date, request.args.getlist('type'))
+    filename = 'circulation_{0}.ndjson.gz'.format(entity)
+    headers = {'Content-Disposition': 'attachment; filename=' + filename}
+
+    return Response(stream_with_context(iter_gzip(iter_ndjson(rows))),
+                    mimetype='application/gzip', headers=headers)
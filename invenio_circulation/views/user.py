@@ -27,10 +27,11 @@ import invenio_circulation.models as models
 
 from invenio_circulation.views.utils import (
         datetime_serial, flatten, _get_cal_heatmap_dates,
-        _get_cal_heatmap_range, send_signal, get_user)
+        _get_cal_heatmap_range, _get_occupancy_etag, _get_occupancy_url,
+        send_signal, get_user)
 from invenio_circulation.api.utils import ValidationExceptions
 
-from flask import Blueprint, render_template, request, flash
+from flask import Blueprint, Response, render_template, request, flash
 
 
 blueprint = Blueprint('circulation_user', __name__, url_prefix='/circulation',
@@ -89,7 +90,7 @@ def user_record_actions(record_id, state=None):
                            start_date=start_date.isoformat(),
                            end_date=end_date.isoformat(),
                            waitlist=waitlist, delivery=delivery,
-                           cal_range=cal_range, cal_data={})
+                           cal_range=cal_range, cal_data=[])
 
 
 @blueprint.route('/api/user/run_action', methods=['POST'])
@@ -128,6 +129,36 @@ def api_user_run_action():
     return ('', 200)
 
 
+@blueprint.route('/api/occupancy/<item_ids>', methods=['GET'])
+def api_occupancy(item_ids):
+    """API to get the occupancy of the given items as cal-heatmap data.
+
+    The comma separated items share one heatmap. The response carries an
+    ETag, so clients and proxies only fetch it again after the loan cycles
+    of the items changed.
+    """
+    from invenio_circulation.api.availability import get_item_periods
+
+    try:
+        item_ids = [int(x) for x in item_ids.split(',')]
+    except ValueError:
+        return ('', 400)
+
+    etag = _get_occupancy_etag(item_ids)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        item_periods = get_item_periods(item_ids)
+        data = {'cal_data': _get_cal_heatmap_dates(None, item_periods),
+                'cal_range': _get_cal_heatmap_range(None, item_periods)}
+        response = Response(json.dumps(data), mimetype='application/json')
+
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    return response
+
+
 def _get_state(state):
     if state:
         start_date, end_date, waitlist, delivery = state.split(':')
@@ -147,13 +178,19 @@ def _get_record_items(record_id, user, start_date, end_date, waitlist):
     items = []
     query = 'record_id:{0}'.format(record_id)
 
-    for item in models.CirculationItem.search(query):
+    record_items = models.CirculationItem.search(query)
+    context = api.context.ValidationContext()
+    # Fetch the availability of all the items at once
+    context.get_availability(record_items, start_date, end_date)
+
+    for item in record_items:
         warnings = []
         try:
             api.circulation.try_request_items(user=user, items=[item],
                                               start_date=start_date,
                                               end_date=end_date,
-                                              waitlist=waitlist)
+                                              waitlist=waitlist,
+                                              context=context)
             request = True
         except ValidationExceptions as e:
             exceptions = [x[0] for x in e.exceptions]
@@ -166,8 +203,7 @@ def _get_record_items(record_id, user, start_date, end_date, waitlist):
 
         items.append({'item': item,
                       'request': request,
-                      'cal_data': json.dumps(_get_cal_heatmap_dates([item])),
-                      'cal_range': _get_cal_heatmap_range([item]),
+                      'cal_url': _get_occupancy_url([item]),
                       'warnings': json.dumps(warnings)})
 
     return items
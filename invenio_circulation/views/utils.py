@@ -91,57 +91,50 @@ def filter_params(func, **kwargs):
     """Extract parameters from keyword-arguments for a given function.
 
     Read the function parameters and extract the corresponding values from
-    the given keyword-arguments.
+    the given keyword-arguments. Parameters with a default value are optional.
     """
     import inspect
-    return func(**{arg: kwargs[arg] for arg in inspect.getargspec(func).args})
-
-
-def _get_cal_heatmap_dates(items):
-    def to_seconds(date):
-        return int(date.strftime("%s"))
-
-    def get_date_range(start_date, end_date):
-        delta = (end_date - start_date).days
-        res = []
-        for day in range(delta+1):
-            res.append(start_date + datetime.timedelta(days=day))
-        return res
-
-    res = set()
-    for item in items:
-        query = 'item_id:{0}'.format(item.id)
-        statuses = [models.CirculationLoanCycle.STATUS_FINISHED,
-                    models.CirculationLoanCycle.STATUS_CANCELED]
-        clcs = models.CirculationLoanCycle.search(query)
-        clcs = filter(lambda x: x.current_status not in statuses, clcs)
-        for clc in clcs:
-            date_range = get_date_range(clc.start_date, clc.end_date)
-            for date in date_range:
-                res.add((str(to_seconds(date)), 1))
-
-    return dict(res)
-
-
-def _get_cal_heatmap_range(items):
-    min_dates = []
-    max_dates = []
-    for item in items:
-        query = 'item_id:{0}'.format(item.id)
-        statuses = [models.CirculationLoanCycle.STATUS_FINISHED,
-                    models.CirculationLoanCycle.STATUS_CANCELED]
-        clcs = models.CirculationLoanCycle.search(query)
-        clcs = filter(lambda x: x.current_status not in statuses, clcs)
-        if not clcs:
-            continue
-        min_dates.append(min(clc.start_date for clc in clcs))
-        max_dates.append(max(clc.end_date for clc in clcs))
-
-    if not min_dates or not max_dates:
+    spec = inspect.getargspec(func)
+    optional = spec.args[len(spec.args) - len(spec.defaults or ()):]
+    return func(**{arg: kwargs[arg] for arg in spec.args
+                   if arg in kwargs or arg not in optional})
+
+
+def _get_cal_heatmap_dates(items, item_periods=None):
+    """Get the busy days of the given items as run-length encoded list.
+
+    Every run is a [start_day, length] pair, start_day counting the days
+    since 1970-01-01. The runs are expanded to the cal-heatmap format by
+    the client, see js/circulation/cal_setup.js.
+
+    :param item_periods: The items busy periods, if they are already known,
+                         see api.availability.get_item_periods.
+    """
+    from invenio_circulation.api.availability import (get_item_periods,
+                                                      get_union)
+
+    if item_periods is None:
+        item_periods = get_item_periods(items)
+
+    epoch = datetime.date(1970, 1, 1)
+    return [[(start_date - epoch).days, (end_date - start_date).days + 1]
+            for start_date, end_date in get_union(item_periods)]
+
+
+def _get_cal_heatmap_range(items, item_periods=None):
+    """Get the number of months covered by the busy days of the items."""
+    from invenio_circulation.api.availability import (get_item_periods,
+                                                      get_union)
+
+    if item_periods is None:
+        item_periods = get_item_periods(list(items))
+
+    periods = get_union(item_periods)
+    if not periods:
         return 0
 
-    min_date = min(min_dates)
-    max_date = max(max_dates)
+    min_date = periods[0][0]
+    max_date = periods[-1][1]
 
     return relativedelta.relativedelta(max_date, min_date).months + 1
 
@@ -173,3 +166,36 @@ def get_user(current_user):
         user.save()
 
     return user
+
+
+def _get_occupancy_etag(item_ids):
+    """Get an ETag for the occupancy of the items with the given ids.
+
+    The occupancy only changes together with the items loan cycles, so the
+    tag is built from their latest modification date and their number, the
+    latter covering deleted loan cycles.
+    """
+    import hashlib
+    from sqlalchemy import func
+    from invenio_db import db
+
+    CLC = models.CirculationLoanCycle
+    modified, count = (db.session
+                       .query(func.max(CLC.modification_date),
+                              func.count(CLC.id))
+                       .filter(CLC.item_id.in_(item_ids)).one())
+
+    key = '{0}:{1}:{2}'.format(','.join(str(x) for x in sorted(item_ids)),
+                               modified.isoformat() if modified else '',
+                               count)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+def _get_occupancy_url(items):
+    """Get the URL of the occupancy endpoint for the given items."""
+    from flask import url_for
+
+    ids = ','.join(str(item.id) for item in items)
+    if not ids:
+        return ''
+    return url_for('circulation_user.api_occupancy', item_ids=ids)
@@ -129,6 +129,12 @@ setup(
         'invenio_db.models': [
             'invenio_circulation = invenio_circulation.models',
         ],
+        'invenio_celery.tasks': [
+            'invenio_circulation = invenio_circulation.tasks',
+        ],
+        'flask.commands': [
+            'circulation = invenio_circulation.cli:circulation',
+        ],
         'invenio_assets.bundles': [
             'invenio_circulation_css = invenio_circulation.bundles:css',
             ('invenio_circulation_circulation_js = '
@@ -147,7 +153,6 @@ setup(
         # 'invenio_base.api_apps': [],
         # 'invenio_base.api_blueprints': [],
         # 'invenio_base.blueprints': [],
-        # 'invenio_celery.tasks': [],
         # 'invenio_db.models': [],
         # 'invenio_pidstore.minters': [],
         # 'invenio_records.jsonresolver': [],
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Benchmark DateManager with long lived items.
+
+Every simulated item has years of loan history, one loan after another with
+some idle days in between. Run with:
+
+    python tests/benchmarks/date_manager.py [years] [repetitions]
+"""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import random
+import sys
+import timeit
+
+
+def _create_history(years, seed=42):
+    rand = random.Random(seed)
+    day = datetime.date.today() - datetime.timedelta(days=365 * years)
+    end = datetime.date.today() + datetime.timedelta(days=60)
+    res = []
+    while day < end:
+        start = day + datetime.timedelta(days=rand.randint(0, 5))
+        day = start + datetime.timedelta(days=rand.randint(7, 28))
+        res.append((start, day))
+    return res
+
+
+def main(years=10, repetitions=100):
+    """Run the benchmark and print the timings."""
+    from invenio_circulation.api.utils import DateManager
+
+    periods = _create_history(years)
+    today = datetime.date.today()
+    end = today + datetime.timedelta(days=30)
+    occupancy = DateManager.get_occupancy(periods)
+
+    def contained_date():
+        try:
+            DateManager.get_contained_date(today, end, periods)
+        except Exception:
+            pass
+
+    benchmarks = [
+        ('get_contained_date', contained_date),
+        ('get_date_suggestions',
+         lambda: DateManager.get_date_suggestions(periods)),
+        ('get_largest_free_period',
+         lambda: DateManager.get_largest_free_period(today, end, occupancy)),
+        ('get_free_periods',
+         lambda: DateManager.get_free_periods(today, 5, occupancy)),
+    ]
+
+    print('{0} periods over {1} years'.format(len(periods), years))
+    for name, func in benchmarks:
+        duration = timeit.timeit(func, number=repetitions) / repetitions
+        print('{0:<25} {1:>10.3f} ms'.format(name, duration * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(x) for x in sys.argv[1:]])
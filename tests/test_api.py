@@ -88,6 +88,163 @@ def test_event_create(current_app, rec_uuids):
         _delete_test_data(ce)
 
 
+def test_event_batch(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        with api.event.batch():
+            ces = [api.event.create(description=str(i)) for i in range(3)]
+            assert all(ce.id is None for ce in ces)
+
+        assert len(set(ce.id for ce in ces)) == 3
+        for i, ce in enumerate(ces):
+            assert models.CirculationEvent.get(ce.id).description == str(i)
+
+        # The events of a failing block are dropped
+        with pytest.raises(ValueError):
+            with api.event.batch():
+                ce = api.event.create(description='dropped')
+                raise ValueError()
+        assert ce.id is None
+        query = models.CirculationEvent.query.filter_by(description='dropped')
+        assert query.count() == 0
+
+        _delete_test_data(*ces)
+
+
+def test_event_timeline(current_app, rec_uuids):
+    import datetime
+    import invenio_circulation.api as api
+
+    from invenio_db import db
+
+    with current_app.app_context():
+        ces = [api.event.create(loan_cycle_id=None, description='timeline')
+               for i in range(3)]
+        for ce, day in zip(ces, [3, 1, 2]):
+            ce.creation_date = datetime.datetime(2000, 1, day)
+        db.session.commit()
+
+        timeline = api.event.get_timeline(description='timeline')
+        assert [ce.id for ce in timeline] == [ces[1].id, ces[2].id, ces[0].id]
+
+        _delete_test_data(*ces)
+
+
+def test_event_archive(current_app, rec_uuids, tmpdir):
+    import datetime
+    import gzip
+    import json
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    from invenio_db import db
+
+    with current_app.app_context():
+        ce = api.event.create(description='archive')
+        ce.creation_date = datetime.datetime(2000, 1, 15)
+        db.session.commit()
+
+        res = api.event.archive(datetime.datetime(2000, 2, 1), str(tmpdir))
+        assert len(res) == 1
+        path, count = res[0]
+        assert count == 1
+        assert path.endswith('circulation_event-2000-01.ndjson.gz')
+
+        with gzip.open(path) as f:
+            data = [json.loads(line) for line in f]
+        assert data[0]['id'] == ce.id
+        assert data[0]['description'] == 'archive'
+
+        # Rows of an already archived month are added to its file
+        ce2 = api.event.create(description='archive')
+        ce2.creation_date = datetime.datetime(2000, 1, 20)
+        db.session.commit()
+
+        res = api.event.archive(datetime.datetime(2000, 2, 1), str(tmpdir))
+        assert res == [(path, 1)]
+        with gzip.open(path) as f:
+            data = [json.loads(line) for line in f]
+        assert [x['id'] for x in data] == [ce.id, ce2.id]
+        assert tmpdir.listdir() == [tmpdir.join(path.split('/')[-1])]
+
+        db.session.expunge_all()
+        with pytest.raises(Exception):
+            models.CirculationEvent.get(ce.id)
+
+
+def test_event_archive_interrupted(current_app, rec_uuids, tmpdir,
+                                   monkeypatch):
+    import datetime
+    import gzip
+    import json
+    import invenio_circulation.api as api
+    import invenio_circulation.export as export
+
+    from invenio_db import db
+
+    def read_ids(path):
+        with gzip.open(path) as f:
+            return [json.loads(line)['id'] for line in f]
+
+    with current_app.app_context():
+        ce = api.event.create(description='archive')
+        ce.creation_date = datetime.datetime(2001, 3, 10)
+        db.session.commit()
+
+        # Interrupted after deleting the rows, before moving the file
+        def failing_move_gz(src, dst):
+            raise IOError()
+
+        monkeypatch.setattr(export, 'move_gz', failing_move_gz)
+        with pytest.raises(IOError):
+            api.event.archive(datetime.datetime(2001, 4, 1), str(tmpdir))
+        monkeypatch.undo()
+
+        path = str(tmpdir.join('circulation_event-2001-03.ndjson.gz'))
+        assert tmpdir.listdir() == [tmpdir.join(
+            'circulation_event-2001-03.ndjson.gz.tmp')]
+
+        res = api.event.archive(datetime.datetime(2001, 4, 1), str(tmpdir))
+        assert res == [(path, 1)]
+        assert read_ids(path) == [ce.id]
+        assert tmpdir.listdir() == [tmpdir.join(path.split('/')[-1])]
+
+        # Interrupted before deleting the rows
+        ce2 = api.event.create(description='archive')
+        ce2.creation_date = datetime.datetime(2001, 4, 10)
+        db.session.commit()
+
+        path2 = str(tmpdir.join('circulation_event-2001-04.ndjson.gz'))
+        export.write_ndjson_gz(path2 + '.tmp', [{'id': ce2.id}])
+
+        res = api.event.archive(datetime.datetime(2001, 5, 1), str(tmpdir))
+        assert res == [(path2, 1)]
+        assert read_ids(path2) == [ce2.id]
+        assert not tmpdir.join(path2.split('/')[-1] + '.tmp').exists()
+
+
+def test_event_export(current_app, rec_uuids):
+    import gzip
+    import io
+    import invenio_circulation.api as api
+    from invenio_circulation.export import export, iter_gzip, iter_ndjson
+
+    with current_app.app_context():
+        ce = api.event.create(event='export_test')
+
+        rows = list(export('event', types=['export_test']))
+        assert [row['id'] for row in rows] == [ce.id]
+        assert '_data' not in rows[0]
+
+        data = ''.join(iter_gzip(iter_ndjson(rows)))
+        with gzip.GzipFile(fileobj=io.BytesIO(data)) as f:
+            assert len(f.readlines()) == 1
+
+        _delete_test_data(ce)
+
+
 def test_event_update(current_app, rec_uuids):
     import invenio_circulation.api as api
     import invenio_circulation.models as models
@@ -116,3 +273,40 @@ def test_event_delete(current_app, rec_uuids):
             raise AssertionError('Deleting an event should not be possible.')
         except Exception as e:
             pass
+
+
+def test_jsonify(current_app, rec_uuids):
+    import invenio_circulation.models as models
+    from invenio_circulation.serializers import get_serializer
+    from invenio_circulation.signals import get_entity
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+
+        ci = models.CirculationItem.get(ci.id)
+        data = ci.jsonify()
+
+        assert data['id'] == ci.id
+        assert data['barcode'] == ci.barcode
+        assert data['location']['code'] == cl.code
+        assert '_data' not in data
+        assert '_sa_instance_state' not in data
+
+        serializer = get_serializer(models.CirculationItem)
+        assert serializer is get_serializer(models.CirculationItem)
+        assert ''.join(serializer.iter_json([])) == '[]'
+
+        # Fields registered by other modules after the compilation
+        def _get_entity(sender, data):
+            return {'name': 'test_field', 'result': ['test_field']}
+
+        get_entity.connect(_get_entity)
+        try:
+            serializer = get_serializer(models.CirculationItem)
+            assert 'test_field' in [x[0] for x in serializer.fields]
+        finally:
+            get_entity.disconnect(_get_entity)
+        serializer = get_serializer(models.CirculationItem)
+        assert 'test_field' not in [x[0] for x in serializer.fields]
+
+        _delete_test_data(cl, clr, clrm, cu, ci)
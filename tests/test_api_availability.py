@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Module tests."""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+
+import pytest
+from invenio_circulation import InvenioCirculation
+
+from utils import (_create_dates, _create_test_data, _delete_test_data,
+                   current_app, rec_uuids, state)
+
+
+def test_availability_occupancy(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+
+        current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
+        clc = api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                    current_status=current_status,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    desired_start_date=start_date,
+                                    desired_end_date=end_date,
+                                    issued_date=start_date,
+                                    delivery=None)
+
+        assert api.availability.get_periods([ci]) == [(start_date, end_date)]
+        assert api.availability.get_periods([ci], exclude=[clc]) == []
+        assert api.availability.get_loan_cycle_ids([ci]) == [clc.id]
+
+        new_end_date = end_date - datetime.timedelta(days=7)
+        api.loan_cycle.update(clc, end_date=new_end_date)
+        assert api.availability.get_periods([ci]) == [(start_date,
+                                                       new_end_date)]
+
+        api.loan_cycle.cancel_clcs([clc])
+        assert api.availability.get_periods([ci]) == []
+        assert api.availability.check_consistency() == []
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
+
+
+def test_availability_check_rebuild(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_db import db
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+
+        current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
+        clc = api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                    current_status=current_status,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    desired_start_date=start_date,
+                                    desired_end_date=end_date,
+                                    issued_date=start_date,
+                                    delivery=None)
+
+        db.session.execute(models.CirculationItemOccupancy.__table__.delete())
+        db.session.commit()
+        assert api.availability.check_consistency() == [
+                (clc.id, (ci.id, start_date, end_date), None)]
+
+        assert api.availability.rebuild() == 1
+        assert api.availability.check_consistency() == []
+        assert api.availability.get_periods([ci]) == [(start_date, end_date)]
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
+
+
+def test_availability_multiple_items():
+    import invenio_circulation.api as api
+
+    def d(day):
+        return datetime.date(2016, 1, day)
+
+    item_periods = {1: [(d(1), d(5)), (d(10), d(12))],
+                    2: [(d(3), d(10))],
+                    3: []}
+
+    assert api.availability.get_busy_counts(item_periods) == [
+            (d(1), d(2), 1), (d(3), d(5), 2), (d(6), d(9), 1),
+            (d(10), d(10), 2), (d(11), d(12), 1)]
+    assert api.availability.get_union(item_periods) == [(d(1), d(12))]
+    assert api.availability.get_intersection(item_periods) == []
+
+    del item_periods[3]
+    assert api.availability.get_intersection(item_periods) == [
+            (d(3), d(5)), (d(10), d(10))]
+    assert api.availability.get_first_free_day(item_periods, d(4)) == d(6)
+    assert api.availability.get_first_free_day(item_periods, d(7)) == d(7)
+    assert api.availability.get_first_free_day({}, d(7)) is None
+
+
+def test_availability_check(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_circulation.api.utils import ValidationExceptions
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates(start_weeks=1)
+
+        current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
+        clc = api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                    current_status=current_status,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    desired_start_date=start_date,
+                                    desired_end_date=end_date,
+                                    issued_date=start_date,
+                                    delivery=None)
+
+        req_start, req_end = _create_dates(end_weeks=2)
+        availability = api.availability.check([ci], req_start, req_end)
+        assert not availability[ci.id].free
+        assert availability[ci.id].contained_dates == (
+                req_start, start_date - datetime.timedelta(days=1))
+        assert availability[ci.id].suggested_dates
+
+        context = api.context.ValidationContext()
+        context.set_availability(req_start, req_end, availability)
+        with pytest.raises(ValidationExceptions) as e:
+            api.circulation.try_request_items(cu, [ci], req_start, req_end,
+                                              context=context)
+        assert [x[0] for x in e.value.exceptions] == ['date_suggestion']
+
+        availability = api.availability.check([ci], req_start, req_end,
+                                              exclude=[clc])
+        assert availability[ci.id].free
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
+
+
+def test_availability_find_copy(current_app, rec_uuids):
+    import uuid
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_circulation.api.utils import ValidationExceptions
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        ci2 = api.item.create(rec_uuids[0], cl.id, '978-1934356982',
+                              'CM-B00001339', 'books', '13.37', 'Vol 1',
+                              'no desc',
+                              models.CirculationItem.STATUS_ON_SHELF,
+                              models.CirculationItem.GROUP_BOOK)
+        start_date, end_date = _create_dates(end_weeks=2)
+
+        clc = api.circulation.loan_items(cu, [ci], start_date, end_date)[0]
+
+        item, availability = api.availability.find_copy(
+                rec_uuids[0], start_date, end_date)
+        assert item.id == ci2.id
+        assert availability.free
+        assert availability.available_from == start_date
+
+        clc2 = api.circulation.request_items(cu, None, start_date, end_date,
+                                             record_id=rec_uuids[0])[0]
+        assert clc2.item.id == ci2.id
+
+        item, availability = api.availability.find_copy(
+                rec_uuids[0], start_date, end_date)
+        assert not availability.free
+        assert availability.available_from == (end_date +
+                                               datetime.timedelta(days=1))
+
+        with pytest.raises(ValidationExceptions) as e:
+            api.circulation.request_items(cu, None, start_date, end_date,
+                                          record_id=str(uuid.uuid4()))
+        assert [x[0] for x in e.value.exceptions] == ['items']
+
+        _delete_test_data(cl, clr, clrm, cu, ci, ci2, clc, clc2)
+
+
+def test_availability_cal_heatmap_dates():
+    from invenio_circulation.views.utils import _get_cal_heatmap_dates
+
+    def d(month, day):
+        return datetime.date(1970, month, day)
+
+    item_periods = {1: [(d(1, 2), d(1, 4)), (d(2, 1), d(2, 1))],
+                    2: [(d(1, 5), d(1, 6))]}
+
+    assert _get_cal_heatmap_dates(None, item_periods) == [[1, 5], [31, 1]]
+    assert _get_cal_heatmap_dates(None, {1: []}) == []
+
+
+def test_availability_occupancy_endpoint(current_app, rec_uuids):
+    import json
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+        url = '/circulation/api/occupancy/{0}'.format(ci.id)
+
+        client = current_app.test_client()
+        res = client.get(url)
+        etag = res.headers['ETag']
+        assert res.status_code == 200
+        assert json.loads(res.data.decode('utf-8')) == {'cal_data': [],
+                                                        'cal_range': 0}
+
+        res = client.get(url, headers={'If-None-Match': etag})
+        assert res.status_code == 304
+
+        current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
+        clc = api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                    current_status=current_status,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    desired_start_date=start_date,
+                                    desired_end_date=end_date,
+                                    issued_date=start_date,
+                                    delivery=None)
+
+        res = client.get(url, headers={'If-None-Match': etag})
+        data = json.loads(res.data.decode('utf-8'))
+        assert res.status_code == 200
+        assert res.headers['ETag'] != etag
+        assert [x[1] for x in data['cal_data']] == [28 + 1]
+
+        assert client.get('/circulation/api/occupancy/x').status_code == 400
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
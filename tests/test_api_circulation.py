@@ -556,3 +556,205 @@ def test_return_items_successful_update_waitlist1(current_app, rec_uuids):
         assert clc2.start_date == start_date2
 
         _delete_test_data(cl, clr, clrm, cu, clc1, clc2, ci)
+
+
+def test_bulk_loan_and_return_items(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+        ci2 = api.item.create(rec_uuids[0], cl.id, '978-1934356982',
+                              'CM-B00001339', 'books', '13.37', 'Vol 2',
+                              'no desc',
+                              models.CirculationItem.STATUS_MISSING,
+                              models.CirculationItem.GROUP_BOOK)
+        barcodes = [ci.barcode, ci2.barcode, 'unknown', ci.barcode]
+
+        results = api.circulation.bulk_loan_items(cu, barcodes)
+
+        assert [x['barcode'] for x in results] == barcodes
+        assert results[0]['errors'] == []
+        assert [x[0] for x in results[1]['errors']] == ['items_status']
+        assert [x[0] for x in results[2]['errors']] == ['items']
+        assert [x[0] for x in results[3]['errors']] == ['items']
+
+        clc = results[0]['loan_cycle']
+        assert ci.current_status == models.CirculationItem.STATUS_ON_LOAN
+        assert clc.current_status == models.CirculationLoanCycle.STATUS_ON_LOAN
+        assert clc.start_date == start_date
+        assert clc.end_date == end_date
+        assert api.availability.get_periods([ci]) == [(start_date, end_date)]
+
+        results = api.circulation.bulk_return_items([ci.barcode,
+                                                     ci2.barcode])
+
+        assert results[0]['errors'] == []
+        assert results[0]['loan_cycle'] == clc
+        assert [x[0] for x in results[1]['errors']] == ['items_status']
+        assert ci.current_status == models.CirculationItem.STATUS_ON_SHELF
+        stat_finished = models.CirculationLoanCycle.STATUS_FINISHED
+        assert clc.current_status == stat_finished
+
+        _delete_test_data(cl, clr, clrm, cu, clc, ci, ci2)
+
+
+def test_validation_context_shared(current_app, rec_uuids, monkeypatch):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+
+        calls = []
+        check = api.context.check
+
+        def counting_check(*args, **kwargs):
+            calls.append(args)
+            return check(*args, **kwargs)
+
+        monkeypatch.setattr(api.context, 'check', counting_check)
+
+        context = api.context.ValidationContext()
+        api.circulation.try_loan_items(cu, [ci], start_date, end_date,
+                                       context=context)
+        api.circulation.try_request_items(cu, [ci], start_date, end_date,
+                                          context=context)
+        clcs = api.circulation.loan_items(cu, [ci], start_date, end_date,
+                                          context=context)
+        assert len(calls) == 1
+        assert context.get_loan_rule(cu, ci).id == clr.id
+
+        context = api.context.ValidationContext()
+        api.circulation.try_return_items([ci], context=context)
+        assert context._loan_cycles == {ci.id: [clcs[0]]}
+        assert context.get_loan(ci) == clcs[0]
+        api.circulation.return_items([ci], context=context)
+        assert (clcs[0].current_status ==
+                models.CirculationLoanCycle.STATUS_FINISHED)
+
+        _delete_test_data(cl, clr, clrm, cu, clcs[0], ci)
+
+
+def test_conflict_drops_positional_context(current_app, rec_uuids,
+                                           monkeypatch):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_db import db
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+
+        contexts = []
+        get_context = api.circulation._get_context
+        try_loan_items = api.circulation.try_loan_items
+
+        def recording_get_context(context):
+            contexts.append(context)
+            return get_context(context)
+
+        def recording_try_loan_items(*args, **kwargs):
+            contexts.append(kwargs['context'])
+            return try_loan_items(*args, **kwargs)
+
+        monkeypatch.setattr(api.circulation, '_get_context',
+                            recording_get_context)
+        monkeypatch.setattr(api.circulation, 'try_loan_items',
+                            recording_try_loan_items)
+
+        def change_concurrently(obj):
+            table = type(obj).__table__
+            db.session.execute(table.update()
+                               .where(table.c.id == obj.id)
+                               .values(version_id=table.c.version_id + 1))
+
+        context = api.context.ValidationContext()
+        change_concurrently(ci)
+        clcs = api.circulation.loan_items(cu, [ci], start_date, end_date,
+                                          False, None, context)
+        assert contexts == [context, None]
+        assert ci.current_status == models.CirculationItem.STATUS_ON_LOAN
+
+        del contexts[:]
+        context = api.context.ValidationContext()
+        api.circulation.try_return_items([ci], context=context)
+        change_concurrently(clcs[0])
+        api.circulation.return_items([ci], context)
+        assert contexts == [context, None]
+        assert (clcs[0].current_status ==
+                models.CirculationLoanCycle.STATUS_FINISHED)
+
+        _delete_test_data(cl, clr, clrm, cu, clcs[0], ci)
+
+
+def test_concurrent_loans(current_app, rec_uuids):
+    import random
+    import threading
+    import timeit
+
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_db import db
+    from invenio_circulation.api.utils import (ConflictException,
+                                               ValidationExceptions)
+
+    threads_count = 8
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+        items = [ci] + [api.item.create(rec_uuids[0], cl.id, '978-1934356982',
+                                        'CM-B0000200{0}'.format(i), 'books',
+                                        '13.37', 'Vol 1', 'no desc',
+                                        models.CirculationItem.STATUS_ON_SHELF,
+                                        models.CirculationItem.GROUP_BOOK)
+                        for i in range(4)]
+        item_ids = [x.id for x in items]
+        user_id = cu.id
+
+    start = threading.Event()
+    results = []
+
+    def desk(seed):
+        ids = item_ids[:]
+        random.Random(seed).shuffle(ids)
+        with current_app.app_context():
+            start.wait()
+            user = models.CirculationUser.get(user_id)
+            for item_id in ids:
+                item = models.CirculationItem.get(item_id)
+                try:
+                    api.circulation.loan_items(user, [item], start_date,
+                                               end_date)
+                    results.append((item_id, 'loaned'))
+                except (ValidationExceptions, ConflictException) as e:
+                    results.append((item_id, type(e).__name__))
+            db.session.remove()
+
+    threads = [threading.Thread(target=desk, args=(i,))
+               for i in range(threads_count)]
+    for thread in threads:
+        thread.start()
+    begin = timeit.default_timer()
+    start.set()
+    for thread in threads:
+        thread.join()
+    duration = timeit.default_timer() - begin
+
+    assert len(results) == threads_count * len(item_ids)
+    loaned = sorted(x for x, res in results if res == 'loaned')
+    assert loaned == sorted(item_ids)
+    print('{0} concurrent loan attempts in {1:.3f}s, {2:.1f}/s'.format(
+        len(results), duration, len(results) / duration))
+
+    with current_app.app_context():
+        CLC = models.CirculationLoanCycle
+        clcs = CLC.find(CLC.item_id.in_(item_ids))
+        assert sorted(x.item_id for x in clcs) == sorted(item_ids)
+        assert all(x.current_status == CLC.STATUS_ON_LOAN for x in clcs)
+
+        items = [models.CirculationItem.get(x) for x in item_ids]
+        _delete_test_data(cl, clr, clrm, models.CirculationUser.get(user_id),
+                          *(clcs + items))
@@ -223,6 +223,149 @@ def test_loan_cycle_overdue(current_app, rec_uuids):
         _delete_test_data(cl, clr, clrm, cu, ci, clc)
 
 
+def test_loan_cycle_detect_overdue(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates(start_weeks=-5)
+
+        current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
+        clc = api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                    current_status=current_status,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    desired_start_date=start_date,
+                                    desired_end_date=end_date,
+                                    issued_date=start_date,
+                                    delivery=None)
+
+        res = api.loan_cycle.detect_overdue(chunk_size=1)
+        assert res['overdue'] >= 1
+        assert res['chunks'] >= 1
+
+        clc = models.CirculationLoanCycle.get(clc.id)
+        stat = models.CirculationLoanCycle.STATUS_OVERDUE
+        assert clc.additional_statuses.count(stat) == 1
+
+        # A second run doesn't find anything left to overdue.
+        assert api.loan_cycle.detect_overdue()['overdue'] == 0
+
+        query = 'loan_cycle_id:{0} event:{1}'.format(
+                clc.id, models.CirculationLoanCycle.EVENT_OVERDUE)
+        assert len(models.CirculationEvent.search(query)) == 1
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
+
+
+def test_loan_cycle_conflict(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_db import db
+    from sqlalchemy.orm.exc import StaleDataError
+
+    CLC = models.CirculationLoanCycle
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+        clc = api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                    current_status=CLC.STATUS_REQUESTED,
+                                    start_date=start_date,
+                                    end_date=end_date,
+                                    desired_start_date=start_date,
+                                    desired_end_date=end_date,
+                                    issued_date=start_date,
+                                    delivery=None)
+        table = CLC.__table__
+
+        def change_concurrently():
+            db.session.execute(table.update()
+                               .where(table.c.id == clc.id)
+                               .values(version_id=table.c.version_id + 1))
+
+        # A stale save raises instead of being dropped
+        change_concurrently()
+        clc.delivery = 'conflict'
+        with pytest.raises(StaleDataError):
+            clc.save()
+        assert CLC.get(clc.id).delivery is None
+
+        # Actions run again on the reloaded loan cycles
+        change_concurrently()
+        api.loan_cycle.transform_into_loan([clc])
+        assert CLC.get(clc.id).current_status == CLC.STATUS_ON_LOAN
+
+        events = models.CirculationEvent.query.filter_by(
+                loan_cycle_id=clc.id, event=CLC.EVENT_TRANSFORMED_REQUEST)
+        assert events.count() == 1
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
+
+
+def test_loan_cycle_overdue_letters(current_app, rec_uuids, monkeypatch):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates(start_weeks=-5)
+        cmt = api.mail_template.create('test_overdue_letter', 'Overdue',
+                                       'Dear {{ name }}',
+                                       '{{ items|length }} items')
+        letters = current_app.config['CIRCULATION_OVERDUE_LETTERS']
+        current_app.config['CIRCULATION_OVERDUE_LETTERS'] = [
+                ('test_overdue_letter', 0)]
+
+        current_status = models.CirculationLoanCycle.STATUS_ON_LOAN
+        clcs = [api.loan_cycle.create(item_id=ci.id, user_id=cu.id,
+                                      current_status=current_status,
+                                      start_date=start_date,
+                                      end_date=end_date,
+                                      desired_start_date=start_date,
+                                      desired_end_date=end_date,
+                                      issued_date=start_date,
+                                      delivery=None)
+                for _ in range(3)]
+        api.loan_cycle.detect_overdue()
+
+        # A failure to store the mails leaves the loan cycles uncovered
+        def failing_store_all(mails):
+            raise ValueError()
+
+        monkeypatch.setattr(api.mail, 'store_all', failing_store_all)
+        with pytest.raises(ValueError):
+            api.loan_cycle.send_overdue_letters()
+        monkeypatch.undo()
+        query = models.CirculationEvent.query.filter(
+                models.CirculationEvent.loan_cycle_id.in_(
+                    [x.id for x in clcs]),
+                models.CirculationEvent.event ==
+                models.CirculationLoanCycle.EVENT_OVERDUE_LETTER)
+        assert query.count() == 0
+
+        mail = current_app.extensions['mail']
+        with mail.record_messages() as outbox:
+            res = api.loan_cycle.send_overdue_letters()
+            assert res['letters'] >= 1
+            assert res['loan_cycles'] >= 3
+            assert api.loan_cycle.send_overdue_letters()['letters'] == 0
+
+        outbox = [x for x in outbox if x.recipients == [cu.email]]
+        assert len(outbox) == 1
+        assert outbox[0].body == 'Dear {0}\n3 items'.format(cu.name)
+
+        for clc in clcs:
+            query = 'loan_cycle_id:{0} event:{1}'.format(
+                    clc.id, models.CirculationLoanCycle.EVENT_OVERDUE_LETTER)
+            assert len(models.CirculationEvent.search(query)) == 1
+
+        current_app.config['CIRCULATION_OVERDUE_LETTERS'] = letters
+        models.CirculationMail.query.filter_by(recipient=cu.email).delete()
+        _delete_test_data(cl, clr, clrm, cu, ci, cmt, *clcs)
+
+
 def test_loan_cycle_overdue_failure(current_app, rec_uuids):
     import datetime
     import invenio_circulation.api as api
@@ -422,6 +565,21 @@ def test_loan_cycle_extension_failure_item_status(current_app, rec_uuids):
         _delete_test_data(cl, clr, clrm, cu, ci, clc_l)
 
 
+def test_loan_cycle_extension_failure_no_clcs(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    from invenio_circulation.api.availability import Availability
+    from invenio_circulation.api.utils import ValidationExceptions
+
+    with current_app.app_context():
+        start_date, end_date = _create_dates()
+
+        assert Availability.join([], start_date, end_date).free
+
+        with pytest.raises(ValidationExceptions) as e:
+            api.loan_cycle.try_loan_extension([], end_date)
+        assert 'user' in [x[0] for x in e.value.exceptions]
+
+
 def test_update_waitlist_end_date(current_app, rec_uuids):
     '''
     A request in the future will be canceled, thus the end_date will be
@@ -447,6 +605,91 @@ def test_update_waitlist_end_date(current_app, rec_uuids):
         _delete_test_data(cl, clr, clrm, cu, ci, clc_l)
 
 
+def test_update_waitlist_changes(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date1, end_date1 = _create_dates()
+        start_date2, end_date2 = _create_dates(start_weeks=2)
+
+        clc_r = api.circulation.request_items(cu, [ci],
+                                              start_date2, end_date2)[0]
+        clc_l = api.circulation.loan_items(cu, [ci],
+                                           start_date1, end_date1,
+                                           waitlist=True)[0]
+        shortened_end_date = clc_l.end_date
+        assert shortened_end_date < end_date1
+
+        api.loan_cycle.update(
+                clc_r,
+                current_status=models.CirculationLoanCycle.STATUS_CANCELED)
+        changes = api.loan_cycle.update_waitlist(clc_r)
+
+        assert [(clc.id, old, new) for clc, old, new in changes] == [
+                (clc_l.id, (start_date1, shortened_end_date),
+                 (start_date1, end_date1))]
+        assert models.CirculationLoanCycle.get(clc_l.id).end_date == end_date1
+        assert api.loan_cycle.update_waitlist(clc_r) == []
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc_l, clc_r)
+
+
+def test_update_waitlist_deferred(current_app, rec_uuids):
+    import invenio_circulation.api as api
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date1, end_date1 = _create_dates()
+        start_date2, end_date2 = _create_dates(start_weeks=2)
+        start_date3, end_date3 = _create_dates(start_weeks=3)
+
+        clc_r2 = api.circulation.request_items(cu, [ci],
+                                               start_date3, end_date3)[0]
+        clc_r1 = api.circulation.request_items(cu, [ci],
+                                               start_date2, end_date2,
+                                               waitlist=True)[0]
+        clc_l = api.circulation.loan_items(cu, [ci],
+                                           start_date1, end_date1,
+                                           waitlist=True)[0]
+
+        with api.waitlist.deferred() as pending:
+            api.loan_cycle.cancel_clcs([clc_r1, clc_r2])
+            assert pending == {ci.id: [clc_r1.id, clc_r2.id]}
+            assert clc_l.end_date != clc_l.desired_end_date
+
+        assert clc_l.end_date == clc_l.desired_end_date
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc_l, clc_r1, clc_r2)
+
+
+def test_update_waitlist_deferred_failure(current_app, rec_uuids,
+                                          monkeypatch):
+    import invenio_circulation.api as api
+
+    dispatched = []
+    monkeypatch.setattr(api.waitlist, 'dispatch', dispatched.append)
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        start_date, end_date = _create_dates()
+        clc = api.circulation.request_items(cu, [ci],
+                                            start_date, end_date)[0]
+
+        with pytest.raises(ValueError):
+            with api.waitlist.deferred():
+                api.waitlist.defer(clc)
+                raise ValueError()
+        assert dispatched == []
+
+        with api.waitlist.deferred():
+            api.waitlist.defer(clc)
+        assert dispatched == [{ci.id: [clc.id]}]
+
+        _delete_test_data(cl, clr, clrm, cu, ci, clc)
+
+
 def test_update_waitlist_end_date1(current_app, rec_uuids):
     '''
     A request in the future will be canceled, thus the end_date will be
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Mail outbox tests."""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import socket
+
+from utils import (_create_test_data, _delete_test_data,
+                   current_app, rec_uuids, state)
+
+
+def _delete_mails(mails):
+    from invenio_db import db
+
+    for cm in mails:
+        db.session.delete(cm)
+    db.session.commit()
+
+
+def test_send_message_queued(current_app, rec_uuids, monkeypatch):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        connections = []
+        mail = current_app.extensions['mail']
+        connect = mail.connect
+
+        def counting_connect():
+            connections.append(1)
+            return connect()
+
+        monkeypatch.setattr(mail, 'connect', counting_connect)
+        with mail.record_messages() as outbox:
+            api.user.send_message([cu] * 5, 'Subject', 'Message')
+
+        assert len(outbox) == 5
+        assert len(connections) == 1
+        assert outbox[0].recipients == [cu.email]
+
+        mails = models.CirculationMail.query.filter_by(
+                recipient=cu.email).all()
+        assert len(mails) == 5
+        assert all(x.status == models.CirculationMail.STATUS_SENT
+                   for x in mails)
+        assert all(x.attempts == 1 for x in mails)
+
+        _delete_mails(mails)
+        _delete_test_data(cl, clr, clrm, cu, ci)
+
+
+def test_mail_retry(current_app, monkeypatch):
+    from flask_mail import Connection
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+
+    def failing_send(self, message, envelope_from=None):
+        raise socket.error('Connection refused')
+
+    monkeypatch.setattr(Connection, 'send', failing_send)
+
+    with current_app.app_context():
+        current_app.config['CIRCULATION_MAIL_MAX_ATTEMPTS'] = 2
+        recipient = 'mail.retry@test.com'
+        api.mail.queue_all([('john.doe@cern.ch', recipient, 'Subject',
+                             'Body')] * 2)
+
+        mails = models.CirculationMail.query.filter_by(
+                recipient=recipient).all()
+        assert all(x.status == models.CirculationMail.STATUS_PENDING
+                   for x in mails)
+        assert all(x.attempts == 1 for x in mails)
+        assert all(x.next_attempt > datetime.datetime.now() for x in mails)
+        assert all('Connection refused' in x.last_error for x in mails)
+
+        # Nothing is due before the backoff delay passed.
+        assert api.mail.send_pending() == {'sent': 0, 'retried': 0,
+                                           'failed': 0}
+
+        for cm in mails:
+            cm.next_attempt = datetime.datetime.now()
+        res = api.mail.send(mails)
+        assert res == {'sent': 0, 'retried': 0, 'failed': 2}
+        assert all(x.status == models.CirculationMail.STATUS_FAILED
+                   for x in mails)
+
+        current_app.config['CIRCULATION_MAIL_MAX_ATTEMPTS'] = 5
+        _delete_mails(mails)
+
+
+def test_mail_template_cache(current_app):
+    import invenio_circulation.api as api
+    from invenio_circulation.api.mail_template import get_template
+
+    with current_app.app_context():
+        cmt = api.mail_template.create('cache_test', 'Hello {{ name }}',
+                                       'Dear {{ name }},', 'Content')
+
+        template = get_template('cache_test')
+        assert get_template('cache_test') is template
+        assert template.render(name='John') == ('Hello John',
+                                                'Dear John,\nContent')
+
+        api.mail_template.update(cmt, content='Changed')
+        changed = get_template('cache_test')
+        assert changed is not template
+        assert changed.render(name='John')[1] == 'Dear John,\nChanged'
+
+        api.mail_template.delete(cmt)
+        assert get_template('cache_test') is None
@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Request queue tests."""
+
+from __future__ import absolute_import, print_function
+
+import threading
+
+from utils import (_create_dates, _create_test_data, _delete_test_data,
+                   current_app, rec_uuids, state)
+
+
+def _create_requests(cu, ci, count):
+    import invenio_circulation.api as api
+
+    res = []
+    for i in range(count):
+        start_date, end_date = _create_dates(start_weeks=5 * i + 1)
+        res.extend(api.circulation.request_items(cu, [ci], start_date,
+                                                 end_date))
+    return res
+
+
+def test_request_queue_claim(current_app, rec_uuids):
+    import invenio_circulation.api as api
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        clcs = _create_requests(cu, ci, 3)
+        ids = set(x.id for x in clcs)
+
+        desk1 = [x for x in api.request_queue.claim('desk1', 2)
+                 if x.id in ids]
+        desk2 = [x for x in api.request_queue.claim('desk2', 10)
+                 if x.id in ids]
+        assert len(desk1) == 2
+        assert len(desk2) == 1
+        assert not set(x.id for x in desk1) & set(x.id for x in desk2)
+        assert desk1[0].id == clcs[0].id
+
+        assert api.request_queue.renew('desk2', desk1) == 0
+        assert api.request_queue.renew('desk1', desk1) == 2
+        assert api.request_queue.release('desk1', desk1[:1]) == 1
+        claimed = [x.id for x in api.request_queue.get_claimed('desk1')]
+        assert desk1[0].id not in claimed
+        assert desk1[1].id in claimed
+
+        desk3 = [x for x in api.request_queue.claim('desk3') if x.id in ids]
+        assert [x.id for x in desk3] == [desk1[0].id]
+
+        _delete_test_data(cl, clr, clrm, cu, ci, *clcs)
+
+
+def test_request_queue_fill(current_app, rec_uuids):
+    import invenio_circulation.api as api
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        clcs = _create_requests(cu, ci, 3)
+        size = current_app.config['CIRCULATION_REQUEST_CLAIM_SIZE']
+        current_app.config['CIRCULATION_REQUEST_CLAIM_SIZE'] = 2
+
+        first = api.request_queue.fill('fill_desk')
+        assert len(first) == 2
+
+        # Refreshing shows the same claims, the limit is capped
+        again = api.request_queue.fill('fill_desk', 100)
+        assert [x.id for x in again] == [x.id for x in first]
+
+        # Only the shortfall is claimed
+        api.request_queue.release('fill_desk', first[:1])
+        refilled = api.request_queue.fill('fill_desk')
+        assert len(refilled) == 2
+        assert first[1].id in [x.id for x in refilled]
+
+        current_app.config['CIRCULATION_REQUEST_CLAIM_SIZE'] = size
+        api.request_queue.release('fill_desk', refilled)
+        _delete_test_data(cl, clr, clrm, cu, ci, *clcs)
+
+
+def test_request_queue_lease_expiry(current_app, rec_uuids):
+    import invenio_circulation.api as api
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        clcs = _create_requests(cu, ci, 1)
+
+        lease = current_app.config['CIRCULATION_REQUEST_CLAIM_LEASE']
+        current_app.config['CIRCULATION_REQUEST_CLAIM_LEASE'] = 0
+        assert clcs[0].id in [x.id for x in api.request_queue.claim('desk1')]
+        current_app.config['CIRCULATION_REQUEST_CLAIM_LEASE'] = lease
+
+        assert clcs[0].id in [x.id for x in api.request_queue.claim('desk2')]
+        assert clcs[0].id not in [x.id for x in
+                                  api.request_queue.claim('desk3')]
+
+        _delete_test_data(cl, clr, clrm, cu, ci, *clcs)
+
+
+def test_request_queue_concurrent_claims(current_app, rec_uuids):
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_db import db
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        clcs = _create_requests(cu, ci, 8)
+        ids = set(x.id for x in clcs)
+        user_id, item_id = cu.id, ci.id
+
+    start = threading.Event()
+    claimed = []
+
+    def desk(name):
+        with current_app.app_context():
+            start.wait()
+            while True:
+                res = api.request_queue.claim(name, 1)
+                if not res:
+                    break
+                claimed.extend(x.id for x in res if x.id in ids)
+            db.session.remove()
+
+    threads = [threading.Thread(target=desk, args=('desk{0}'.format(i),))
+               for i in range(4)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(claimed) == sorted(ids)
+
+    with current_app.app_context():
+        CLC = models.CirculationLoanCycle
+        _delete_test_data(cl, clr, clrm, models.CirculationUser.get(user_id),
+                          models.CirculationItem.get(item_id),
+                          *CLC.find(CLC.id.in_(ids)))
+
+
+def test_request_queue_claim_race(current_app, rec_uuids, monkeypatch):
+    import datetime
+    import invenio_circulation.api as api
+    import invenio_circulation.models as models
+    from invenio_db import db
+    from sqlalchemy.sql.expression import Delete
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        clcs = _create_requests(cu, ci, 1)
+        Claim = models.CirculationRequestClaim
+        table = Claim.__table__
+
+        # Without row locks, as on SQLite, another process can claim the
+        # loan cycle between the check of the claims and the insert
+        monkeypatch.setattr(api.request_queue, '_SKIP_LOCKED_DIALECTS', ())
+        execute = db.session.execute
+        calls = []
+
+        def claim_concurrently(statement, *args, **kwargs):
+            if not calls and isinstance(statement, Delete):
+                calls.append(statement)
+                now = datetime.datetime.now()
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert().values(
+                            loan_cycle_id=clcs[0].id, desk='other_desk',
+                            claim_date=now,
+                            expiry_date=now + datetime.timedelta(hours=1)))
+            return execute(statement, *args, **kwargs)
+
+        monkeypatch.setattr(db.session, 'execute', claim_concurrently)
+        claimed = api.request_queue.claim('desk1', 10)
+        monkeypatch.undo()
+
+        assert len(calls) == 1
+        assert clcs[0].id not in [x.id for x in claimed]
+        assert Claim.query.get(clcs[0].id).desk == 'other_desk'
+
+        api.request_queue.release('desk1', claimed)
+        api.request_queue.release('other_desk', clcs)
+        _delete_test_data(cl, clr, clrm, cu, ci, *clcs)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""Module tests."""
+
+from __future__ import absolute_import, print_function
+
+
+def test_simulation():
+    """Test a small benchmark run."""
+    import json
+
+    from invenio_circulation.benchmark import Simulation, compare
+
+    results = Simulation(items=3, requests=20, horizon=30).run()
+    assert results['parameters']['items'] == 3
+    assert sum(x['count'] for x in results['operations'].values()) == 60
+    for stats in results['operations'].values():
+        assert stats['p50'] <= stats['p90'] <= stats['p99'] <= stats['max']
+
+    results = json.loads(json.dumps(results))
+    assert set(compare(results, results).values()) <= set([1.0])
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""DateManager tests."""
+
+from __future__ import absolute_import, print_function
+
+import datetime
+import random
+
+import pytest
+
+
+def _legacy_timeline(dm, requested_period, periods):
+    periods = [dm._convert_to_days(*x) for x in periods]
+    requested_period = dm._convert_to_days(*requested_period)
+    period_min = min(x[0] for x in periods + [requested_period])
+    period_max = max(x[1] for x in periods + [requested_period])
+    return period_min, [int(any(s <= x <= e for s, e in periods))
+                        for x in range(period_min, period_max)]
+
+
+def _legacy_contained_date(dm, requested_start, requested_end, periods):
+    """Day by day implementation DateManager was using before."""
+    req_start, req_end = dm._convert_to_days(requested_start, requested_end)
+    first, timeline = _legacy_timeline(dm, (requested_start, requested_end),
+                                       periods)
+    start, end = None, None
+    for i in range(req_start - first, req_end - first):
+        if timeline[i] == 0 and start is None:
+            start = i
+        elif timeline[i] == 1 and start is not None and end is None:
+            end = i - 1
+    if start is None:
+        return None
+    elif end is None:
+        return dm._convert_to_datetime(first + start, req_end)
+    return dm._convert_to_datetime(first + start, first + end)
+
+
+def _legacy_date_suggestions(dm, periods):
+    today = datetime.date.today()
+    first, timeline = _legacy_timeline(dm, (today, today), periods)
+    res = []
+    start = None
+    for i, day in enumerate(timeline):
+        if day == 0 and start is None:
+            start = i
+        elif day == 1 and start is not None:
+            res.append((first + start, first + i - 1))
+            start = None
+    if start is None:
+        res.append((first + len(timeline) + 1, None))
+    else:
+        res.append((first + start, first + len(timeline)))
+    return [dm._convert_to_datetime(*x) for x in res]
+
+
+def _random_periods(rand, today):
+    res = []
+    for _ in range(rand.randint(0, 8)):
+        start = today + datetime.timedelta(days=rand.randint(-30, 30))
+        res.append((start, start + datetime.timedelta(rand.randint(0, 10))))
+    return res
+
+
+def test_date_manager_legacy_compatibility():
+    from invenio_circulation.api.utils import DateException, DateManager
+
+    rand = random.Random(42)
+    today = datetime.date.today()
+
+    for _ in range(2000):
+        periods = _random_periods(rand, today)
+        start = today + datetime.timedelta(days=rand.randint(-35, 35))
+        end = start + datetime.timedelta(days=rand.randint(0, 20))
+
+        expected = _legacy_contained_date(DateManager, start, end, periods)
+        if expected is None:
+            with pytest.raises(DateException):
+                DateManager.get_contained_date(start, end, periods)
+        else:
+            assert DateManager.get_contained_date(start, end,
+                                                  periods) == expected
+
+        if periods:
+            expected = _legacy_date_suggestions(DateManager, periods)
+            assert DateManager.get_date_suggestions(periods) == expected
+
+    # Reversed periods never contain a date
+    with pytest.raises(DateException):
+        DateManager.get_contained_date(today, today - datetime.timedelta(2),
+                                       [])
+
+
+def test_date_manager_free_periods():
+    from invenio_circulation.api.utils import DateManager, Occupancy
+
+    rand = random.Random(42)
+    today = datetime.date.today()
+
+    for _ in range(500):
+        periods = _random_periods(rand, today)
+        occupancy = DateManager.get_occupancy(periods)
+        start = today - datetime.timedelta(days=40)
+        end = today + datetime.timedelta(days=45)
+
+        days = [start + datetime.timedelta(days=x)
+                for x in range((end - start).days + 1)]
+        free = [x for x in days if not any(s <= x <= e for s, e in periods)]
+
+        # The free periods cover exactly the free days
+        windows = DateManager.get_free_periods(start, 100, occupancy)
+        assert windows[-1][1] is None
+        covered = []
+        for s, e in windows:
+            e = e or end
+            covered.extend(s + datetime.timedelta(days=x)
+                           for x in range((e - s).days + 1))
+        assert [x for x in covered if x <= end] == free
+
+        largest = DateManager.get_largest_free_period(start, end, occupancy)
+        if not free:
+            assert largest is None
+        else:
+            length = max(min(e or end, end) - s for s, e in windows)
+            assert largest[1] - largest[0] == length
+            assert all(x in free for x in (largest[0], largest[1]))
+
+    assert len(Occupancy([(1, 2), (3, 4), (6, 8), (7, 7)])) == 2
+
+
+def test_date_manager_mutable_occupancy():
+    from invenio_circulation.api.utils import MutableOccupancy, Occupancy
+
+    rand = random.Random(42)
+    periods = []
+    for _ in range(200):
+        start = rand.randint(0, 300)
+        periods.append((start, start + rand.randint(0, 20)))
+
+    mutable = MutableOccupancy(periods[:100])
+    for period in periods[100:]:
+        mutable.add(*period)
+    for period in periods[:50]:
+        mutable.remove(*period)
+    assert len(mutable) == 150
+
+    # The lookups match the ones of the merged periods
+    occupancy = Occupancy(periods[50:])
+    for day in range(-1, 330):
+        first_free = occupancy.get_first_free_day(day)
+        assert mutable.get_first_free_day(day) == first_free
+        assert (mutable.get_next_busy_day(first_free) ==
+                occupancy.get_next_busy_day(first_free))
+
+    with pytest.raises(ValueError):
+        mutable.remove(*periods[0])
@@ -27,6 +27,7 @@
 
 from __future__ import absolute_import, print_function
 
+import pytest
 from flask import Flask
 
 from invenio_circulation import InvenioCirculation
@@ -49,3 +50,16 @@ def test_init():
     assert 'invenio-circulation' not in app.extensions
     ext.init_app(app)
     assert 'invenio-circulation' in app.extensions
+
+
+def test_filter_params():
+    """Test the extraction of function parameters."""
+    from invenio_circulation.views.utils import filter_params
+
+    def func(a, b, c=3):
+        return a, b, c
+
+    assert filter_params(func, a=1, b=2, d=4) == (1, 2, 3)
+    assert filter_params(func, a=1, b=2, c=5) == (1, 2, 5)
+    with pytest.raises(KeyError):
+        filter_params(func, a=1, c=5)
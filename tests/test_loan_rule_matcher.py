@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of Invenio.
+# Copyright (C) 2016 CERN.
+#
+# Invenio is free software; you can redistribute it
+# and/or modify it under the terms of the GNU General Public License as
+# published by the Free Software Foundation; either version 2 of the
+# License, or (at your option) any later version.
+#
+# Invenio is distributed in the hope that it will be
+# useful, but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Invenio; if not, write to the
+# Free Software Foundation, Inc., 59 Temple Place, Suite 330, Boston,
+# MA 02111-1307, USA.
+#
+# In applying this license, CERN does not
+# waive the privileges and immunities granted to it by virtue of its status
+# as an Intergovernmental Organization or submit itself to any jurisdiction.
+
+
+"""LoanRuleMatcher tests."""
+
+from __future__ import absolute_import, print_function
+
+import itertools
+import random
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+from utils import (_create_test_data, _delete_test_data,
+                   current_app, rec_uuids, state)
+
+Match = namedtuple('Match', 'id loan_rule_id item_type patron_type '
+                            'location_code')
+
+PATTERNS = ['abc', 'abd', '', '*', 'a*', 'ab*', 'abc*', 'abcd*', 'x*',
+            '*c', 'a*c', '**']
+VALUES = ['abc', 'ab', 'a', 'abcd', 'abd', 'x', '']
+
+
+def _legacy_compare(location_code, item_type, user_group, rule):
+    def _compare(val, rule_val):
+        if '*' in rule_val:
+            tmp = rule_val.replace('*', '')
+            if val.startswith(tmp):
+                res = SequenceMatcher(None, val, tmp).ratio()
+                return res if res > 0 else 0.1
+        else:
+            if rule_val == val:
+                return 1
+        return 0
+
+    return (_compare(item_type, rule.item_type),
+            _compare(user_group, rule.patron_type),
+            _compare(location_code, rule.location_code),
+            rule.loan_rule_id)
+
+
+def _legacy_match(matches, item_type, user_group, location_code):
+    rules = sorted([_legacy_compare(location_code, item_type, user_group, x)
+                    for x in matches],
+                   key=lambda x: (1-x[0], 1-x[1], 1-x[2]))
+    rules = [x for x in rules if x[0] != 0 and x[1] != 0 and x[2] != 0]
+    return rules[0][3] if rules else None
+
+
+def test_loan_rule_matcher_wildcard_combinations():
+    from invenio_circulation.api.rule_matcher import LoanRuleMatcher
+
+    combinations = itertools.product(PATTERNS, PATTERNS, PATTERNS)
+    for i, patterns in enumerate(combinations):
+        matches = [Match(i, i, *patterns)]
+        matcher = LoanRuleMatcher(matches)
+        for values in itertools.product(VALUES, VALUES, VALUES):
+            candidates = matcher.get_candidates(*values)
+            expected = _legacy_compare(values[2], values[0], values[1],
+                                       matches[0])
+            if 0 in expected[:3]:
+                assert candidates == []
+            else:
+                assert candidates == [(1 - expected[0], 1 - expected[1],
+                                       1 - expected[2], 0)]
+
+
+def test_loan_rule_matcher_precedence():
+    from invenio_circulation.api.rule_matcher import LoanRuleMatcher
+
+    rand = random.Random(42)
+    for _ in range(50):
+        matches = [Match(i, i, rand.choice(PATTERNS), rand.choice(PATTERNS),
+                         rand.choice(PATTERNS))
+                   for i in range(rand.randint(1, 30))]
+        matcher = LoanRuleMatcher(matches)
+        for values in itertools.product(VALUES, VALUES, VALUES):
+            assert (matcher.match(*values) ==
+                    _legacy_match(matches, *values))
+
+
+def test_loan_rule_matcher_empty():
+    from invenio_circulation.api.rule_matcher import LoanRuleMatcher
+
+    matcher = LoanRuleMatcher([])
+    assert matcher.match('book', 'default', 'CCL') is None
+
+
+def test_loan_rule_resolution_memoized(current_app, rec_uuids, monkeypatch):
+    import invenio_circulation.api as api
+    from invenio_circulation.api.rule_matcher import LoanRuleMatcher
+    from invenio_circulation.api.utils import get_loan_period, is_renewable
+
+    calls = []
+    match = LoanRuleMatcher.match
+
+    def counting_match(self, *args):
+        calls.append(args)
+        return match(self, *args)
+
+    monkeypatch.setattr(LoanRuleMatcher, 'match', counting_match)
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+        items = [ci] * 30
+
+        assert get_loan_period(cu, items) == 28
+        assert is_renewable(cu, items)
+        assert len(calls) == 1
+
+        api.loan_rule.update(clr, loan_period=14)
+        assert get_loan_period(cu, items) == 14
+        assert len(calls) == 2
+
+        _delete_test_data(cl, clr, clrm, cu, ci)
+
+
+def test_loan_rule_matcher_explain():
+    from invenio_circulation.api.rule_matcher import LoanRuleMatcher
+
+    matches = [Match(1, 10, '*', '*', '*'),
+               Match(2, 20, 'book', '*', 'CCL*'),
+               Match(3, 30, 'periodical', '*', '*')]
+    matcher = LoanRuleMatcher(matches)
+
+    explanation = matcher.explain('book', 'default', 'CCL')
+    assert [x['loan_rule_match_id'] for x in explanation] == [2, 1]
+    assert [x['applied'] for x in explanation] == [True, False]
+    assert explanation[0]['item_type'] == 1
+    assert explanation[0]['location_code'] == 1
+    assert explanation[1]['patron_type'] == 0.1
+    assert matcher.match('book', 'default', 'CCL') == 20
+
+
+def test_loan_rule_evaluate(current_app, rec_uuids):
+    import invenio_circulation.models as models
+    from invenio_circulation.api.rule_matcher import compare, evaluate
+    from invenio_circulation.api.utils import explain_loan_rule
+
+    with current_app.app_context():
+        cl, clr, clrm, cu, ci = _create_test_data(rec_uuids)
+
+        explanation = explain_loan_rule(cu, ci)
+        assert explanation[0]['loan_rule_match_id'] == clrm.id
+        assert explanation[0]['applied']
+
+        key = (models.CirculationUser.GROUP_DEFAULT,
+               models.CirculationItem.GROUP_BOOK, 'CCL')
+        results = evaluate()
+        assert results['count'] == len(results['results'])
+        assert key + (1, clr.id) in results['results']
+
+        matches = [{'loan_rule_id': clr.id + 1, 'item_type': '*',
+                    'patron_type': '*', 'location_code': 'C*'}]
+        migrated = evaluate(matches)
+        assert key + (1, clr.id, clr.id + 1) in compare(results, migrated)
+
+        _delete_test_data(cl, clr, clrm, cu, ci)
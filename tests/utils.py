@@ -6,9 +6,7 @@ def _create_indices(app):
     from invenio_circulation.models import entities
 
     for name, _, cls in filter(lambda x: x[0] != 'Record', entities):
-        index = cls.__tablename__
-        cls._es.indices.delete(index=index, ignore=404)
-        cls._es.indices.create(index=index, body=cls._mappings)
+        cls.create_index()
 
     es = Elasticsearch()
     es.indices.delete(index=app.config['INDEXER_DEFAULT_INDEX'], ignore=404)
@@ -95,6 +93,7 @@ def _create_dates(start_days=0, start_weeks=0, end_days=0, end_weeks=4):
 
 def _setup(app):
     from flask_cli import FlaskCLI
+    from flask_mail import Mail
     from invenio_db import InvenioDB
     from invenio_indexer import InvenioIndexer
     from invenio_search import InvenioSearch
@@ -106,8 +105,14 @@ def _setup(app):
     InvenioSearch(app)
     InvenioCirculation(app)
 
+    app.config['MAIL_SUPPRESS_SEND'] = True
+    Mail(app)
+
     db_uri = 'postgresql+psycopg2://localhost/cds'
     app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    app.config['CIRCULATION_EVENTS_ASYNC_INDEXING'] = False
+    app.config['CIRCULATION_WAITLIST_ASYNC'] = False
+    app.config['CIRCULATION_MAIL_ASYNC'] = False
 
 
 @pytest.fixture(scope='module')